@@ -11,6 +11,8 @@ import array
 import numpy as np
 from xml.etree import cElementTree as ET
 
+from noise_estimate import robust_stats
+
 
 def Set_Table_Param():
 #    if debug>0: return
@@ -193,7 +195,7 @@ def Import_and_Process_LC(folder, outfile = "LC-MS.msh5", compress=False, comp_l
             spectre.set_buffer(abuf)
             spectre.adapt_size()
             spectre.hamming().zf(2).rfft().modulus()  # double the size
-            mu, sigma = spectre.robust_stats(iterations=5)
+            mu, sigma = robust_stats(spectre.get_buffer(), iterations=5)
             spectre.buffer -= mu
             if compress:
                 spectre.zeroing(sigma*comp_level).eroding()
@@ -213,7 +215,7 @@ def Import_and_Process_LC(folder, outfile = "LC-MS.msh5", compress=False, comp_l
                     spectre.set_buffer(abuf)
                     spectre.adapt_size()
                     spectre.chsize(datai.size2).hamming().zf(2).rfft().modulus()
-                    mu, sigma = spectre.robust_stats(iterations=5)
+                    mu, sigma = robust_stats(spectre.get_buffer(), iterations=5)
                     spectre.buffer -= mu
                     if compress:
                         spectre.zeroing(sigma*comp_level).eroding()
@@ -28,14 +28,10 @@ from datetime import datetime
 import numpy as np
 from xml.etree import cElementTree as ET
 
-#################### set MKL number threads to 1 ##########
-import ctypes
-mkl_rt = ctypes.CDLL('libmkl_rt.so')
-mkl_get_max_threads = mkl_rt.mkl_get_max_threads
-def mkl_set_num_threads(cores):
-    mkl_rt.mkl_set_num_threads(ctypes.byref(ctypes.c_int(cores)))
-
-mkl_set_num_threads(1)
+from noise_estimate import robust_stats
+from executor import Executor, pipeline
+from sparse_store import make_sparse
+from processing_4EU import rfft_block, complex_type
 
 # #####################################################
 # # This code allows to pickle methods, and thus to use multiprocessing on methods
@@ -121,51 +117,61 @@ def comp_sizes(si1, si2):
         allsz.append((si1,si2))
     return allsz
 
-def iterargF2(LCfile, sizeF1, sizeF2, compress, comp_level, allsizes):
+def iterargF2(LCfile, sizeF1, sizeF2, compress, comp_level, allsizes, noise_estimator=None, dtype=float):
     "an iterator used by the F2 processing to allow multiprocessing or MPI set-up"
     for i1 in range(sizeF1):
         #print(i1, ipacket, end='  ')
         tbuf = LCfile.read(4*sizeF2)   # get data
         if len(tbuf) != 4*sizeF2:
             break
-        yield (tbuf, compress, comp_level, allsizes, i1, sizeF1)  # must return only one value !
+        yield (tbuf, compress, comp_level, allsizes, i1, sizeF1, noise_estimator, dtype)  # must return only one value !
+
+def ft_modulus(abuf, size, dtype=float):
+    """
+    the spectrum of the transient abuf, truncated or zerofilled to size, computed in dtype (float32 or float64)
+    same as spike chsize(size).hamming().zf(2).rfft().modulus()
+    """
+    x = np.zeros((1, 2*size), dtype=dtype)
+    n = min(size, abuf.size)
+    x[0,:n] = abuf[:n]
+    x[0,:size] *= np.hamming(size).astype(dtype)
+    c = rfft_block(x)[0].view(complex_type(dtype))
+    return np.sqrt(c.real**2 + c.imag**2)
+
+def erode(b):
+    "sets to zero the values of b isolated between two zeros, as spike eroding() - in place"
+    b[1:-1] = np.where(np.logical_and(b[2:] == 0, b[:-2] == 0), 0.0, b[1:-1])
+    if b[1] == 0: b[0] = 0
+    if b[-2] == 0: b[-1] = 0
+    return b
 
 def processF2row(data):
-    from spike.FTICR import FTICRData
-    tbuf, compress, comp_level, allsizes, i1, sizeF1 = data
+    """
+    process one spectrum, and its downsampled versions
+    returns them as a list of numpy buffers of type dtype - computed in dtype, float32 also halves the transfer to the main process
+    """
+    tbuf, compress, comp_level, allsizes, i1, sizeF1, noise_estimator, dtype = data
     if sys.maxsize  == 2**31-1:   # the flag used by array depends on architecture - here on 32bit
         flag = 'l'              # Apex files are in int32
     else:                       # here in 64bit
         flag = 'i'              # strange, but works here.
-    abuf = np.array(array.array(flag,tbuf),dtype=float)
-
-    # processing
-    spectre = FTICRData(buffer=abuf)               # to handle FT
-    spectre.adapt_size()
-    spectre.hamming().zf(2).rfft().modulus()  # double the size
-    mu, sigma = spectre.robust_stats(iterations=5)
-    spectre.buffer -= mu
-    if compress:
-        spectre.zeroing(sigma*comp_level).eroding()
+    abuf = np.array(array.array(flag,tbuf),dtype=dtype)
 
+    # processing - the full spectrum, and its downsampled versions
+    sizes = [abuf.size] + [size2 for (size1, size2) in allsizes if i1%(sizeF1//size1) == 0]   # modulo the size ratio
     spectres = []
-    spectres.append(spectre)
-    # now downsampling
-    for idt, (size1,size2) in enumerate(allsizes):
-        if i1%(sizeF1//size1) == 0:   # modulo the size ratio
-            spectre = FTICRData(buffer=abuf)
-            spectre.adapt_size()
-            spectre.chsize(size2).hamming().zf(2).rfft().modulus()
-            mu, sigma = spectre.robust_stats(iterations=5)
-            spectre.buffer -= mu
-            if compress:
-                spectre.zeroing(sigma*comp_level).eroding()
-            spectres.append(spectre)
-
+    for size in sizes:
+        spectre = ft_modulus(abuf, size, dtype)
+        mu, sigma = robust_stats(spectre, iterations=5, method=noise_estimator)
+        spectre -= mu
+        if compress:
+            spectre[abs(spectre) < sigma*comp_level] = 0.0
+            erode(spectre)
+        spectres.append(spectre)
     return spectres
 
 def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
-        compress=False, comp_level=3.0, downsample=True, dparameters=None):
+        compress=False, comp_level=3.0, downsample=True, dparameters=None, noise_estimator=None, precision='double', backend=None, prefetch=4, sparse=False):
     """
     Entry point to import sets of LC-MS spectra
     processing is done on the fly
@@ -173,12 +179,18 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
     
     compression is active if (compress=True).
     comp_level is the ratio (in x sigma) under which values are set to 0.0
+    noise_estimator is the method used to estimate sigma (see noise_estimate.py)
+    if precision is 'single', spectra are transfered and buffered in float32 - the file is still in float64
+    backend is the way spectra are processed in parallel, on nProc workers (see executor.py)
+        if None, 'processes' is used if nProc > 1, 'serial' otherwise
+    reading the file, processing and writing the results are overlapped, with queues of prefetch spectra (see executor.pipeline())
+        the waiting times of each stage are printed - 0 runs them one after the other
+    if sparse is True, the chunks holding only zeros are not stored (see sparse_store.py)
     downsample is applied if (downsample=True).
     These two parameters are efficient but it takes time.
 
     dparameters if present, is a dictionnary copied into the final file as json 
     """
-    import multiprocessing as mp
     from spike.File import Solarix, Apex 
 #    from spike.File.Solarix import locate_acquisition, read_param
     from spike.NPKData import TimeAxis, copyaxes
@@ -187,9 +199,11 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
     from spike.util import widgets
     from spike.FTICR import FTICRData
 
-    if nProc > 1:
-        print("** running on %d processors"%nProc)
-        Pool = mp.Pool(nProc)
+    if backend is None:
+        backend = 'processes' if nProc > 1 else 'serial'
+    executor = Executor(backend, nProc)     # BLAS is limited to one thread per worker
+    if executor.parallel:
+        print("** running on", executor)
 
     for _importer in (Solarix, Apex):
         try:
@@ -249,6 +263,8 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
     if compress:
         HF.set_compression(True)
     HF.create_from_template(data, group='resol1')
+    if sparse:
+        make_sparse(data)
     HF.store_internal_object(params, h5name='params')    # store params in the file
     # then store files xx.methods and scan.xml
     HF.store_internal_file(parfilename)
@@ -271,6 +287,8 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
             datai.axis1.size = si1
             datai.axis2.size = si2
             HF.create_from_template(datai, group='resol%d'%(i+2))
+            if sparse:
+                make_sparse(datai)
             datalist.append(datai)
             maxvalues.append(0.0)
 
@@ -281,42 +299,42 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
     pbar = pg.ProgressBar(widgets=Impwidgets, maxval=sizeF1, fd=sys.stdout).start()
     
     with open(fname,"rb") as f:
-        ipacket = 0
         szpacket = 11
-        packet = np.zeros((szpacket,sizeF2))   # store by packet to increase compression speed
-        absmax = 0.0
-
-        xarg = iterargF2(f, sizeF1, sizeF2, compress, comp_level, allsizes )      # construct iterator for main loop
-
-        if nProc>1:
-            res = Pool.imap(processF2row, xarg)   # multiproc processing using Pool
-        else:
-            res = map(processF2row, xarg)         # plain single proc processing
-        for i1,spectres in enumerate(res):        # and get results
-            spectre = spectres.pop(0)
-            packet[ipacket,:] = spectre.buffer[:]  # store into packet
-            np.maximum(projection.buffer, spectre.buffer, out=projection.buffer)  # projection
-            if (ipacket+1)%szpacket == 0:          # and dump every szpacket
-                maxvalues[0] = max( maxvalues[0], abs(packet.max()) )   # compute max
-                data.buffer[i1-(szpacket-1):i1+1,:] = packet[:,:]  # and copy
-                packet[:,:] = 0.0
-                ipacket = 0
-            else:
-                ipacket += 1
-            # now downsample
-            for idt,spectre in enumerate(spectres):
-                datai = datalist[idt]
-                if i1%(sizeF1//datai.size1) == 0:   # modulo the size ratio
-                    ii1 = (i1*datai.size1) // sizeF1
-                    maxvalues[idt+1] = max( maxvalues[idt+1], spectre.absmax )   # compute max (0 is full spectrum)
-                    datai.buffer[ii1,:] = spectre.buffer[:]
-
-            pbar.update(i1+1)
-            last = i1
-        # flush the remaining packet
-        maxvalues[0] = max( maxvalues[0], abs(packet[:ipacket,:].max()) )
-        data.buffer[last-ipacket:last,:] = packet[:ipacket,:]
+        dtype = np.float32 if precision == 'single' else np.float64
+        packet = np.zeros((szpacket,sizeF2), dtype=dtype)   # store by packet to increase compression speed
+
+        xarg = iterargF2(f, sizeF1, sizeF2, compress, comp_level, allsizes, noise_estimator, dtype)      # construct iterator for main loop
+
+        def store(res):     # runs in the writer thread
+            ipacket = 0
+            for i1,spectres in enumerate(res):        # and get results
+                spectre = spectres.pop(0)
+                packet[ipacket,:] = spectre[:]  # store into packet
+                np.maximum(projection.buffer, spectre, out=projection.buffer)  # projection
+                if (ipacket+1)%szpacket == 0:          # and dump every szpacket
+                    maxvalues[0] = max( maxvalues[0], abs(packet.max()) )   # compute max
+                    data.buffer[i1-(szpacket-1):i1+1,:] = packet[:,:]  # and copy
+                    packet[:,:] = 0.0
+                    ipacket = 0
+                else:
+                    ipacket += 1
+                # now downsample
+                for idt,spectre in enumerate(spectres):
+                    datai = datalist[idt]
+                    if i1%(sizeF1//datai.size1) == 0:   # modulo the size ratio
+                        ii1 = (i1*datai.size1) // sizeF1
+                        maxvalues[idt+1] = max( maxvalues[idt+1], np.abs(spectre).max() )   # compute max (0 is full spectrum)
+                        datai.buffer[ii1,:] = spectre[:]
+
+                pbar.update(i1+1)
+                last = i1
+            # flush the remaining packet
+            maxvalues[0] = max( maxvalues[0], abs(packet[:ipacket,:].max()) )
+            data.buffer[last-ipacket:last,:] = packet[:ipacket,:]
+
+        _, stats = pipeline(lambda xs: executor.imap(processF2row, xs), xarg, store, prefetch, name='Import', inflight=prefetch+executor.inflight)
     pbar.finish()
+    stats.report()
 
     # then write projection as 'projectionF2'
     print('writing projections')
@@ -325,6 +343,11 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
     HF.create_from_template(proj, group='projectionF2')
     proj.buffer[:] =  projection.buffer[:]
 
+    if sparse:
+        print('writing occupancy maps')
+        for d in [data] + datalist:
+            d.buffer.save()
+
     # store maxvalues in the file
     print('writing max abs value')
     HF.store_internal_object(maxvalues, h5name='maxvalues')
@@ -335,8 +358,7 @@ def Import_and_Process_LC(folder, nProc=1, outfile = "LC-MS.msh5",
 
     # and close
     HF.flush()
-    if nProc>1:
-        Pool.close()    # finally closes multiprocessing slaves
+    executor.close()    # finally closes the slaves
     return data
 
 class Proc_Parameters(object):
@@ -354,6 +376,11 @@ class Proc_Parameters(object):
         self.erase = True
         self.paramfile = None
         self.mp = 4
+        self.executor = None
+        self.noise_estimator = 'clip'
+        self.precision = 'double'
+        self.prefetch = 4
+        self.sparse = False
         if configfile is not None:
             self.paramfile = configfile
             cp = NPKConfigParser()
@@ -366,6 +393,11 @@ class Proc_Parameters(object):
             self.downSampling = cp['processing'].getboolean("downsampling", "True")
             self.erase = cp['processing'].getboolean("erase", "True")
             self.mp = cp['processing'].getint("multiprocessing", self.mp)
+            self.executor = cp['processing'].get("executor", self.executor)
+            self.noise_estimator = cp['processing'].get("noise_estimator", self.noise_estimator)
+            self.precision = cp['processing'].get("precision", self.precision)
+            self.prefetch = cp['processing'].getint("prefetch", self.prefetch)
+            self.sparse = cp['processing'].getboolean("sparse_outfile", self.sparse)
             if self.infilename is None:
                 self.infilename = os.path.dirname(self.paramfile)
             if self.outfile is None:
@@ -466,7 +498,7 @@ def main():
     Set_Table_Param()
     d = Import_and_Process_LC(param.infilename, nProc=param.mp, outfile=param.fulloutname,
         compress=param.compression, comp_level=param.compress_level, downsample=param.downSampling,
-        dparameters=param.todic() )
+        dparameters=param.todic(), noise_estimator=param.noise_estimator, precision=param.precision, backend=param.executor, prefetch=param.prefetch, sparse=param.sparse )
     elaps = time.time()-t0
     print('Processing took %.2f minutes'%(elaps/60))
 
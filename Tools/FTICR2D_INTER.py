@@ -30,6 +30,7 @@ from spike.FTICR import FTICRData
 
 from . import FTICR_INTER as FI
 from . import utilities as U
+from ..sparse_store import load_sparse
 from . import parameters as p
 
 #
@@ -63,12 +64,20 @@ class MR(object):
                 pass
             else:
                 dl.unit='m/z'
-                self.data.append(dl)
-        # load diagonal
+                self.data.append(load_sparse(dl))     # reads only the chunks holding data
+        # load diagonal and projections - precomputed by the processing, small enough to be kept in memory
         try:
-            self.diag = FTICR.FTICRData(name=self.name, mode="onfile", group="diagonal")
+            self.diag = FTICR.FTICRData(name=self.name, mode="memory", group="diagonal")
         except tables.NoSuchNodeError:
             self.diag = self.data[0].diagonal().plus()
+        for attr, grp in (('proj1', 'projectionF1'), ('proj2', 'projectionF2')):
+            try:
+                proj = FTICR.FTICRData(name=self.name, mode="memory", group=grp)
+            except tables.NoSuchNodeError:
+                proj = None
+            else:
+                proj.unit = 'm/z'
+            setattr(self, attr, proj)
     def report(self):
         "report object content"
         print (self.name)
@@ -241,9 +250,13 @@ class MR_interact(MR):
         if new:
             self.top_ax.clear() # clear
             self.diag.display(figure=self.top_ax, title=self.title, scale=self.scale1D.value, label='diagonal')
+            if self.proj2 is not None:
+                self.proj2.display(figure=self.top_ax, scale=self.scale1D.value, label='F2 projection')
             self.top_ax.legend()
             self.side_ax.clear() # clear
             self.side_ax.plot(self.diag.get_buffer(),self.diag.axis1.mass_axis())
+            if self.proj1 is not None:
+                self.side_ax.plot(self.proj1.get_buffer(), self.proj1.axis1.mass_axis())
             self.side_ax.set_xlim(xmax=self.diag.absmax/self.scale1D.value)
         self.spec_ax.clear() # clear 
         datasel.display(zoom=zz, scale=self.scale.value, 
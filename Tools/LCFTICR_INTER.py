@@ -30,6 +30,7 @@ from spike.File import csv
 
 from . import FTICR_INTER as FI
 from . import utilities as U
+from ..sparse_store import load_sparse
 
 from . import parameters as p
 
@@ -94,7 +95,7 @@ class MR(object):
             except tables.NoSuchNodeError:
                 pass
             else:
-                self.data.append(dl)
+                self.data.append(load_sparse(dl))     # reads only the chunks holding data
         # set-up details
         for d in self.data:
             if d.size1 != len(self.min):
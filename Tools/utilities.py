@@ -10,6 +10,7 @@ from functools import partial
 from pprint import pprint
 import numpy as np
 from spike.NPKData import _NPKData as npkd
+from ..noise_estimate import robust_stats
 
 Apodisation = namedtuple('Apodisation', ['name', 'function'])
 
@@ -297,7 +298,7 @@ def process_ms1d(data, parameters, verbose=False):
                 "final size", data.size1)
     audittrail( audit, "phase", "Post processing")
     data.modulus()
-    mu, sigma = data.robust_stats( iterations=10 )
+    mu, sigma = robust_stats(data.get_buffer().real, iterations=10)
     data.noise = sigma
     # Baseline
     if parameters['baseline_todo'] == 'None':
@@ -340,8 +341,8 @@ def peakpick_ms1d(data, parameters):
     test = b[b != 0.0 ]
     if (len(b)-len(test))/len(b) >0.1 : # more than 10% zeroed !
         audittrail( audit, "text","dataset is compressed - noise estimate is approximate")
-        test = test[ (test-test.mean()) < 5*test.std() ]
-        threshold = test.std()*float(parameters['peakpicking_noise_level'])/3
+        mu, sigma = robust_stats(test, tresh=5.0, iterations=1)
+        threshold = sigma*float(parameters['peakpicking_noise_level'])/3
         data.set_unit('m/z').peakpick(threshold=threshold, verbose=False, zoom=parameters['zoom'])
     else:
         data.set_unit('m/z').peakpick(autothresh=float(parameters['peakpicking_noise_level']), verbose=False, zoom=parameters['zoom'])
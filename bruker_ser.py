@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+bruker_ser.py
+
+direct access to the raw 2D FT-ICR data-sets, as stored by Bruker Apex and Solarix spectrometers
+- ser file and acquisition parameters - without importing them first into a msh5 file.
+
+open_ser() returns a FTICRData with the same axes as the spike Import_2D() functions,
+and a buffer mapped on the ser file, read on demand.
+import_2D() is a parallel version of Import_2D(), which creates the msh5 file.
+"""
+
+from __future__ import print_function, division
+import os
+import math
+import time
+import zlib
+import unittest
+import numpy as np
+
+from spike.FTICR import FTICRData
+from spike.File import Apex, Solarix
+from spike.File.HDF5File import HDF5File
+
+FORMATS = {'Apex': Apex, 'Solarix': Solarix}
+
+def read_header(folder, format="Solarix", F1specwidth=None):
+    """
+    reads the acquisition parameters of the 2D data-set in folder, and returns (data, files)
+    data is an empty FTICRData with axes set as Import_2D[format]() does, and params attached,
+    files is the list of the parameter files, which are attached to the msh5 files
+    """
+    importer = FORMATS[format]
+    parfilename = importer.locate_acquisition(folder)
+    params = importer.read_param(parfilename)
+    files = [parfilename]
+    if format == "Solarix":
+        try:
+            scanfile = os.path.join(folder, "scan.xml")
+            sizeF1 = importer.read_scan(scanfile)
+        except FileNotFoundError:
+            scanfile = os.path.join(folder, "ImagingInfo.xml")
+            sizeF1 = importer.read_scan(scanfile)
+    else:
+        scanfile = os.path.join(folder, "scan.xml")
+        sizeF1 = int(params["L_20"])
+    files.append(scanfile)
+    sizeF2 = int(params["TD"])
+    data = FTICRData(dim=2)
+    data.axis2.size = sizeF2
+    data.axis2.specwidth = float(params["SW_h"])
+    if format == "Solarix":
+        try:
+            excite = importer.locate_ExciteSweep(folder)
+        except Exception:
+            excite = None
+        else:
+            files.append(excite)
+        try:
+            data.axis2.lowfreq, data.axis2.highfreq = importer.read_ExciteSweep(excite)
+        except Exception:
+            data.axis2.highfreq = float(params["EXC_Freq_High"])
+            data.axis2.lowfreq = float(params["EXC_Freq_Low"])
+    else:
+        data.axis2.highfreq = float(params["SW_h_Broadband"])
+        data.axis2.lowfreq = float(params["FR_low"])
+    data.axis2.highmass = float(params["MW_high"])
+    data.axis2.left_point = 0
+    data.axis2.offset = 0.0
+    data.axis2.calibA = float(params["ML1"])
+    data.axis2.calibB = float(params["ML2"])
+    data.axis2.calibC = float(params["ML3"])
+    if not math.isclose(data.axis2.calibC, 0.0):
+        print('Using 3 parameters calibration,  Warning calibB is -ML2')
+        data.axis2.calibB *= -1
+    data.axis1.size = sizeF1    # assumes most parameter are equivalent - except specwidth
+    if F1specwidth is not None:
+        data.axis1.specwidth = F1specwidth
+    else:
+        f1 = float(params["IN_26"])     # IN_26 is used in 2D sequence as incremental time
+        if f1 < 1E-4:
+            data.axis1.specwidth = 1.0/(2*f1)
+        else:
+            data.axis1.specwidth = data.axis2.specwidth
+    for key in ("highfreq", "lowfreq", "calibA", "calibB", "calibC"):
+        setattr(data.axis1, key, getattr(data.axis2, key))
+    data.axis1.highmass = float(params["MW_high"])
+    data.axis1.left_point = 0
+    data.axis1.offset = 0.0
+    data.params = params
+    return (data, files)
+
+def apply_opt_param(data, opt_param):
+    """
+    overwrites axes values with the optionnal parameters of the [import] section of the mscf file
+    F1_xxx and F2_xxx go to one axis, other keys to both
+    """
+    for item, value in opt_param.items():
+        if item.startswith('F1_'):
+            setattr(data.axis1, item[3:], value)
+            print("Updating axis F1 %s to %f"%(item[3:], value))
+        elif item.startswith('F2_'):
+            setattr(data.axis2, item[3:], value)
+            print("Updating axis F2 %s to %f"%(item[3:], value))
+        else:
+            setattr(data.axis1, item, value)
+            setattr(data.axis2, item, value)
+            print("Updating all axes %s to %f"%(item, value))
+
+def attach_acquisition(data, hf):
+    "stores the acquisition parameters and parameter files of data (see read_header()) into hf, a HDF5File"
+    hf.store_internal_object(data.params, h5name='params')
+    for f in data.files:
+        hf.store_internal_file(f)
+
+class SerFile(object):
+    """
+    read-only access to the transients of a ser file, mapped in memory, as a 2D array of float
+    only row slices (or a single row) and column slices are supported, as in ser[i0:i1, :]
+    as in Import_2D(), the last transient is not used and reads as zeros, as do transients missing from the file
+    only the file name and shape are pickled, so that worker processes map the file by themselves
+    """
+    ondisk = True
+    dtype = np.dtype(float)
+    ndim = 2
+    def __init__(self, name, shape, byteorder='<'):
+        self.name = name
+        self.shape = tuple(int(i) for i in shape)
+        self.byteorder = byteorder
+        self._map()
+    def _map(self):
+        "maps the complete transients present in the file"
+        self.nvalid = min(self.shape[0]-1, os.path.getsize(self.name)//(4*self.shape[1]))
+        self.map = np.memmap(self.name, dtype=self.byteorder+'i4', mode='r', shape=(self.nvalid, self.shape[1]))
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'byteorder': self.byteorder}
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+    @property
+    def buffer(self):
+        "so that a SerFile can be used as a data-set by worker_open()"
+        return self
+    def __len__(self):
+        return self.shape[0]
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key
+        if not isinstance(rows, slice):
+            return self[int(rows):int(rows)+1, cols][0]
+        i0, i1, step = rows.indices(self.shape[0])
+        ncols = len(range(*cols.indices(self.shape[1])))
+        out = np.zeros((len(range(i0, i1, step)), ncols))
+        last = min(i1, self.nvalid)
+        if last > i0:
+            valid = self.map[i0:last:step, cols]
+            out[:valid.shape[0]] = valid
+        return out
+    def flush(self):
+        "nothing to do, the file is read-only"
+        pass
+    def release(self):
+        "unmaps the file"
+        self.map = None
+
+def open_ser(folder, format="Solarix", opt_param=None):
+    """
+    returns a FTICRData giving access to the raw 2D data-set in folder, without importing it.
+    the buffer is a SerFile, also available as data.shared, so that workers can read it by themselves
+    opt_param, if given, overwrites axes values (see apply_opt_param())
+    data.files is the list of the parameter files
+    """
+    data, files = read_header(folder, format)
+    if opt_param:
+        apply_opt_param(data, opt_param)
+    byteorder = '>' if data.params.get("BYTORDA", "0") == "1" else '<'
+    data.shared = SerFile(os.path.join(folder, "ser"), (data.axis1.size, data.axis2.size), byteorder)
+    data.buffer = data.shared
+    data.files = files
+    return data
+
+def chunk_bytes(block, chunkshape, filters):
+    """
+    cuts block, a 2D array of float aligned on HDF5 chunks, into chunks of shape chunkshape (zero padded at the edges),
+    and encodes them as the HDF5 filters (shuffle and zlib) would do.
+    returns a list of ((i, j), bytes), with (i, j) the offset of each chunk in block
+    """
+    c1, c2 = chunkshape
+    chunks = []
+    for i in range(0, block.shape[0], c1):
+        for j in range(0, block.shape[1], c2):
+            chunk = np.zeros(chunkshape)
+            part = block[i:i+c1, j:j+c2]
+            chunk[:part.shape[0], :part.shape[1]] = part
+            raw = chunk.view(np.uint8)
+            if filters.shuffle:     # byte k of all values, for k = 0..7
+                raw = raw.reshape((-1, chunk.itemsize)).T
+            chunks.append(((i, j), zlib.compress(raw.tobytes(), filters.complevel)))
+    return chunks
+
+def _import_rows(data):
+    """
+    converts the rows i0 to i1 of ser - called by the import workers
+    returns (i0, block) or, if encoding the chunks, (i0, list of chunks) (see chunk_bytes())
+    """
+    ser, i0, i1, chunkshape, filters = data
+    block = ser[i0:i1, :]
+    if filters is None:
+        return (i0, block)
+    return (i0, chunk_bytes(block, chunkshape, filters))
+
+def import_2D(folder, outfile, format="Solarix", opt_param=None, compress=False, imap=map, blockmem=64*1024*1024):
+    """
+    imports the 2D data-set in folder into the msh5 file outfile, and returns it as a FTICRData, as Import_2D[format]() does
+    opt_param, if given, overwrites axes values (see apply_opt_param()) before the file is created
+    the ser file is converted by ranges of rows aligned on the HDF5 chunks, dispatched through imap (a parallel map)
+    if compress, the chunks are compressed by the workers, and written as such in the file
+    """
+    t0 = time.time()
+    data = open_ser(folder, format, opt_param)
+    ser = data.shared
+    hf = HDF5File(outfile, "w")
+    hf.set_compression(compress)
+    hf.create_from_template(data)       # data.buffer is now the HDF5 dataset
+    attach_acquisition(data, hf)
+    node = data.buffer
+    filters = node.filters
+    if filters.complevel == 0 or filters.complib != 'zlib' or filters.bitshuffle or filters.fletcher32:
+        filters = None                  # HDF5 writes the data
+    c1, c2 = node.chunkshape
+    nrows = c1*max(1, blockmem//(8*c1*ser.shape[1]))
+    xarg = ((ser, i0, min(i0+nrows, ser.shape[0]), node.chunkshape, filters) for i0 in range(0, ser.shape[0], nrows))
+    for i0, res in imap(_import_rows, xarg):
+        if filters is None:
+            node[i0:i0+res.shape[0], :] = res
+        else:
+            for (i, j), chunk in res:
+                node.write_chunk((i0+i, j), chunk)
+    hf.flush()
+    ser.release()
+    del data.shared
+    data.hdf5file = hf
+    print("%s imported into %s in %.1f sec"%(folder, outfile, time.time()-t0))
+    return data
+
+class Test(unittest.TestCase):
+    """tests """
+    def test_serfile(self):
+        "testing reading a ser file by slices"
+        import tempfile, pickle
+        fname = os.path.join(tempfile.gettempdir(), 'test_bruker.ser')
+        ref = np.arange(5*8, dtype='<i4').reshape((5, 8))
+        ref[:3].tofile(fname)      # a truncated file
+        ser = SerFile(fname, (5, 8))
+        self.assertTrue(np.all(ser[1:3, :] == ref[1:3]))
+        self.assertTrue(np.all(ser[2, 3:6] == ref[2, 3:6]))
+        self.assertTrue(np.all(ser[2:5, :][1:] == 0.0))     # the last transient is not used, missing ones are zeros
+        other = pickle.loads(pickle.dumps(ser))
+        self.assertTrue(np.all(other[0:2, :] == ref[0:2]))
+        other.release()
+        ser.release()
+        os.unlink(fname)
+    def test_chunk_bytes(self):
+        "testing that chunks encoded by the workers are read back by HDF5"
+        import tempfile, tables
+        fname = os.path.join(tempfile.gettempdir(), 'test_chunks.h5')
+        ref = np.random.randn(20, 30)
+        for shuffle in (True, False):
+            with tables.open_file(fname, "w") as h:
+                filters = tables.Filters(complevel=1, complib='zlib', shuffle=shuffle)
+                node = h.create_carray("/", "data", tables.Float64Atom(), ref.shape, chunkshape=(6, 8), filters=filters)
+                for (i, j), chunk in chunk_bytes(ref, node.chunkshape, node.filters):
+                    node.write_chunk((i, j), chunk)
+            with tables.open_file(fname, "r") as h:
+                self.assertTrue(np.all(h.root.data[:] == ref))
+        os.unlink(fname)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+executor.py
+
+the parallel execution layer shared by the 2D processing (processing_4EU.py) and the LC-MS import (ImportLCmp.py)
+
+an Executor applies a function to each element of an iterable, using one of BACKENDS:
+    'serial'    : in the current process
+    'threads'   : a pool of threads - no pickling, efficient as long as the work releases the GIL (numpy FFT, copies...)
+    'processes' : a pool of processes, with python multiprocessing
+    'mpi'       : the MPI slaves, when the program is launched with mpirun (see spike.util.mpiutil)
+
+the number of threads used by the BLAS and OpenMP libraries is limited in the workers (see limit_blas_threads())
+so that nworkers workers do not oversubscribe the machine.
+
+pipeline() overlaps the reading of the input, the computation and the storage of the results,
+with a reader thread and a writer thread connected to the computation by bounded queues.
+"""
+
+from __future__ import print_function, division
+import os
+import time
+import ctypes
+import queue
+import threading
+import unittest
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+from spike.util import mpiutil
+
+BACKENDS = ('serial', 'threads', 'processes', 'mpi')
+BLAS_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def limit_blas_threads(n):
+    """
+    limits to n the threads used by the BLAS and OpenMP libraries of the current process
+    uses threadpoolctl when available, otherwise the MKL and OpenBLAS entry points, if these libraries are present
+    the environment variables are also set, for the processes started afterwards
+    """
+    for var in BLAS_ENV:
+        os.environ[var] = str(n)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        for lib, func in (('libmkl_rt.so', 'MKL_Set_Num_Threads'), ('libopenblas.so', 'openblas_set_num_threads')):
+            try:
+                getattr(ctypes.CDLL(lib), func)(n)
+            except (OSError, AttributeError):
+                pass
+    else:
+        threadpool_limits(n)
+
+def _init_worker(blas_threads, initializer, initargs):
+    "initializer of the worker processes"
+    if blas_threads is not None:
+        limit_blas_threads(blas_threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+class _Initialized(object):
+    """
+    wraps func so that initializer(*initargs) is called before the first call in each MPI slave
+    (the function is sent only once to each slave)
+    """
+    def __init__(self, func, initializer, initargs):
+        self.func = func
+        self.initializer = initializer
+        self.initargs = initargs
+        self.done = False
+    def __call__(self, data):
+        if not self.done:
+            self.initializer(*self.initargs)
+            self.done = True
+        return self.func(data)
+
+def _bounded(pool_map, func, xarg, inflight):
+    """
+    yields the results of pool_map(func, xarg) - the imap() or imap_unordered() of a pool -
+    while feeding the pool with at most inflight elements of xarg not yet returned,
+    as the pools would otherwise read xarg to the end at once
+    """
+    slots = threading.BoundedSemaphore(inflight)
+    done = threading.Event()
+    def feed():
+        for x in xarg:
+            while not slots.acquire(timeout=0.1):
+                if done.is_set():
+                    return
+            if done.is_set():
+                return
+            yield x
+    try:
+        for r in pool_map(func, feed()):
+            slots.release()
+            yield r
+    finally:
+        done.set()      # so that the pool stops reading xarg if the results are abandoned
+
+def default_backend(mp=False):
+    "the backend used when none is given : mpi if launched with mpirun, processes if mp is True, serial otherwise"
+    if mpiutil.MPI_size > 1:
+        return 'mpi'
+    if mp:
+        return 'processes'
+    return 'serial'
+
+class Executor(object):
+    """
+    applies functions to the elements of iterables, on one of BACKENDS, with nworkers workers
+    blas_threads is the number of BLAS threads allowed in each worker, None leaves it untouched
+    (in 'threads' mode, the limit applies to the whole process)
+    the pool of workers is created at once - so better early, while memory is still empty - and released by close()
+    with processes, imap_unordered() with an initializer replaces it by a pool of initialized workers, kept for the next calls
+    at most inflight elements of the iterables are handed to the workers and not yet returned, so that memory remains bounded
+    """
+    def __init__(self, backend='serial', nworkers=1, blas_threads=1):
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend %s, should be one of %s"%(backend, ", ".join(BACKENDS)))
+        self.backend = backend
+        self.blas_threads = blas_threads
+        self.pool = None
+        self.initialized = None     # the (initializer, initargs) of the current pool of processes, see imap_unordered()
+        if backend == 'mpi':
+            if mpiutil.MPI_size < 2:
+                raise ValueError("the mpi backend requires the program to be launched with mpirun")
+            nworkers = mpiutil.MPI_size-1
+        elif backend == 'serial':
+            nworkers = 1
+        self.nworkers = nworkers
+        self.inflight = 2*nworkers
+        if backend == 'processes':
+            self.pool = mp.Pool(nworkers, initializer=_init_worker, initargs=(blas_threads, None, ()))
+        elif backend == 'threads':
+            if blas_threads is not None:
+                limit_blas_threads(blas_threads)
+            self.pool = ThreadPool(nworkers)
+    def __repr__(self):
+        return "Executor(%s, %d worker%s)"%(self.backend, self.nworkers, "s" if self.nworkers > 1 else "")
+    @property
+    def parallel(self):
+        "True if the work is distributed"
+        return self.backend != 'serial'
+    @property
+    def remote(self):
+        "True if the workers are in other processes - arguments and results are then pickled"
+        return self.backend in ('processes', 'mpi')
+    def imap(self, func, xarg):
+        "same as map(func, xarg), results come in order"
+        if self.pool is not None:
+            return _bounded(self.pool.imap, func, xarg, self.inflight)
+        if self.backend == 'mpi':
+            return self._ordered(mpiutil.enum_imap(func, xarg))
+        return map(func, xarg)
+    def _ordered(self, res):
+        "puts back in order the (i, result) pairs of res"
+        pending = {}
+        nxt = 0
+        for i, r in res:
+            pending[i] = r
+            while nxt in pending:
+                yield pending.pop(nxt)
+                nxt += 1
+    def enum_imap(self, func, xarg):
+        "yields (i, func(xarg[i])) pairs, in any order"
+        if self.backend == 'mpi':
+            return mpiutil.enum_imap(func, xarg)
+        return enumerate(self.imap(func, xarg))
+    def imap_unordered(self, func, xarg, initializer=None, initargs=()):
+        """
+        yields func(x) for each x of xarg, in any order
+        if initializer is given, initializer(*initargs) is called once in each worker before the first call to func
+        """
+        if self.backend == 'processes' and initializer is not None:
+            self._initialize(initializer, initargs)
+        elif self.backend == 'mpi':
+            if initializer is not None:
+                func = _Initialized(func, initializer, initargs)
+            for i, r in mpiutil.enum_imap(func, xarg):
+                yield r
+            return
+        elif initializer is not None:     # threads share the state of the main process
+            initializer(*initargs)
+        if self.pool is not None:
+            res = _bounded(self.pool.imap_unordered, func, xarg, self.inflight)
+        else:
+            res = map(func, xarg)
+        for r in res:
+            yield r
+    def _initialize(self, initializer, initargs):
+        """
+        makes sure initializer(*initargs) was called in each worker process
+        the pool is replaced by an initialized one if needed, so that there is never more than one pool of nworkers
+        """
+        if self.initialized is not None:
+            init, args = self.initialized
+            if init is initializer and len(args) == len(initargs) and all(a is b for a, b in zip(args, initargs)):
+                return
+        self.close()
+        self.pool = mp.Pool(self.nworkers, initializer=_init_worker, initargs=(self.blas_threads, initializer, initargs))
+        self.initialized = (initializer, initargs)
+    def close(self):
+        "releases the workers"
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.initialized = None
+
+class PipelineStats(object):
+    """
+    the waiting times (in sec.) and the queue depths of the stages of a pipeline() run
+    wait['reader'] : the reader waiting on a full input queue
+    wait['input'], wait['output'] : the computation waiting for input, or on a full output queue
+    wait['writer'] : the writer waiting for results
+    the stage which limits the pipeline is the one the others wait for the most
+    """
+    def __init__(self, name, depth=0):
+        self.name = name
+        self.depth = depth
+        self.items = 0
+        self.wait = {'reader': 0.0, 'input': 0.0, 'output': 0.0, 'writer': 0.0}
+        self.queues = {'input': [0, 0, 0], 'output': [0, 0, 0]}     # number of samples, sum and max of the depths
+    def sample(self, name, depth):
+        "records the depth of the queue name"
+        q = self.queues[name]
+        q[0] += 1
+        q[1] += depth
+        q[2] = max(q[2], depth)
+    def mean_depth(self, name):
+        "mean depth of the queue name"
+        q = self.queues[name]
+        return q[1]/max(1, q[0])
+    @property
+    def limit(self):
+        "the stage which limits the pipeline"
+        waited = {'reader': self.wait['input'], 'compute': self.wait['reader']+self.wait['writer'], 'writer': self.wait['output']}
+        return max(waited, key=waited.get)
+    def report(self):
+        "prints the statistics"
+        if self.depth <= 0:
+            return
+        print("%s pipeline: %d items, queues of %d - mean (max) depth input %.1f (%d) output %.1f (%d)"%(self.name, self.items, self.depth,
+            self.mean_depth('input'), self.queues['input'][2], self.mean_depth('output'), self.queues['output'][2]))
+        print("   waiting times: reader %.1f sec, compute %.1f sec for input and %.1f sec for the writer, writer %.1f sec - the %s limits the pipeline"%(
+            self.wait['reader'], self.wait['input'], self.wait['output'], self.wait['writer'], self.limit))
+
+_DONE = object()    # marks the end of a queue
+
+class PipelineAborted(Exception):
+    """
+    raised by pipeline() to the consumer when the reading or the computation failed,
+    so that it does not mistake the end of the results for a normal end (e.g. storing incomplete blocks as done)
+    """
+    pass
+
+class _NoLock(object):
+    "a lock which does nothing"
+    def acquire(self):
+        pass
+    def release(self):
+        pass
+    def __enter__(self):
+        pass
+    def __exit__(self, *args):
+        pass
+
+def pipeline(compute, xarg, consumer, depth=4, lock=None, name="processing", inflight=None):
+    """
+    returns consumer(compute(xarg)), run as 3 concurrent stages:
+        a reader thread iterates over xarg, and fills a prefetch queue of depth elements
+        compute() - typically the imap() of an Executor - is fed from that queue by the calling thread
+        a writer thread runs consumer() over the results, received through a queue of depth elements
+    if lock is given, it is held while reading each element of xarg, and while consumer handles each result
+        (e.g. for HDF5, which does not support concurrent accesses) - otherwise reading and writing are independent
+    if inflight is given, compute() - which must then return one result per element - is handed at most inflight elements
+        not yet returned (e.g. depth + the Executor inflight), so that the reader does not run ahead of the results
+    if the reading or the computation fails, the results given to consumer end by raising PipelineAborted,
+        and the original exception is raised
+    returns (the value returned by consumer, a PipelineStats)
+    if depth is 0, the stages are run sequentially, as consumer(compute(xarg))
+    """
+    stats = PipelineStats(name, depth)
+    if depth <= 0:
+        return (consumer(compute(xarg)), stats)
+    if lock is None:
+        lock = _NoLock()
+    inq = queue.Queue(depth)
+    outq = queue.Queue(depth)
+    slots = threading.BoundedSemaphore(inflight) if inflight else None      # elements handed to compute() and not returned
+    stop = threading.Event()        # set when a stage ends early
+    aborted = threading.Event()     # set when the reading or the computation failed
+    failed = []                     # exceptions raised in the threads
+    value = []
+    def put(q, item, key):
+        "puts item into q, returns False if the pipeline is stopped"
+        t0 = time.time()
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if stop.is_set():
+                    return False
+        stats.wait[key] += time.time()-t0
+        return True
+    def get(q, key):
+        "gets the next item of q, _DONE if the pipeline is stopped"
+        t0 = time.time()
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if stop.is_set():
+                    return _DONE
+        stats.wait[key] += time.time()-t0
+        return item
+    def read():
+        try:
+            it = iter(xarg)
+            while True:
+                with lock:
+                    x = next(it, _DONE)
+                if not put(inq, x, 'reader') or x is _DONE:
+                    break
+        except BaseException as e:
+            failed.append(e)
+            aborted.set()
+            put(inq, _DONE, 'reader')
+    def feed():
+        while True:
+            stats.sample('input', inq.qsize())
+            x = get(inq, 'input')
+            if x is _DONE:
+                return
+            if slots is not None:       # waits for the computation, not counted in the stats
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+            yield x
+    def results():
+        held = False
+        try:
+            while True:
+                if held:
+                    lock.release()
+                    held = False
+                r = get(outq, 'writer')
+                if r is _DONE:
+                    if aborted.is_set():
+                        raise PipelineAborted("%s interrupted"%name)
+                    return
+                lock.acquire()
+                held = True
+                yield r
+        finally:
+            if held:
+                lock.release()
+    def write():
+        res = results()
+        try:
+            value.append(consumer(res))
+        except BaseException as e:
+            failed.append(e)
+        finally:
+            res.close()     # releases the lock
+            stop.set()
+    reader = threading.Thread(target=read, name=name+"-reader", daemon=True)
+    writer = threading.Thread(target=write, name=name+"-writer", daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        for r in compute(feed()):
+            if slots is not None:
+                slots.release()
+            stats.items += 1
+            stats.sample('output', outq.qsize())
+            if not put(outq, r, 'output'):
+                break
+        put(outq, _DONE, 'output')
+    except BaseException:
+        aborted.set()
+        stop.set()
+        raise
+    finally:
+        reader.join()
+        writer.join()
+    if failed:
+        raise failed[0]
+    return (value[0], stats)
+
+_state = []
+def _square(x):
+    return x*x + sum(_state)
+
+def _slow(x):
+    time.sleep(0.002)
+    return x
+
+class Test(unittest.TestCase):
+    """tests """
+    def test_backends(self):
+        "testing that all local backends give the same results"
+        for backend in ('serial', 'threads', 'processes'):
+            ex = Executor(backend, 2)
+            self.assertEqual(list(ex.imap(_square, range(10))), [i*i for i in range(10)])
+            self.assertEqual(sorted(ex.enum_imap(_square, range(5))), [(i, i*i) for i in range(5)])
+            res = ex.imap_unordered(_square, range(10), initializer=_state.append, initargs=(1,))
+            self.assertEqual(sorted(res), [i*i+1 for i in range(10)])
+            if backend == 'processes':      # the initialized pool replaced the first one, and is kept
+                self.assertEqual(len(mp.active_children()), 2)
+                self.assertEqual(list(ex.imap(_square, range(3))), [i*i+1 for i in range(3)])
+            del _state[:]
+            ex.close()
+    def test_pipeline(self):
+        "testing the pipeline, and that errors are propagated"
+        ex = Executor('threads', 2)
+        for depth in (0, 1, 4):
+            res, stats = pipeline(lambda xs: ex.imap(_square, xs), range(50), list, depth)
+            self.assertEqual(res, [i*i for i in range(50)])
+        self.assertEqual(stats.items, 50)
+        def consumer(res):
+            for r in res:
+                if r > 10:
+                    raise ValueError("stop")
+        with self.assertRaises(ValueError):
+            pipeline(lambda xs: ex.imap(_square, xs), range(50), consumer, 2)
+        def reader():
+            yield 1
+            raise KeyError("bad input")
+        with self.assertRaises(KeyError):
+            pipeline(lambda xs: ex.imap(_square, xs), reader(), list, 2)
+        def failing(xs):
+            for x in xs:
+                if x == 20:
+                    raise KeyboardInterrupt
+                yield x
+        flushed = []
+        def store(res):
+            for r in res:
+                pass
+            flushed.append(True)      # as ColumnWriter.flush(), must not be reached
+        for source in (range(50), reader()):
+            with self.assertRaises((KeyboardInterrupt, KeyError)):
+                pipeline(failing, source, store, 2)
+        self.assertEqual(flushed, [])
+        read = []
+        def xarg():
+            for i in range(200):
+                read.append(i)
+                yield i
+        def ahead(res):
+            return max(len(read)-n for n, r in enumerate(res))
+        for inflight in (None, 2+ex.inflight):
+            del read[:]
+            res, stats = pipeline(lambda xs: ex.imap_unordered(_slow, xs), xarg(), ahead, 2, inflight=inflight)
+            self.assertTrue(res <= 2+ex.inflight + 2 + 3)     # compute, the 2 queues, and the elements being passed
+        ex.close()
+    def test_bounded(self):
+        "testing that the input is not read much ahead of the results, on all local backends"
+        for backend in ('serial', 'threads', 'processes'):
+            ex = Executor(backend, 2)
+            read = []
+            def xarg():
+                for i in range(200):
+                    read.append(i)
+                    yield i
+            def consumer(res):
+                ahead = 0
+                for n, r in enumerate(res):
+                    ahead = max(ahead, len(read)-n)
+                return ahead
+            for imap in (ex.imap, ex.imap_unordered):
+                del read[:]
+                self.assertTrue(consumer(imap(_slow, xarg())) <= ex.inflight+1)
+                self.assertEqual(len(read), 200)
+            ex.close()
+    def test_ordered(self):
+        "testing the reordering of MPI results"
+        ex = Executor()
+        self.assertEqual(list(ex._ordered([(2,'c'), (0,'a'), (1,'b')])), ['a', 'b', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fft_tuner.py
+
+choice of the size of the processed data-sets from measured FFT speeds.
+
+intelliround() picks the closest "round" size, assuming that powers of 2 are always the fastest,
+best_size() times the real FFT of all candidate sizes within a tolerance of the target on the current machine
+and picks the fastest one.
+Timings are measured once and stored per host in ~/.eufticr/
+
+candidates are p*2^n, with p a small odd product of 3 and 5 (see ODD_FACTORS) and n >= MINPOW2
+so that sizes can be divided by 4 several times, as required by the downsampled levels.
+"""
+
+from __future__ import print_function, division
+import os
+import json
+import socket
+import time
+import unittest
+import numpy as np
+try:
+    from scipy import fft as spfft
+except ImportError:     # scipy < 1.4
+    spfft = None
+
+ODD_FACTORS = (1, 3, 5, 9, 15, 25, 27, 45, 75, 81)
+MINPOW2 = 4
+CACHEDIR = os.path.join(os.path.expanduser("~"), ".eufticr")
+
+def candidates(x, tolerance):
+    "the list of candidate sizes within x*(1-tolerance) and x*(1+tolerance), in increasing order"
+    low, high = x*(1.0-tolerance), x*(1.0+tolerance)
+    r = []
+    for p in ODD_FACTORS:
+        s = p*2**MINPOW2
+        while s <= high:
+            if s >= low:
+                r.append(s)
+            s *= 2
+    return sorted(r)
+
+def time_rfft(size, dtype=float, repeat=5, pointmem=1024*1024):
+    "the time of the real FFT of size points, in sec. - best of repeat, measured on about pointmem points"
+    lib = np.fft if spfft is None else spfft
+    nrows = max(1, pointmem//size)
+    x = np.random.randn(nrows, size).astype(dtype)
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        lib.rfft(x, axis=1)
+        t = (time.time()-t0)/nrows
+        if best is None or t < best:
+            best = t
+    return best
+
+class FFTTuner(object):
+    """
+    measures and remembers the FFT speed of sizes, for a given data type
+    timings are kept in cachefile, a json file, by default ~/.eufticr/fft_sizes_HOSTNAME.json
+    """
+    def __init__(self, dtype=float, cachefile=None):
+        self.dtype = np.dtype(dtype).name
+        if cachefile is None:
+            cachefile = os.path.join(CACHEDIR, "fft_sizes_%s.json"%socket.gethostname())
+        self.cachefile = cachefile
+        self.timings = {}
+        try:
+            with open(cachefile) as F:
+                self.timings = json.load(F)
+        except (IOError, ValueError):
+            pass
+        self.timings.setdefault(self.dtype, {})
+        self.modified = False
+    def timing(self, size):
+        "the time of the FFT of size points, measured on the first call, read from the cache afterwards"
+        t = self.timings[self.dtype].get(str(size))
+        if t is None:
+            t = time_rfft(size, self.dtype)
+            self.timings[self.dtype][str(size)] = t
+            self.modified = True
+        return t
+    def save(self):
+        "stores the timings in cachefile"
+        try:
+            os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+            with open(self.cachefile, "w") as F:
+                json.dump(self.timings, F, indent=1, sort_keys=True)
+        except (IOError, OSError) as e:
+            print("Warning, FFT timings could not be stored in %s : %s"%(self.cachefile, e))
+    def best_size(self, x, tolerance):
+        """
+        returns the fastest size within a tolerance of x (0.1 is 10%), as measured on this machine
+        the chosen and rejected sizes are logged
+        if no candidate is found, the tolerance is enlarged until there is one
+        """
+        cand = candidates(x, tolerance)
+        while not cand:
+            tolerance = 2*tolerance + 0.01
+            cand = candidates(x, tolerance)
+        self.modified = False
+        timed = [(self.timing(s), s) for s in cand]
+        if self.modified:
+            self.save()
+        t, best = min(timed)
+        rejected = ", ".join("%d (%.1f%%)"%(s, 100*(ts-t)/t) for ts, s in timed if s != best)
+        print("FFT size for %.0f points: %d chosen (%.3g ms/FFT), rejected: %s"%(x, best, 1000*t, rejected or "none"))
+        return best
+
+class Test(unittest.TestCase):
+    """tests """
+    def test_candidates(self):
+        "testing the candidate sizes"
+        cand = candidates(1000, 0.1)
+        self.assertEqual(cand, [960, 1024])
+        for s in candidates(100000, 0.2):
+            self.assertTrue(80000 <= s <= 120000)
+            self.assertEqual(s%(2**MINPOW2), 0)
+    def test_tuner(self):
+        "testing best_size() with stored timings"
+        import tempfile
+        fname = os.path.join(tempfile.gettempdir(), 'test_fft_sizes.json')
+        with open(fname, "w") as F:
+            json.dump({'float64': {'960': 1.0, '1024': 2.0}}, F)
+        tuner = FFTTuner(cachefile=fname)
+        self.assertEqual(tuner.best_size(1000, 0.1), 960)     # from the file
+        self.assertEqual(tuner.best_size(1000, 0.0), 1024)    # tolerance enlarged
+        best = tuner.best_size(3000, 0.05)      # measured and stored
+        self.assertTrue(best in candidates(3000, 0.05))
+        self.assertTrue(str(best) in FFTTuner(cachefile=fname).timings['float64'])
+        os.unlink(fname)
+
+if __name__ == '__main__':
+    unittest.main()
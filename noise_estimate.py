@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+noise_estimate.py
+
+robust estimation of the noise level of spectra, used for baseline (ridge) removal and compression thresholds
+
+the estimate is the (mean, std) of the data once the peaks have been excluded.
+3 methods are available:
+    'legacy'   : the original code, iterated sigma clipping, which builds a filtered copy of the data at each pass
+    'clip'     : same sigma clipping, done with a mask and without copies - stops as soon as the mask is stable
+                 this is the default, results are the same as 'legacy' up to rounding errors
+    'quantile' : O(n) estimate - median and inter-quantile width (found with np.partition)
+                 followed by a single clipping pass - faster but slightly different from the 2 others
+
+all methods can work on a whole block of data at once, computing one estimate per column or row (see axis)
+"""
+
+from __future__ import print_function, division
+import unittest
+import numpy as np
+
+METHODS = ('legacy', 'clip', 'quantile')
+DEFAULT = 'clip'
+
+def robust_stats(data, tresh=3.0, iterations=10, axis=None, method=None):
+    """
+    returns (mean, std) of data, while excluding most outliers, defined as larger than (tresh*std+mean)
+
+    data is a numpy array,
+    if axis is None, the estimate is computed over the whole array, and mean and std are scalars
+    if axis is given, one estimate is computed along axis for each 1D slice of data (e.g. axis=0 for each column of a 2D)
+        mean and std are then 1D arrays
+    method is one of METHODS, DEFAULT is used if None
+    """
+    if method is None:
+        method = DEFAULT
+    if method not in METHODS:
+        raise ValueError("unknown noise estimate method %s, should be one of %s"%(method, METHODS))
+    data = np.asarray(data)
+    if axis is None:
+        data = data.ravel()
+        axis = 0
+    if data.ndim == 1:
+        mean, std = _robust_stats(data[:,None], tresh, iterations, method)
+        return (mean[0], std[0])
+    # work on columns of a 2D
+    x = np.moveaxis(data, axis, 0)
+    shape = x.shape[1:]
+    x = x.reshape((x.shape[0], -1))
+    mean, std = _robust_stats(x, tresh, iterations, method)
+    return (mean.reshape(shape), std.reshape(shape))
+
+def _robust_stats(x, tresh, iterations, method):
+    "robust_stats() on each column of the 2D array x"
+    if method == 'legacy':
+        mean = np.empty(x.shape[1])
+        std = np.empty(x.shape[1])
+        for k in range(x.shape[1]):
+            b = x[:,k].copy()
+            for i in range(iterations):
+                b = b[ b-b.mean()<tresh*b.std() ]
+            mean[k], std[k] = b.mean(), b.std()
+        return (mean, std)
+    mask = np.ones(x.shape, dtype=bool)
+    tmp = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float32))     # float32 data is processed in float32
+    if method == 'quantile':
+        q = np.partition(x, (x.shape[0]//6, x.shape[0]//2, (5*x.shape[0])//6), axis=0)
+        median = q[x.shape[0]//2]
+        sigma = 0.5*(q[(5*x.shape[0])//6] - q[x.shape[0]//6])   # +/- 1 sigma quantiles of a gaussian
+        np.subtract(x, median, out=tmp)
+        np.less(tmp, tresh*sigma, out=mask)
+        return _masked_stats(x, mask, tmp)
+    count = x.shape[0]*np.ones(x.shape[1], dtype=int)
+    mean, std = _masked_stats(x, mask, tmp)
+    for i in range(iterations):
+        np.subtract(x, mean, out=tmp)
+        mask &= (tmp < tresh*std)
+        n = mask.sum(axis=0)
+        if np.all(n == count):      # masks are nested, so unchanged counts mean converged
+            break
+        count = n
+        mean, std = _masked_stats(x, mask, tmp)
+    return (mean, std)
+
+def _masked_stats(x, mask, tmp):
+    "mean and std of each column of x, restricted to mask - tmp is a work buffer of the shape of x"
+    n = np.maximum(1, mask.sum(axis=0))
+    np.multiply(x, mask, out=tmp)
+    mean = tmp.sum(axis=0)/n
+    np.subtract(x, mean, out=tmp)
+    tmp *= tmp
+    tmp *= mask
+    std = np.sqrt(tmp.sum(axis=0)/n)
+    return (mean, std)
+
+class Test(unittest.TestCase):
+    """tests """
+    def test_methods(self):
+        "testing that all methods agree on gaussian noise with peaks"
+        x = np.random.randn(10000, 4) + 10.0
+        x[::100] += 1000.0      # peaks
+        ref = robust_stats(x, axis=0, method='legacy')
+        for method in ('clip', 'quantile'):
+            mean, std = robust_stats(x, axis=0, method=method)
+            self.assertTrue(np.allclose(mean, ref[0], rtol=0.01))
+            self.assertTrue(np.allclose(std, ref[1], rtol=0.05))
+        mean, std = robust_stats(x, axis=0, method='clip')
+        self.assertTrue(np.allclose(mean, ref[0], rtol=1E-12))
+        self.assertTrue(np.allclose(std, ref[1], rtol=1E-12))
+    def test_batch(self):
+        "testing that the batched form gives the same values as the 1D one"
+        x = np.random.randn(500, 3)**2
+        mean, std = robust_stats(x.T, axis=1)
+        for k in range(3):
+            m, s = robust_stats(x[:,k])
+            self.assertAlmostEqual(m, mean[k])
+            self.assertAlmostEqual(s, std[k])
+
+if __name__ == '__main__':
+    unittest.main()
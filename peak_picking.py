@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+peak_picking.py
+
+tiled peak picking of the processed 2D data-sets.
+
+the 2D is split into tiles (see tiles()), which are processed independently, and in parallel by processing_4EU.
+each tile is read with a margin of one point on each side, so that the peaks found in a tile core are exactly
+the ones found on the whole 2D : a peak is a point larger than its threshold and than its 4 neighbours,
+as in spike.plugins.Peaks.peaks2d() - the outermost rows and columns are not searched.
+the tile cores do not overlap, so that a peak found on a tile border is reported once only,
+merge_peaks() then builds a single table, sorted by decreasing intensity.
+
+the threshold is given for each column - processing_4EU uses the noise levels measured during F1.
+the centroid fits a parabola on the summit and its 2 neighbours along each axis,
+the center() model of spike.plugins.Peaks, solved in closed form.
+
+the table of peaks is stored in the msh5 file as the HDF5 table /peaks (see store_peaks())
+"""
+
+from __future__ import print_function, division
+import unittest
+import numpy as np
+import tables
+
+PEAK_DTYPE = np.dtype([('posF1', np.float64), ('posF2', np.float64),      # in index
+                       ('intens', np.float64),
+                       ('widthF1', np.float32), ('widthF2', np.float32)])  # full width at half maximum, in index
+PEAKS = 'peaks'     # name of the table in the msh5 files
+
+def tiles(size1, size2, tile1, tile2):
+    "yields the (i0, i1, j0, j1) cores of the tiles of size tile1 x tile2 covering a size1 x size2 2D, borders excluded"
+    for i0 in range(1, size1-1, tile1):
+        for j0 in range(1, size2-1, tile2):
+            yield (i0, min(i0+tile1, size1-1), j0, min(j0+tile2, size2-1))
+
+def _parabola(a, b, c):
+    "the summit (offset, height) and the width of the parabola through (-1, a) (0, b) (1, c) - b is the largest"
+    A = 0.5*(a+c) - b
+    B = 0.5*(c-a)
+    off = -B/(2*A)
+    height = b - B*B/(4*A)
+    return off, height, np.sqrt(2.0*height/(-A))     # FWHM of center() is sqrt(2) x width
+
+def pick_tile(data, threshold, centroid=True, offset=(0, 0)):
+    """
+    peak picking of a tile : data holds the tile core, with one point of margin on each side,
+    threshold is the array of the thresholds of the columns of data,
+    offset is the position of data[0,0] in the 2D
+    returns the peaks of the core, as an array of PEAK_DTYPE, with positions in the 2D
+    """
+    core = data[1:-1, 1:-1]
+    mask = ((core > threshold[1:-1]) &
+            (core > data[:-2, 1:-1]) & (core > data[2:, 1:-1]) &
+            (core > data[1:-1, :-2]) & (core > data[1:-1, 2:]))
+    i, j = np.nonzero(mask)
+    i += 1
+    j += 1
+    peaks = np.zeros(len(i), dtype=PEAK_DTYPE)
+    peaks['intens'] = data[i, j]
+    peaks['posF1'] = i + offset[0]
+    peaks['posF2'] = j + offset[1]
+    if centroid and len(i) > 0:
+        off1, h1, w1 = _parabola(data[i-1, j], data[i, j], data[i+1, j])
+        off2, h2, w2 = _parabola(data[i, j-1], data[i, j], data[i, j+1])
+        peaks['posF1'] += off1
+        peaks['posF2'] += off2
+        peaks['intens'] += (h1 - data[i, j]) + (h2 - data[i, j])
+        peaks['widthF1'] = w1
+        peaks['widthF2'] = w2
+    return peaks
+
+def merge_peaks(tile_peaks):
+    "merges tile_peaks, the tables of peaks of the tiles, into one table, sorted by decreasing intensity"
+    if not tile_peaks:
+        return np.zeros(0, dtype=PEAK_DTYPE)
+    peaks = np.concatenate(tile_peaks)
+    return peaks[np.argsort(-peaks['intens'], kind='stable')]
+
+def store_peaks(hf, peaks, data, threshold=None):
+    """
+    stores peaks in hf, a HDF5File, as the table PEAKS, with the m/z coordinates computed from the axes of data
+    threshold, the noise level ratio used, is kept as an attribute
+    """
+    if PEAKS in hf.hf.root:     # left by a previous run
+        hf.hf.remove_node('/'+PEAKS)
+    desc = np.dtype(PEAK_DTYPE.descr + [('mzF1', np.float64), ('mzF2', np.float64)])
+    table = hf.hf.create_table(hf.hf.root, PEAKS, description=desc, title="2D peak list",
+        filters=tables.Filters(complevel=1, complib='zlib'), expectedrows=max(1, len(peaks)))
+    rows = np.zeros(len(peaks), dtype=desc)
+    for name in PEAK_DTYPE.names:
+        rows[name] = peaks[name]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rows['mzF1'] = data.axis1.itomz(peaks['posF1'])
+        rows['mzF2'] = data.axis2.itomz(peaks['posF2'])
+    table.append(rows)
+    if threshold is not None:
+        table.attrs.noise_level = threshold
+    table.flush()
+
+class Test(unittest.TestCase):
+    """tests """
+    def test_tiles(self):
+        "testing that tiled peak picking gives the same peaks as the whole 2D, once"
+        np.random.seed(123)
+        data = np.random.rand(100, 130)
+        data[40, 49:52] = [5, 10, 5]      # a peak on a tile border
+        data[39:42, 50] = [6, 10, 4]
+        threshold = np.full(130, 0.9)
+        ref = merge_peaks([pick_tile(data, threshold)])
+        self.assertTrue(len(ref) > 50)
+        self.assertTrue(np.all(ref['intens'][:-1] >= ref['intens'][1:]))
+        top = ref[0]
+        self.assertAlmostEqual(top['posF2'], 50.0)
+        self.assertTrue(top['posF1'] < 40.0 and top['posF1'] > 39.8)   # shifted toward the larger neighbour
+        self.assertTrue(top['intens'] > 10.0)
+        found = []
+        for (i0, i1, j0, j1) in tiles(100, 130, 40, 50):
+            found.append(pick_tile(data[i0-1:i1+1, j0-1:j1+1], threshold[j0-1:j1+1], offset=(i0-1, j0-1)))
+        peaks = merge_peaks(found)
+        self.assertEqual(sorted(peaks.tolist()), sorted(ref.tolist()))
+    def test_parabola(self):
+        "testing the centroid on a sampled parabola"
+        x = np.array([-1.0, 0.0, 1.0])
+        y = 8.0*(1 - ((x-0.3)/2.0)**2)
+        off, height, width = _parabola(*y)
+        self.assertAlmostEqual(off, 0.3)
+        self.assertAlmostEqual(height, 8.0)
+        self.assertAlmostEqual(width, np.sqrt(2.0)*2.0)
+
+if __name__ == '__main__':
+    unittest.main()
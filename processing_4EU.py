@@ -13,30 +13,44 @@ This version is specific to EU project
 
 from __future__ import print_function, division
 import sys, os, time
+import copy
+import threading
 import unittest
 import numpy as np
 from numpy import fft as npfft
+try:
+    from scipy import fft as spfft
+except ImportError:     # scipy < 1.4
+    spfft = None
 import tables
-from scipy.signal import decimate, lfilter, cheby1, medfilt, medfilt2d
+from scipy.signal import decimate, lfilter, cheby1, medfilt, medfilt2d, firwin
 import multiprocessing as mp
 import pickle
 import json
 import functools
+import math
+from math import gcd
 
 from spike.NPKConfigParser import NPKConfigParser
 from spike.FTICR import *
-from spike.File.Apex import Import_2D as Import_2D_Apex
-from spike.File.Solarix import Import_2D as Import_2D_Solarix
-Import_2D = {'Apex': Import_2D_Apex,'Solarix': Import_2D_Solarix }
 from spike.NPKData import copyaxes
 from spike.File.HDF5File import HDF5File, determine_chunkshape
 from spike.util import progressbar as pg
 from spike.util import widgets
 from spike.util import mpiutil as mpiutil
-from spike.NPKData import as_cpx
+from spike.NPKData import as_cpx, as_float
 from spike.util.simple_logger2 import TeeLogger
 
+from noise_estimate import robust_stats, METHODS as NOISE_METHODS
+from fft_tuner import FFTTuner
+from executor import Executor, BACKENDS as EXECUTORS, default_backend, limit_blas_threads, pipeline
+from bruker_ser import open_ser, import_2D, attach_acquisition, SerFile
+from sparse_store import SparseArray, make_sparse
+from peak_picking import tiles, pick_tile, merge_peaks, store_peaks
+
 debug = 0   # debugging level, 0 means no debugging
+executor = Executor()       # runs the parallel parts of the processing - set in main()
+hdf5_lock = threading.RLock()   # HDF5 is accessed by one thread at a time (see run_pipeline())
 interfproc = False
 
 if sys.version_info[0] < 3:
@@ -56,6 +70,12 @@ under Windows : mpiexec -n nbproc python -m spike.processing (configfile.mscf)
 LARGESTDATA = 8*1024*1024*1024  # 8 Giga points  (that's 64Gb !)
 # the smallest axis size allowed
 SIZEMIN = 1024
+# the memory allowed for a block of rows or columns processed at once (in bytes)
+BLOCKMEM = 64*1024*1024
+# with adaptive_denoising, the margin on the rank deduced from the lines detected, as the weaker lines are not counted
+ADAPTIVE_MARGIN = 2
+# the optimal size of a HDF5 chunk in the intermediate file (in bytes)
+CHUNKMEM = 1024*1024
 #HIGHMASS = 100000   # kludge to use mztoi !
 
 
@@ -130,7 +150,7 @@ def pred_sizes_zf(d0, zf = 0, sizemin = SIZEMIN):
     if debug > 0: print(r, functools.reduce(lambda x, y:x*y, r)//1024//1024, 'Mpoint')     # report if debug
     return tuple(r) 
    
-def pred_sizes(d0, szmult = (1,1), sizemin = SIZEMIN):
+def pred_sizes(d0, szmult = (1,1), sizemin = SIZEMIN, rounding = intelliround):
     """
     given an input data set, determines the optimum size s1,s2 to process it
         with a size multiplicant of szmult
@@ -139,6 +159,7 @@ def pred_sizes(d0, szmult = (1,1), sizemin = SIZEMIN):
     any strictly positive value is possible, 0.2 0.33 1.1 2 2.2 5 etc...
     
     however, axes can never get smaller than sizemin
+    sizes are rounded to easy to FT values with rounding(), intelliround() by default
     returns (si1, si2, ...) as the dataset dimension
     """
     def dosize(s, szm, sizemin):
@@ -146,14 +167,14 @@ def pred_sizes(d0, szmult = (1,1), sizemin = SIZEMIN):
         sm = min(sizemin, s)    # not smaller than sizemin, unless s is already smaller
         s1 = s*szm              # the szm level
         s = max(sm, s1)         # not smaller than sm
-        return intelliround(s)
+        return rounding(s)
     r = []      # will build into r
     for i in range(d0.dim):
         r.append( dosize(d0.axes(i+1).size, szmult[i], sizemin)) # apply l() for each axes
     if debug > 0: print(r, functools.reduce(lambda x, y:x*y, r)//1024//1024, 'Mpoint')     # report if debug
     return tuple(r) 
 
-def comp_sizes(d0,  zflist=None, szmlist=None, largest = LARGESTDATA, sizemin = SIZEMIN, vignette = True):
+def comp_sizes(d0,  zflist=None, szmlist=None, largest = LARGESTDATA, sizemin = SIZEMIN, vignette = True, tolerance = 0.0, dtype = float):
     """
     return a list with data-sizes, computed either
         zflist : from zerofilling index    eg : (1,0,-1)
@@ -162,6 +183,9 @@ def comp_sizes(d0,  zflist=None, szmlist=None, largest = LARGESTDATA, sizemin =
     largest determines the largest dataset allowed
     sizemini determines the minimum size when downzerofilling
     when vignette == True (default) a minimum size data (defined by sizemini) is appended to the list
+    if tolerance > 0, the processed size from szmlist (the first one) is the size with the fastest FFT of type dtype
+        within tolerance (0.1 is 10%) of the multiplied sizes, measured on this machine (see fft_tuner.py)
+        the following sizes are then obtained by dividing it by 4
     """
     sizes = []
     if (zflist!=None) and (szmlist!=None):
@@ -174,7 +198,13 @@ def comp_sizes(d0,  zflist=None, szmlist=None, largest = LARGESTDATA, sizemin =
         sm1,sm2 = szmlist
         first_loop = True       # 1st loop is specal as there is no downsampling to do
         while True:      # reduce progressively the multiplier
-            (psi1, psi2) = pred_sizes(d0, (sm1,sm2))   # initial prediction of sizes, ok for FFT
+            if tolerance > 0 and first_loop:
+                rounding = functools.partial(FFTTuner(dtype).best_size, tolerance=tolerance)
+                (psi1, psi2) = pred_sizes(d0, (sm1,sm2), rounding=rounding)    # fastest sizes
+            elif tolerance > 0:
+                (psi1, psi2) = (si1//4, si2//4)     # so that downsampling is possible
+            else:
+                (psi1, psi2) = pred_sizes(d0, (sm1,sm2))   # initial prediction of sizes, ok for FFT
             if not first_loop:
                 if si1%psi1 != 0:       # check that we'll be able to do downsample
                     psi1 = si1          # if not, do not reduce
@@ -190,7 +220,7 @@ def comp_sizes(d0,  zflist=None, szmlist=None, largest = LARGESTDATA, sizemin =
                 if (si1,si2) == (psi1, psi2):   # infinite loop
                     break
             si1, si2 = psi1, psi2
-            if si1*si2 <= 2*SIZEMIN*SIZEMIN:
+            if si1*si2 <= 2*SIZEMIN*SIZEMIN and not first_loop:     # the processed size is always kept, even if small
                 break
             szres.append( (si1,si2))
             (sm1, sm2) = (0.25*sm1, 0.25*sm2)   # divide by 4, and insure floats
@@ -217,6 +247,63 @@ def comp_sizes(d0,  zflist=None, szmlist=None, largest = LARGESTDATA, sizemin =
     if debug>0: print("sizes to process", sizes)
     return sizes
 
+def mz_window(axis, mzrange, step=1):
+    """
+    the (start, end) range of the points of axis covering the m/z range mzrange (low, high)
+    rounded outward to multiples of step, the whole axis if mzrange is None
+    """
+    if mzrange is None:
+        return (0, axis.size)
+    ilow, ihigh = sorted(float(axis.mztoi(mz)) for mz in mzrange)       # index increases as m/z decreases
+    start = max(0, step*int(math.floor(ilow)//step))
+    end = min(axis.size, step*int(-(-math.ceil(ihigh+1)//step)))
+    if end <= start:
+        raise Exception("m/z range %s is outside of the axis (%.2f - %.2f)"%(mzrange, axis.itomz(axis.size-1), axis.itomz(0)))
+    return (start, end)
+
+def crop_axis(axis, start, end):
+    "crops axis to its points [start:end], keeping the calibration, as extract() does : left_point and specwidth are adapted"
+    axis.specwidth = axis.specwidth*(end+axis.left_point)/(axis.size+axis.left_point)
+    axis.left_point += start
+    axis.size = end-start
+
+def crop_roi(d1, f1range, f2range, allsizes):
+    """
+    restricts the processed 2D d1 to the region of interest given by the m/z ranges f1range and f2range (None for a whole axis)
+    the window is aligned so that it can be downsampled to all the sizes of allsizes, which are returned cropped
+    the axes of d1 are cropped (see crop_axis()) and d1.roi is set (see roi_window())
+    """
+    steps = []
+    for k, size in enumerate((d1.size1, d1.size2)):
+        step = 1
+        for sizes in allsizes:
+            if size%sizes[k] == 0:
+                n = size//sizes[k]
+                step = step*n//gcd(step, n)
+        steps.append(step)
+    i0, i1 = mz_window(d1.axis1, f1range, steps[0])
+    j0, j1 = mz_window(d1.axis2, f2range, steps[1])
+    d1.roi = (d1.size1, d1.size2, i0, i1, j0, j1)
+    cropped = [(s1*(i1-i0)//d1.size1, s2*(j1-j0)//d1.size2) for (s1, s2) in allsizes]
+    crop_axis(d1.axis1, i0, i1)
+    crop_axis(d1.axis2, j0, j1)
+    return cropped
+
+def roi_window(data):
+    "(size1, size2, i0, i1, j0, j1) : the processed sizes of data, and the window [i0:i1, j0:j1] actually stored (see crop_roi())"
+    return getattr(data, 'roi', (data.size1, data.size2, 0, data.size1, 0, data.size2))
+
+def region_of_interest(d0, d1, parameter, allsizes):
+    "applies the m/z ranges of parameter, if any, to d1 processed from d0 (see crop_roi()), returns the cropped allsizes"
+    if parameter.f1_mz_range is None and parameter.f2_mz_range is None:
+        return allsizes
+    if parameter.do_f1demodu and parameter.do_modulus:      # the F1 m/z depend on the demodulation
+        d1.axis1.offsetfreq = f1demodu_shift(d0, parameter)
+    allsizes = crop_roi(d1, parameter.f1_mz_range, parameter.f2_mz_range, allsizes)
+    print("region of interest: F1 %.2f - %.2f m/z, F2 %.2f - %.2f m/z : %d x %d points"%(
+        d1.axis1.itomz(d1.size1-1), d1.axis1.itomz(0), d1.axis2.itomz(d1.size2-1), d1.axis2.itomz(0), d1.size1, d1.size2))
+    return allsizes
+
 def apod(d, size, axis = 0):
     """
     apply apodisation and change size
@@ -232,11 +319,13 @@ def apod(d, size, axis = 0):
         size after == size before
     """
     # utility which choose apod function - independent of d.dim
+    # same as d.kaiser(beta), with the window taken from the cache
     def do_apod(ax):
         if ax==1:
-            d.kaiser(beta=5, axis = todo)    # kaiser(5) is as narrow as sin() but has much less wiggles
+            beta = 5    # kaiser(5) is as narrow as sin() but has much less wiggles
         else:
-            d.kaiser(beta=3.5, axis = todo)
+            beta = 3.5
+        d.apod_apply(todo, kaiser_window(d.axes(todo).size, beta, d.axes(todo).itype))
     # set parameters
     todo = d.test_axis(axis)    # todo is either 1 or 2 : axis along which to act
     initialsize = d.axes(todo).size   # size before zf along todo axis
@@ -270,145 +359,690 @@ def hmclear(d):
     d.buffer[:ihm] = 0.0
     return d
 
-def iterargF2(dinp, size, scan):
+def float_type(parameter):
+    "the numpy type of the processed data : float32 if parameter.precision is 'single', float64 otherwise"
+    if getattr(parameter, 'precision', 'double') == 'single':
+        return np.float32
+    return np.float64
+
+def complex_type(dtype):
+    "the complex type matching the float type dtype"
+    return np.result_type(dtype, np.complex64)
+
+# process-wide caches of apodisation windows and FFT plans, see kaiser_window() and fft_plan()
+_windows = {}
+_fft_plans = {}
+cache_stats = {'window': [0, 0], 'fft': [0, 0]}     # [hits, misses] of each cache, in the current process
+
+def _cached(cache, name, key, build):
+    "returns cache[key], computed by build() on the first call, and counts hits and misses in cache_stats[name]"
+    try:
+        value = cache[key]
+    except KeyError:
+        cache_stats[name][1] += 1
+        value = cache[key] = build()
+    else:
+        cache_stats[name][0] += 1
+    return value
+
+def cache_report():
+    "a one line report of the window and FFT plan caches of the current process"
+    return "window cache: %d hits %d misses - FFT plan cache: %d hits %d misses"%tuple(cache_stats['window'] + cache_stats['fft'])
+
+def kaiser_window(size, beta, itype=0, dtype=float):
+    """
+    returns the kaiser(beta) apodisation buffer of a given size, as NPKData.kaiser() would apply it, of type dtype
+    itype is the itype of the apodised axis, the windows are computed once and shared - they are read-only
+    """
+    def build():
+        if itype == 1:      # complex, the window is duplicated on real and imaginary parts
+            w = as_float((1 + 1.0j)*np.kaiser(size//2, beta))
+        else:
+            w = np.kaiser(size, beta)
+        w = w.astype(dtype)
+        w.flags.writeable = False
+        return w
+    return _cached(_windows, 'window', (size, beta, itype, np.dtype(dtype)), build)
+
+class FFTPlan(object):
+    """
+    the real FFT of a given size and type
+    uses scipy.fft when available, which keeps its pocketfft plans and computes float32 data in single precision
+    (numpy.fft converts it to double), numpy.fft otherwise
+    """
+    def __init__(self, size, dtype=float):
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.lib = npfft if spfft is None else spfft
+    def rfft(self, x, axis=-1):
+        "the complex spectrum of x, along axis"
+        return self.lib.rfft(x, n=self.size, axis=axis)
+
+def fft_plan(size, dtype=float):
+    "returns the FFTPlan for size and dtype, created once per process"
+    return _cached(_fft_plans, 'fft', (size, np.dtype(dtype)), lambda: FFTPlan(size, dtype))
+
+def apod_block(block, size, beta, itype=0):
+    """
+    equivalent of apod() applied to each row of block, a 2D numpy array
+    the kaiser(beta) apodisation is applied along the rows, which are zerofilled or truncated to size
+    returns a new array of shape (block.shape[0], size), of the type of block
+    """
+    initialsize = block.shape[1]
+    todo = min(initialsize, size)
+    out = np.zeros((block.shape[0], size), dtype=block.dtype)
+    out[:,:todo] = block[:,:todo]*kaiser_window(todo, beta, itype, block.dtype)
+    return out
+
+def rfft_block(block):
+    """
+    equivalent of rfft() applied to each row of block, a 2D numpy array of real data
+    returns the complex spectra stored as interleaved floats, as NPKData does, in the precision of block.
+    """
+    n = block.shape[1]
+    spec = fft_plan(n, block.dtype).rfft(block, axis=1)
+    out = np.empty((block.shape[0], n), dtype=block.dtype)
+    c = out.view(complex_type(block.dtype))
+    c[:,1:] = spec[:,1:n//2].conj()
+    c[:,0] = 0.5*(spec[:,0].real - 1j*spec[:,n//2].real)    # same convention as spike _base_rfft()
+    return out
+
+def rfft_data(d, axis=0):
+    "same as d.rfft(axis), on a 1D or 2D NPKData, using the FFT plan cache (see rfft_block())"
+    todo = d.test_axis(axis)
+    if d.axes(todo).itype != 0:
+        raise NPKError("wrong itype", data=d)
+    if d.dim == 1:
+        d.buffer = rfft_block(d.buffer[None,:])[0]
+    elif todo == 2:
+        d.buffer = rfft_block(d.buffer)
+    else:
+        d.buffer = np.ascontiguousarray(rfft_block(d.buffer.T).T)
+    d.axes(todo).itype = 1
+    return d
+
+def chunk_rows(data):
+    "returns the number of rows in a HDF5 chunk of data, 1 if data is not on file"
+    try:
+        return data.buffer.chunkshape[0]
+    except AttributeError:
+        return 1
+
+def itemsize(data):
+    "returns the number of bytes of a value of data, 8 if its buffer has no dtype"
+    return np.dtype(getattr(data.buffer, 'dtype', float)).itemsize
+
+def block_size(dinp, doutp, width, blockmem=BLOCKMEM, dtype=float):
+    """
+    determines how many rows to process at once,
+    a multiple of the HDF5 chunk height of dinp and doutp, holding in blockmem bytes
+    width is the largest row length (in values of type dtype) to handle
+    """
+    rowbytes = width*np.dtype(dtype).itemsize
+    c1, c2 = chunk_rows(dinp), chunk_rows(doutp)
+    step = c1*c2//gcd(c1, c2)       # least common multiple
+    if step*rowbytes > blockmem:     # chunks are too large, align on output only
+        step = c2
+    if step*rowbytes > blockmem:     # still too large, give up alignment
+        return max(1, blockmem//rowbytes)
+    return step*max(1, blockmem//(step*rowbytes))
+
+def intermediate_chunks(dinp, datatemp, blockmem=BLOCKMEM, chunkmem=CHUNKMEM, dtype=float):
+    """
+    determines the chunk shape of the intermediate file, holding values of type dtype, written by rows in F2 and read by columns in F1
+    chunks are as high as the input chunks (or as many rows as blockmem allows)
+    and as wide as allowed by chunkmem, so that F1 can read complete columns of chunks
+    """
+    size = np.dtype(dtype).itemsize
+    width = max(dinp.size2, datatemp.size2)
+    c1 = min(chunk_rows(dinp), datatemp.size1, max(1, blockmem//(width*size)))
+    c2 = 2*max(1, chunkmem//(2*size*c1))        # even, as columns are processed by pairs
+    return (c1, min(c2, datatemp.size2))
+
+class ColumnReader(object):
+    """
+    gives access to the columns of a 2D stored on file
+    columns are read by bands aligned on the HDF5 chunks, and kept in memory until a column out of the band is asked for.
+    memory is bounded by blockmem
+    so that a sequential scan of the columns reads each chunk only once
+    """
+    def __init__(self, data, blockmem=BLOCKMEM, dtype=float):
+        self.data = data
+        self.dtype = dtype
+        try:
+            cw = data.buffer.chunkshape[1]
+        except AttributeError:
+            cw = 2
+        colbytes = np.dtype(dtype).itemsize*data.size1      # columns are kept in memory as dtype
+        if cw*colbytes <= blockmem:
+            self.width = cw*(blockmem//(cw*colbytes))      # a multiple of the chunk width
+        else:
+            self.width = max(2, 2*(blockmem//(2*colbytes)))
+        self.start = 0
+        self.band = None
+        self.bytes_read = 0
+        self.time_read = 0.0
+    def _load(self, i):
+        "loads the band containing column i"
+        t0 = time.time()
+        self.start = self.width*(i//self.width)
+        self.band = np.asarray(self.data.buffer[:, self.start:self.start+self.width], dtype=self.dtype)
+        self.bytes_read += self.band.size*itemsize(self.data)     # as stored in the file
+        self.time_read += time.time()-t0
+    def col(self, i):
+        "returns column i as a 1D FTICRData, same as data.col(i)"
+        if self.band is None or not (self.start <= i < self.start+self.band.shape[1]):
+            self._load(i)
+        c = type(self.data)(buffer = self.band[:,i-self.start].copy())
+        c.axis1 = self.data.axis1.copy()
+        try:
+            c.params = self.data.params
+        except AttributeError:
+            pass
+        return c
+    def cols(self, i0, i1):
+        "returns columns i0 to i1 (excluded) as a 2D numpy array"
+        parts = []
+        i = i0
+        while i < i1:           # the range may span several bands
+            if self.band is None or not (self.start <= i < self.start+self.band.shape[1]):
+                self._load(i)
+            j = min(i1, self.start+self.band.shape[1])
+            parts.append(self.band[:, i-self.start:j-self.start])
+            i = j
+        if len(parts) == 1:
+            return parts[0].copy()
+        return np.hstack(parts)
+    def report(self):
+        "print the reading statistics, compared with a column by column access"
+        dataset = self.data.buffer
+        try:
+            c1, c2 = dataset.chunkshape
+        except AttributeError:
+            return
+        ncol = self.data.size2
+        colchunks = -(-self.data.size1//c1)                # chunks met by a column
+        colbytes = itemsize(self.data)*colchunks*c1*c2      # bytes read per column of chunks
+        if colbytes <= tables.parameters.CHUNK_CACHE_SIZE:  # chunks are kept in cache from one column to the next
+            percol = colbytes*(-(-ncol//c2))
+        else:                                               # each column reads all its chunks again
+            percol = colbytes*ncol
+        saved = percol - self.bytes_read
+        if self.time_read > 0:
+            tsaved = saved*self.time_read/max(1, self.bytes_read)
+        else:
+            tsaved = 0.0
+        print("intermediate file read by bands of %d columns (chunks %d x %d)"%(self.width, c1, c2))
+        print("   %.1f MB read in %.1f sec - column by column access would read %.1f MB"%(self.bytes_read/1024/1024, self.time_read, percol/1024/1024))
+        print_time(tsaved, "   estimated time saved on reading (%.1f MB saved)"%(saved/1024/1024))
+
+class ColumnWriter(object):
+    """
+    collects the columns to be stored in a 2D stored on file, and writes them by blocks of columns
+    block width is a multiple of the HDF5 chunk width, so that each chunk is written only once.
+    columns may arrive in any order (as with MPI), a block is written as soon as it is complete.
+    if aligned is False, columns are written one by one, as they arrive.
+    if consumer is given, consumer(start, block) is called with each block written
+    if progress is given (see Progress), it is informed of each block written
+    if noise is given, a 1D array-like (see noise_node()), the noise levels of the columns are stored in it with the blocks
+    if rows is given, as (i0, i1), only these rows of the columns received are stored
+    columns before start are already stored, and are left untouched
+    """
+    def __init__(self, data, aligned=True, consumer=None, blockmem=BLOCKMEM, progress=None, start=0, noise=None, rows=None):
+        self.data = data
+        self.rows = rows
+        self.consumer = consumer
+        self.noise = noise
+        self.progress = progress
+        self.start = start
+        self.dtype = getattr(data.buffer, 'dtype', float)
+        try:
+            cw = data.buffer.chunkshape[1]
+        except AttributeError:
+            cw = 1
+        colbytes = np.dtype(self.dtype).itemsize*data.size1
+        if not aligned:
+            self.width = 1
+        elif cw*colbytes <= blockmem:
+            self.width = cw*max(1, blockmem//(4*cw*colbytes))      # leave room for a few blocks in flight
+        else:
+            self.width = cw
+        self.blocks = {}        # blocks being filled : {index: [buffer, count, noise, received]}
+    def set_col(self, i, buf, noise=0.0):
+        "stores buf as the column i, noise is its noise level"
+        self.set_cols(i, buf.reshape((-1,1)), np.atleast_1d(noise))
+    def set_cols(self, i0, buf, noise=None):
+        "stores the 2D buffer buf as the columns starting at i0, noise are their noise levels"
+        if self.rows is not None:
+            buf = buf[self.rows[0]:self.rows[1]]
+        i1 = i0 + buf.shape[1]
+        if noise is None:
+            noise = np.zeros(buf.shape[1])
+        if self.width == 1:
+            self._write(i0, buf, noise)
+            return
+        i = i0
+        while i < i1:           # buf may span several blocks
+            ib = i//self.width
+            start = max(ib*self.width, self.start)
+            stop = min((ib+1)*self.width, self.data.size2)
+            try:
+                block = self.blocks[ib]
+            except KeyError:
+                block = [np.zeros((self.data.size1, stop-start), dtype=self.dtype), 0, np.zeros(stop-start), np.zeros(stop-start, dtype=bool)]
+                self.blocks[ib] = block
+            n = min(i1, stop)-i
+            block[0][:, i-start:i-start+n] = buf[:, i-i0:i-i0+n]
+            block[2][i-start:i-start+n] = noise[i-i0:i-i0+n]
+            block[3][i-start:i-start+n] = True
+            block[1] += n
+            if block[1] == stop-start:      # complete
+                self._write(start, block[0], block[2])
+                del self.blocks[ib]
+            i += n
+    def _write(self, start, buf, noise, received=None):
+        """
+        actually writes a block
+        received, if given, tells which columns of an incomplete block were received, the progress only covers these ones
+        """
+        self.data.buffer[:, start:start+buf.shape[1]] = buf
+        if self.noise is not None:
+            self.noise[start:start+buf.shape[1]] = noise
+        if self.consumer is not None:
+            self.consumer(start, buf)
+        if self.progress is None:
+            return
+        if received is None:
+            self.progress.done(start, start+buf.shape[1])
+            return
+        edges = np.diff(np.concatenate(([0], received.astype(np.int8), [0])))
+        for (j0, j1) in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            self.progress.done(start+int(j0), start+int(j1))
+    def flush(self):
+        "writes the incomplete blocks - only the columns received are reported to the progress"
+        for ib in sorted(self.blocks):
+            block = self.blocks[ib]
+            self._write(max(ib*self.width, self.start), block[0], block[2], block[3])
+        self.blocks = {}
+        if self.progress is not None:
+            self.progress.save()
+
+def column_writer(data, parameter, pyramid=None, progress=None, start=0):
+    """
+    the ColumnWriter storing the F1 processed columns into data, and passing them to pyramid.push() if pyramid is given
+    the noise levels of the columns are stored into data.noise if present (see noise_node())
+    only the rows of the region of interest of data are kept (see roi_window())
+    """
+    consumer = None if pyramid is None else pyramid.push
+    size1, size2, i0, i1, j0, j1 = roi_window(data)
+    return ColumnWriter(data, aligned=parameter.block_processing, consumer=consumer, progress=progress, start=start,
+        noise=getattr(data, 'noise', None), rows=(i0, i1))
+
+class Progress(object):
+    """
+    keeps track of the rows or columns of data already computed and stored,
+    as a watermark stored in an attribute of the data node in the HDF5 file, so that the processing can be resumed.
+    the watermark is the number of leading rows or columns completely stored, ranges may be completed in any order
+    it is saved at most every delay seconds, and by save()
+    """
+    def __init__(self, data, name, start=0, delay=10.0):
+        self.node = data.buffer
+        self.name = name
+        self.mark = start
+        self.pending = {}       # ranges completed beyond the watermark : {i0: i1}
+        self.delay = delay
+        self.last = time.time()
+    def done(self, i0, i1):
+        "records that the range i0:i1 is stored"
+        self.pending[i0] = i1
+        while self.mark in self.pending:
+            self.mark = self.pending.pop(self.mark)
+        if time.time()-self.last > self.delay:
+            self.save()
+    def save(self):
+        "stores the watermark into the file, after the data"
+        if not hasattr(self.node, 'set_attr'):      # not on file
+            return
+        self.node.flush()
+        self.node.set_attr(self.name+'_done', self.mark)
+        self.node._v_file.flush()
+        self.last = time.time()
+
+def set_signature(data, name, signature):
+    "stores in the file holding data the signature of the processing, and resets the watermark"
+    data.buffer.set_attr(name+'_signature', signature)
+    data.buffer.set_attr(name+'_done', 0)
+    data.buffer._v_file.flush()
+
+def get_signature(data, name):
+    "returns the signature of the processing stored with data, None if there is none"
+    attrs = data.buffer._v_attrs
+    if name+'_signature' in attrs._v_attrnames:
+        return str(data.buffer.get_attr(name+'_signature'))
+    return None
+
+def resume_point(data, name, signature):
+    """
+    returns the watermark stored by Progress in the file holding data,
+    None if the file was produced with a different signature, and cannot be resumed
+    """
+    if get_signature(data, name) != signature:
+        return None
+    return int(data.buffer.get_attr(name+'_done'))
+
+F1_KEYS = ('do_f1demodu', 'freq_f1demodu', 'do_modulus', 'do_rem_ridge', 'do_urqrd', 'urqrd_rank', 'urqrd_iterations',
+    'do_sane', 'sane_rank', 'sane_iterations', 'samplingfile', 'samplingfile_fake', 'do_pgsane', 'pgsane_rank',
+    'pgsane_iterations', 'pgsane_threshold', 'compress_outfile', 'compress_level', 'noise_estimator', 'precision')
+
+def F2_signature(param, d0, datatemp):
+    "a string identifying the F2 processing of d0 into datatemp"
+    infile = d0.shared.name if hasattr(d0, 'shared') else param.infile       # read directly from the ser file
+    sig = {'infile': os.path.abspath(infile), 'mtime': os.path.getmtime(infile),
+        'input': [int(d0.size1), int(d0.size2)], 'intermediate': [int(datatemp.size1), int(datatemp.size2)],
+        'precision': param.precision}
+    return json.dumps(sig, sort_keys=True)
+
+def F1_signature(param, f2signature, d1):
+    "a string identifying the F1 processing into d1, of an intermediate file with signature f2signature"
+    sig = dict((k, getattr(param, k)) for k in F1_KEYS)
+    sig['intermediate'] = f2signature
+    sig['output'] = [int(d1.size1), int(d1.size2)]
+    if hasattr(d1, 'roi'):
+        sig['roi'] = [int(i) for i in d1.roi]
+    if param.adaptive_denoising:
+        sig['adaptive_threshold'] = param.adaptive_threshold
+    return json.dumps(sig, sort_keys=True, default=str)
+
+def column_reader(dinp, parameter):
+    "returns the object used to read the columns of dinp, a ColumnReader in block mode, dinp itself otherwise"
+    if parameter.block_processing:
+        return ColumnReader(dinp)
+    return dinp
+
+def report_reader(cols):
+    "print reading statistics if cols is a ColumnReader"
+    if isinstance(cols, ColumnReader):
+        cols.report()
+
+def report_denoising(denoising):
+    "print and store the denoising statistics if denoising is a DenoisingStats"
+    if denoising is not None:
+        denoising.report()
+        denoising.save()
+
+def run_pipeline(compute, xarg, consumer, parameter, name):
+    """
+    runs consumer(compute(xarg)) with reading, computation and writing overlapped (see executor.pipeline())
+    with queues of parameter.prefetch elements, xarg and consumer access the files under hdf5_lock
+    compute() is handed at most prefetch + executor.inflight elements not yet returned, so that memory remains bounded
+    returns the PipelineStats, which report() the waiting times of the stages
+    """
+    value, stats = pipeline(compute, xarg, consumer, parameter.prefetch, hdf5_lock, name, parameter.prefetch+executor.inflight)
+    return stats
+
+def iterargF2block(dinp, size, scan, nblock, start=0, dtype=float):
+    "an iterator used by the block F2 processing, yields slabs of nblock rows, from row start, of type dtype"
+    itype = dinp.axis2.itype
+    for i0 in range(start, scan, nblock):
+        i1 = min(i0+nblock, scan)
+        block = np.asarray(dinp.buffer[i0:i1,:], dtype=dtype)
+        yield (i0, block, size, itype)
+
+def _do_proc_F2block(data):
+    "do the F2 processing on a block of rows - called by the mp loop"
+    i0, block, size, itype = data
+    block = apod_block(block, size, beta=3.5, itype=itype)
+    return (i0, rfft_block(block))
+
+def iterargF2range(fname, size, scan, nblock, itype, start=0, dtype=float):
+    "as iterargF2block, but yields only row ranges, workers read the rows from fname themselves (see worker_open())"
+    for i0 in range(start, scan, nblock):
+        yield (fname, i0, min(i0+nblock, scan), size, itype, dtype)
+
+def _do_proc_F2range(data):
+    "do the F2 processing on a range of rows read from file - called by the mp loop"
+    fname, i0, i1, size, itype, dtype = data
+    dinp = worker_open(fname)
+    block = np.asarray(dinp.buffer[i0:i1,:], dtype=dtype)
+    return _do_proc_F2block((i0, block, size, itype))
+
+def do_proc_F2block(dinp, doutp, parameter, start=0):
+    """
+    do the F2 processing by blocks of rows, starting at row start
+    blocks are aligned on HDF5 chunks, each is read and written in one hyperslab access.
+    same results than do_proc_F2mp()
+    """
+    size = doutp.axis2.size
+    scan = min(dinp.size1, doutp.size1)      # min() because no need to do extra work !
+    nblock = block_size(dinp, doutp, max(dinp.size2, size), dtype=float_type(parameter))
+    if debug>0: print("F2 blocks of %d rows"%nblock)
+    F2widgets = ['Processing F2: ', widgets.Percentage(), ' ', widgets.Bar(marker='-',left='[',right=']'), widgets.ETA()]
+    pbar= pg.ProgressBar(widgets=F2widgets, maxval=scan).start() #, fd=sys.stdout)
+    if worker_reads(dinp, parameter):      # workers get only the row ranges
+        xarg = iterargF2range(data_source(dinp), size, scan, nblock, dinp.axis2.itype, start, float_type(parameter))
+        proc = _do_proc_F2range
+    else:
+        xarg = iterargF2block(dinp, size, scan, nblock, start, float_type(parameter))      # construct iterator for main loop
+        proc = _do_proc_F2block
+    progress = Progress(doutp, 'F2', start)
+    def store(res):
+        done = start
+        for i0, buf in res:     # row index is carried in the results
+            doutp.buffer[i0:i0+buf.shape[0],:] = buf
+            progress.done(i0, i0+buf.shape[0])
+            done += buf.shape[0]
+            pbar.update(done)
+    stats = run_pipeline(functools.partial(executor.imap_unordered, proc), xarg, store, parameter, 'F2')
+    progress.save()
+    pbar.finish()
+    stats.report()
+
+def enum_imap_start(func, xarg, start=0):
+    """
+    applies func to each element of xarg, with the executor
+    yields (i, result), with i the rank of the element in xarg, plus start
+    results come in order, except with MPI
+    """
+    for i,r in executor.enum_imap(func, xarg):
+        yield (i+start, r)
+
+def iterargF2(dinp, size, scan, start=0, clear=False):
     "an iterator used by the F2 processing to allow multiprocessing or MPI set-up"
-    for i in range(scan):
+    for i in range(start, scan):
         r = dinp.row(i)
-        yield (r, size)
+        yield (r, size, clear)
 
 def _do_proc_F2(data):
-    "do the elementary F2 processing - called by the mp loop"
-    r, size = data
+    "do the elementary F2 processing - called by the mp loop - hmclear() is applied if clear is True"
+    r, size, clear = data
     apod(r, size)
-    r.rfft()    
+    rfft_data(r)
+    if clear:
+        r = hmclear(r)
     return r
 
-def do_proc_F2mp(dinp, doutp, parameter):
-    "do the F2 processing in MP"    
+def do_proc_F2mp(dinp, doutp, parameter, start=0, clear=False):
+    "do the F2 processing in MP, starting at row start - if clear, rows are cleared for compression (see hmclear())"
     size = doutp.axis2.size
     scan = min(dinp.size1, doutp.size1)      # min() because no need to do extra work !
     F2widgets = ['Processing F2: ', widgets.Percentage(), ' ', widgets.Bar(marker='-',left='[',right=']'), widgets.ETA()]
     pbar= pg.ProgressBar(widgets=F2widgets, maxval=scan).start() #, fd=sys.stdout)
-    xarg = iterargF2(dinp, size, scan )      # construct iterator for main loop
-    if parameter.mp:  # means multiprocessing //
-        res = Pool.imap(_do_proc_F2, xarg)
-        for i,r in enumerate(res):
-            doutp.set_row(i,r)
-            pbar.update(i+1)
-    elif mpiutil.MPI_size > 1:      # code for MPI processing //
-        res = mpiutil.enum_imap(_do_proc_F2, xarg)    # apply it
-        for i,r in res:       # and get results
-            doutp.set_row(i,r)
-            pbar.update(i+1)
-    else:       # plain non //
-        res = imap(_do_proc_F2, xarg)
-        for i,r in enumerate(res):
+    xarg = iterargF2(dinp, size, scan, start, clear)      # construct iterator for main loop
+    progress = Progress(doutp, 'F2', start)
+    def store(res):
+        done = start
+        for i,r in res:
             doutp.set_row(i,r)
-            pbar.update(i+1)
+            progress.done(i, i+1)
+            done += 1
+            pbar.update(done)
+            if interfproc:
+                output = open('InterfProc/progbar.pkl', 'wb')
+                pb = ['F2', int(done/float(scan)*100)]
+                pickle.dump(pb, output)
+                output.close()
+    stats = run_pipeline(functools.partial(enum_imap_start, _do_proc_F2, start=start), xarg, store, parameter, 'F2')
+    progress.save()
     pbar.finish()
+    stats.report()
     
 def do_proc_F2(dinp, doutp, parameter):
-    "do the F2 processing - serial code"
-    size = doutp.axis2.size
-    scan = min(dinp.size1, doutp.size1)      # min() because no need to do extra work !
-    #scan = dinp.size1 # when was it done? 
-    F2widgets = ['Processing F2: ', widgets.Percentage(), ' ', widgets.Bar(marker='-',left='[',right=']'), widgets.ETA()]
-    pbar= pg.ProgressBar(widgets=F2widgets, maxval=scan).start() #, fd=sys.stdout)
-    print("############  in do_proc_F2 #########")
-    print("dinp.axis1.itype ", dinp.axis1.itype) 
-    print("dinp.axis2.itype ", dinp.axis2.itype)
-    print("doutp.axis1.itype ", doutp.axis1.itype) 
-    print("doutp.axis2.itype ", doutp.axis2.itype)
-    print("dinp.axis1.size ", dinp.axis1.size) 
-    print("dinp.axis2.size ", dinp.axis2.size) 
-    print("doutp.axis1.size ", doutp.axis1.size) 
-    print("doutp.axis2.size ", doutp.axis2.size) 
-    print("########################### doutp.report() ")
-    print(doutp.report())
-    #print dir(doutp)
-    for i in xrange(scan):
-        r = dinp.row(i)
-        apod(r, size)
-        r.rfft()    
-        if parameter.compress_outfile:
-            r = hmclear(r)
-        doutp.set_row(i,r)
-        pbar.update(i+1)
-        if interfproc:
-            output = open('InterfProc/progbar.pkl', 'wb')
-            pb = ['F2', int((i+1)/float(scan)*100)]
-            pickle.dump(pb, output)
-            output.close()
-    pbar.finish()
+    "do the F2 processing, with rows cleared for compression if parameter.compress_outfile"
+    if debug>0:
+        print("############  in do_proc_F2 #########")
+        print("dinp.axis1.itype ", dinp.axis1.itype) 
+        print("dinp.axis2.itype ", dinp.axis2.itype)
+        print("doutp.axis1.itype ", doutp.axis1.itype) 
+        print("doutp.axis2.itype ", doutp.axis2.itype)
+        print("dinp.axis1.size ", dinp.axis1.size) 
+        print("dinp.axis2.size ", dinp.axis2.size) 
+        print("doutp.axis1.size ", doutp.axis1.size) 
+        print("doutp.axis2.size ", doutp.axis2.size) 
+        print("########################### doutp.report() ")
+        print(doutp.report())
+    do_proc_F2mp(dinp, doutp, parameter, clear=parameter.compress_outfile)
 
-def do_proc_F1(dinp, doutp, parameter):
-    "scan all cols of dinp, apply proc() and store into doutp"
-    size = doutp.axis1.size
-    scan = min(dinp.size2, doutp.size2)      # min() because no need to do extra work !
+def iterargF1(cols, size, scan, parameter, start=0, first=0):
+    "an iterator used by the F1 processing, yields the columns of cols (see column_reader()) from first+start to first+scan"
+    for i in range(start, scan):
+        yield (cols.col(first+i), size, parameter)
+
+def _do_proc_F1(data):
+    "do the elementary F1 processing on a column - called by the mp loop"
+    c, size, parameter = data
+    apod(c, size)
+    rfft_data(c)
+    return _clean_F1(c, parameter)
+
+def _clean_F1(c, parameter):
+    "ridge removal and compression of the processed column c, returns its buffer and its noise level"
+    # get statistics
+    mean, std = robust_stats(c.get_buffer(), iterations=10, method=parameter.noise_estimator)
+    # computed ridge and remove
+    if parameter.do_F1 and parameter.do_rem_ridge:
+        c -= mean
+    # clean for compression
+    if parameter.compress_outfile :
+        threshold = parameter.compress_level * std
+        c.zeroing(threshold)
+        c = hmclear(c)
+    return (c.buffer, std)
+
+def do_proc_F1(dinp, doutp, parameter, pyramid=None, start=0):
+    "scan all cols of dinp from start, apply proc() and store into doutp - pyramid, if given, receives the columns"
+    size1, size2, i0, i1, j0, j1 = roi_window(doutp)
+    size = size1
+    scan = min(dinp.size2-j0, doutp.size2)      # min() because no need to do extra work !
     F1widgets = ['Processing F1: ', widgets.Percentage(), ' ', widgets.Bar(marker = '-',left='[',right=']'), widgets.ETA()]
     pbar= pg.ProgressBar(widgets = F1widgets, maxval = scan).start() #, fd=sys.stdout)
-    for i in xrange(scan):
-        c = dinp.col(i)
-        apod(c, size)
-        c.rfft()    
-        # get statistics
-        buff = c.get_buffer()
-        b = buff.copy()
-        for i in range(10):
-            b = b[ b-b.mean()<3*b.std() ]
-        # computed ridge and remove
-        if parameter.do_F1 and parameter.do_rem_ridge:
-            c -= b.mean()
-        # clean for compression
-        if parameter.compress_outfile :
-            threshold = parameter.compress_level * b.std()
-            c.zeroing(threshold)
-            c = hmclear(c)
-        doutp.set_col(i,c)
-        pbar.update(i)
+    progress = Progress(doutp, 'F1', start)
+    writer = column_writer(doutp, parameter, pyramid, progress, start)
+    if parameter.block_processing:      # columns are processed by ranges, using a shared worker context
+        proc_F1_ranges(dinp, writer, parameter, size, False, j0+start, j0+scan, j0, pbar)
+        return
+    cols = column_reader(dinp, parameter)
+    def store(res):
+        done = start
+        for i, (buf, noise) in res:
+            writer.set_col(i, buf, noise)
+            done += 1
+            pbar.update(done)
+        writer.flush()
+    stats = run_pipeline(functools.partial(enum_imap_start, _do_proc_F1, start=start), iterargF1(cols, size, scan, parameter, start, j0), store, parameter, 'F1')
     pbar.finish()
+    stats.report()
+    report_reader(cols)
+
+def iterargF1modu(cols, size, scan, parameter, start=0, first=0):
+    "an iterator used by the F1 modulus processing, yields the pairs of columns of cols (see column_reader()) from first+start to first+scan"
+    for i in range(first+start, first+scan):
+        yield (cols.col(2*i), cols.col(2*i+1), size, parameter)
+
+def _do_proc_F1_modu(data):
+    "do the elementary F1 processing on a pair of columns, followed by hypercomplex modulus - called by the mp loop"
+    c0, c1, size, parameter = data
+    d = FTICRData( buffer = np.zeros((size,2)) )     # 2 columns - used for hypercomplex modulus 
+    for off, p in ((0, c0), (1, c1)):
+        apod(p, size)
+        rfft_data(p)
+        d.set_col(off,  p )
+    d.axis1.itype = 1
+    d.axis2.itype = 1
+    d.modulus()
+    return _clean_F1(d.col(0), parameter)
 
-def do_proc_F1_modu(dinp, doutp, parameter):
+def do_proc_F1_modu(dinp, doutp, parameter, pyramid=None, start=0):
     "as do_proc_F1, but applies hypercomplex modulus() at the end"
-    size = 2*doutp.axis1.size
-    scan =  min(dinp.size2, doutp.size2)
+    size1, size2, i0, i1, j0, j1 = roi_window(doutp)
+    size = 2*size1
+    scan =  min(dinp.size2//2-j0, doutp.size2)
     F1widgets = ['Processing F1 modu: ', widgets.Percentage(), ' ', widgets.Bar(marker = '-',left = '[',right=']'), widgets.ETA()]
     pbar = pg.ProgressBar(widgets=F1widgets, maxval=scan).start() #, fd=sys.stdout)
-    d = FTICRData( buffer = np.zeros((2*doutp.size1,2)) )     # 2 columns - used for hypercomplex modulus 
-    for i in xrange( scan):
-        d.chsize(2*doutp.size1, 2)     # 2 columns - used for hypercomplex modulus 
-        for off in (0,1):
-            p = dinp.col(2*i+off)
-            apod(p, size)
-            p.rfft()    
-            d.set_col(off,  p )
-        d.axis1.itype = 1
-        d.axis2.itype = 1
-        d.modulus()
-        # recover buffer
-        c = d.col(0)
-        # get statistics
-        buff = c.get_buffer()
-        b = buff.copy()
-        for i in range(10):
-            b = b[ b-b.mean()<3*b.std() ]
-        # computed ridge and remove
-        if parameter.do_F1 and parameter.do_rem_ridge:
-            c -= b.mean()
-        # clean for compression
-        if parameter.compress_outfile :
-            threshold = parameter.compress_level * b.std()
-            c.zeroing(threshold)
-            c = hmclear(c)
-        doutp.set_col(i,c)
-        pbar.update(i+1)
+    progress = Progress(doutp, 'F1', start)
+    writer = column_writer(doutp, parameter, pyramid, progress, start)
+    if parameter.block_processing:      # pairs of columns are processed by ranges, using a shared worker context
+        proc_F1_ranges(dinp, writer, parameter, size, True, 2*(j0+start), 2*(j0+scan), j0, pbar)
+        return
+    cols = column_reader(dinp, parameter)
+    def store(res):
+        done = start
+        for i, (buf, noise) in res:
+            writer.set_col(i, buf, noise)
+            done += 1
+            pbar.update(done)
+        writer.flush()
+    stats = run_pipeline(functools.partial(enum_imap_start, _do_proc_F1_modu, start=start), iterargF1modu(cols, size, scan, parameter, start, j0), store, parameter, 'F1')
     pbar.finish()
+    stats.report()
+    report_reader(cols)
+
+def denoising_rank(parameter):
+    "the rank of the denoising (urqrd, sane or pg_sane) applied during F1, 0 if none"
+    if parameter.do_urqrd:
+        return parameter.urqrd_rank
+    if parameter.do_sane:
+        return parameter.sane_rank
+    if parameter.samplingfile is not None and parameter.do_pgsane:
+        return parameter.pgsane_rank
+    return 0
+
+def count_lines(d, threshold, method=None):
+    """
+    estimates the number of lines in d, a pair of demodulated columns (real and imaginary parts) :
+    the local maxima of the modulus of its spectrum larger than threshold x its noise level
+    """
+    spec = np.abs(npfft.fft(d.buffer[:,0] + 1j*d.buffer[:,1]))
+    mean, std = robust_stats(spec, iterations=10, method=method)
+    top = spec[1:-1]
+    lines = (top > mean + threshold*std) & (top > spec[:-2]) & (top >= spec[2:])
+    return int(lines.sum())
+
+def denoise(d, parameter, samp=None, size=None):
+    """
+    applies the denoising of parameter to d, a pair of demodulated columns, samp is the NUS sampling if any
+    with adaptive_denoising, the rank is ADAPTIVE_MARGIN x the number of lines found by count_lines(),
+    twice for urqrd, up to the rank of parameter, and columns holding only noise are not denoised
+    returns the rank used, 0 if not denoised
+    """
+    rank = denoising_rank(parameter)
+    if rank > 0 and parameter.adaptive_denoising:
+        lines = count_lines(d, parameter.adaptive_threshold, parameter.noise_estimator)
+        rank = min(rank, ADAPTIVE_MARGIN*(2 if parameter.do_urqrd else 1)*lines)
+    if parameter.do_urqrd and rank > 0:
+        d.urqrd(k=rank, iterations=parameter.urqrd_iterations, axis=1)
+    if parameter.do_sane and rank > 0:
+        d.sane(rank=rank, iterations=parameter.sane_iterations, axis=1)
+    if samp is not None and parameter.do_pgsane:
+        d.chsize(size, d.size2)
+        if rank > 0:
+            d.pg_sane(iterations=parameter.pgsane_iterations, rank=rank, sampling=samp, Lthresh=parameter.pgsane_threshold, axis=1, size=size)
+    return rank
 
 def _do_proc_F1_demodu_modu(data):
-    "given a pair of columns, return the processed demodued FTed modulused column"
+    "given a pair of columns, return the processed demodued FTed modulused column, its noise level and the denoising rank"
     c0, c1, shift, size, parameter = data
     if c0.buffer.max() == 0 and c1.buffer.max() == 0:     # empty data - short-cut !
-        return np.zeros(size//2)
+        return (np.zeros(size//2), 0.0, 0)
     d = FTICRData(buffer = np.zeros((c0.size1, 2)))     # 2 columns - used for hypercomplex modulus 
     d.set_col(0,  c0 )
     d.set_col(1,  c1 )
@@ -421,56 +1055,371 @@ def _do_proc_F1_demodu_modu(data):
         if parameter.samplingfile_fake:    # samplingfile_fake allows to fake NUS on complete data-sets
             d.set_buffer(d.get_buffer()[samp])     # throw points
         d.zf()                          # add missing points by padding with zeros
+    else:
+        samp = None
     # perform freq_f1demodu demodulation
     d.f1demodu(shift)
     # clean thru urqrd or sane
-    if parameter.do_urqrd:
-        d.urqrd(k=parameter.urqrd_rank, iterations=parameter.urqrd_iterations, axis=1)
-    if parameter.do_sane:
-        d.sane(rank=parameter.sane_rank, iterations=parameter.sane_iterations, axis=1)
-    if parameter.samplingfile is not None:      # NUS ?
-        if parameter.do_pgsane:
-            d.chsize(size, d.size2)
-            d.pg_sane(iterations=parameter.pgsane_iterations, rank=parameter.pgsane_rank, sampling=samp, Lthresh=parameter.pgsane_threshold, axis=1, size=size)
+    rank = denoise(d, parameter, samp, size)
 
     # finally do FT
     apod(d, size, axis = 1)
-    d.rfft(axis = 1)        # this rfft() is different from npfft.rfft() one !
+    rfft_data(d, axis = 1)        # this rfft() is different from npfft.rfft() one !
     d.modulus()
     # recover buffer
     buff = d.col(0).get_buffer()
     # get staistics
-    b = buff.copy()
-    for i in range(10):
-        b = b[ b-b.mean()<3*b.std() ]
+    mean, std = robust_stats(buff, iterations=10, method=parameter.noise_estimator)
     # computed ridge and remove
     if parameter.do_F1 and parameter.do_rem_ridge:
-        buff -= b.mean()
+        buff -= mean
     # clean for compression
     if parameter.compress_outfile :
-        threshold = parameter.compress_level * b.std()
+        threshold = parameter.compress_level * std
         buff[abs(buff)<threshold] = 0.0
-    return buff   # return raw data
+    return (buff, std, rank)   # return raw data, its noise level and the denoising rank
 
-def iterarg(dinp, rot, size, parameter ):
-    "an iterator used by the processing to allow  multiprocessing or MPI set-up"
-    for i in range(0, dinp.size2, 2):
-        c0 = dinp.col(i)
-        c1 = dinp.col(i+1)
+def iterarg(dinp, rot, size, parameter, cols=None, start=0, stop=None):
+    """
+    an iterator used by the processing to allow  multiprocessing or MPI set-up
+    columns are read from cols if given (see column_reader()), from dinp otherwise, starting at column start, up to stop
+    """
+    if cols is None:
+        cols = dinp
+    if stop is None:
+        stop = dinp.size2
+    for i in range(start, stop, 2):
+        c0 = cols.col(i)
+        c1 = cols.col(i+1)
 #        print i, c0, c1, rot, size
         yield (c0, c1, rot, size, parameter)
 
-def do_proc_F1_demodu_modu(dinp, doutp, parameter):
-    "as do_proc_F1, but applies demodu and then complex modulus() at the end"
-    size = 2*doutp.axis1.size
-    scan =  min(dinp.size2, doutp.size2)
+def column_ranges(dinp, scan, nworkers, start=0, dtype=float):
+    """
+    an iterator over (i0, i1), ranges of columns of dinp, from start up to scan, to be read as dtype
+    ranges are aligned on HDF5 chunks when possible, and small enough to keep all workers busy
+    """
+    width = ColumnReader(dinp, dtype=dtype).width
+    width = min(width, 2*max(1, (scan-start)//(8*nworkers)))      # at least 4 ranges per worker
+    if width > 2 and width%2 == 1:
+        width -= 1
+    i0 = start
+    while i0 < scan:
+        i1 = min(width*(i0//width+1), scan)
+        yield (i0, i1)
+        i0 = i1
+
+def demodu_ramp(size, shift):
+    "returns the phase ramp applied by f1demodu(shift) on columns of length size, computed as NPKData.flipphase() does"
+    ph1 = 180.0*shift
+    p0 = -0.5*ph1
+    p1 = ph1/(size-1)
+    e = np.empty(size, dtype=complex)
+    for i in range(size):
+        z = math.radians(p0 + i*p1)
+        e[i] = math.cos(z) + 1j*math.sin(z)
+    return e
+
+class F1Context(object):
+    """
+    holds everything the F1 workers need to process any pair of columns:
+    parameters, NUS sampling and demodulation phase ramp - the apodisation window comes from the window cache.
+    It is computed once by the main process and sent once to each worker (see imap_context())
+    so that tasks carry only column indices.
+    if source is given, the workers read the columns from it by themselves (see worker_open())
+    """
+    def __init__(self, parameter, dinp, rot, size, source=None):
+        self.parameter = parameter
+        self.rot = rot
+        self.size = size
+        self.source = source
+        self.dtype = float_type(parameter)
+        self.samp = None
+        n = dinp.size1          # column size at demodulation
+        if parameter.samplingfile is not None:      # NUS - sampling already loaded into dinp
+            self.samp = dinp.axis1.get_sampling()
+            n = max(self.samp) + 1
+        self.n = n
+        self.cache = {}
+        self.ramp(n)
+        # denoising is done column by column, on FTICRData objects
+        denoise = parameter.do_urqrd or parameter.do_sane or (self.samp is not None and parameter.do_pgsane)
+        self.vectorized = parameter.vectorized_F1 and not denoise
+        self.npairs = max(1, BLOCKMEM//(np.dtype(self.dtype).itemsize*(6*size + 4*self.n)))     # pairs processed at once by the vectorized kernel
+    def __getstate__(self):
+        "workspaces are not sent to the workers"
+        state = self.__dict__.copy()
+        state['cache'] = dict((k, v) for k, v in self.cache.items() if k[0] != 'workspace')
+        return state
+    def ramp(self, n):
+        "the f1demodu phase ramp for columns of length n"
+        try:
+            return self.cache['ramp', n]
+        except KeyError:
+            self.cache['ramp', n] = demodu_ramp(n, self.rot).astype(complex_type(self.dtype))
+            return self.cache['ramp', n]
+    def window(self, n):
+        "the kaiser(5) F1 apodisation window of length n"
+        return kaiser_window(n, 5, dtype=self.dtype)
+    def workspace(self, name, shape, dtype=None):
+        """
+        a buffer of given shape and type (self.dtype by default), allocated once and reused from one block to the next
+        each thread has its own workspaces
+        """
+        if dtype is None:
+            dtype = self.dtype
+        key = ('workspace', name, threading.get_ident())
+        ws = self.cache.get(key)
+        if ws is None or ws.shape[0] != shape[0] or ws.shape[1] < shape[1]:
+            ws = np.empty(shape, dtype=dtype)
+            self.cache[key] = ws
+        return ws[:, :shape[1]]
+
+_context = None     # the F1Context (or F1ColumnContext) of the current process, see set_context()
+def set_context(context):
+    "sets the context of the current process - used as the initializer of the workers"
+    global _context
+    _context = context
+
+def imap_context(func, xarg, context):
+    """
+    applies func to each element of xarg, with the executor
+    context is sent only once to each worker, where func finds it in the global _context
+    results are returned in any order
+    """
+    return executor.imap_unordered(func, xarg, initializer=set_context, initargs=(context,))
+
+def _do_proc_F1_pair(c0, c1):
+    """
+    given a pair of columns as numpy arrays, return the processed demodued FTed modulused column,
+    its noise level and the denoising rank
+    same as _do_proc_F1_demodu_modu(), using the precomputed values found in the worker context
+    """
+    ctx = _context
+    parameter = ctx.parameter
+    size = ctx.size
+    if c0.max() == 0 and c1.max() == 0:     # empty data - short-cut !
+        return (np.zeros(size//2), 0.0, 0)
+    d = FTICRData(buffer = np.zeros((c0.size, 2)))     # 2 columns - used for hypercomplex modulus 
+    d.buffer[:,0] = c0
+    d.buffer[:,1] = c1
+    d.axis1.itype = 0
+    d.axis2.itype = 1
+    #  if NUS - fill with zeros
+    if ctx.samp is not None:
+        d.axis1.set_sampling(ctx.samp)
+        if parameter.samplingfile_fake:    # samplingfile_fake allows to fake NUS on complete data-sets
+            d.set_buffer(d.get_buffer()[ctx.samp])     # throw points
+        d.zf()                          # add missing points by padding with zeros
+    # perform freq_f1demodu demodulation - as d.f1demodu(rot)
+    c = ctx.ramp(d.size1) * (d.buffer[:,0] + 1j*d.buffer[:,1])
+    d.buffer[:,0] = c.real
+    d.buffer[:,1] = c.imag
+    # clean thru urqrd or sane
+    rank = denoise(d, parameter, ctx.samp, size)
+    # finally do FT - as apod(d, size, axis=1)
+    n = min(d.size1, size)
+    if d.size1 > size:
+        d.chsize(size, d.size2)
+    d.apod_apply(1, ctx.window(n))
+    if d.size1 < size:
+        d.chsize(size, d.size2)
+    rfft_data(d, axis = 1)        # this rfft() is different from npfft.rfft() one !
+    d.modulus()
+    # recover buffer
+    buff = d.col(0).get_buffer()
+    # get staistics
+    mean, std = robust_stats(buff, iterations=10, method=parameter.noise_estimator)
+    # computed ridge and remove
+    if parameter.do_F1 and parameter.do_rem_ridge:
+        buff -= mean
+    # clean for compression
+    if parameter.compress_outfile :
+        threshold = parameter.compress_level * std
+        buff[abs(buff)<threshold] = 0.0
+    return (buff, std, rank)   # return raw data, its noise level and the denoising rank
+
+def _do_proc_F1_block(band, out):
+    """
+    vectorized F1 processing of a block of K pairs of columns : band is (size1, 2K), results go to out, (size//2, K)
+    returns the noise levels of the K processed columns
+    same results as _do_proc_F1_pair() applied to each pair, without per column objects,
+    and using the workspaces of the worker context (see F1Context)
+    denoising (urqrd, sane, pg_sane) is not handled here
+    """
+    ctx = _context
+    parameter = ctx.parameter
+    size = ctx.size
+    half = size//2
+    K = band.shape[1]//2
+    #  if NUS - fill with zeros
+    if ctx.samp is not None:
+        x = ctx.workspace('zf', (ctx.n, 2*K))
+        x[...] = 0.0
+        if parameter.samplingfile_fake:    # samplingfile_fake allows to fake NUS on complete data-sets
+            x[ctx.samp,:] = band[ctx.samp,:]
+        else:
+            x[ctx.samp,:] = band
+    else:
+        x = band
+    # perform freq_f1demodu demodulation
+    z = ctx.workspace('demodu', (ctx.n, K), dtype=complex_type(ctx.dtype))
+    np.multiply(x[:,1::2], 1j, out=z)
+    np.add(z, x[:,0::2], out=z)
+    np.multiply(ctx.ramp(ctx.n)[:,None], z, out=z)     # operand order matters for the last bit
+    # apodisation and zerofilling/truncation to size
+    n = min(ctx.n, size)
+    w = ctx.workspace('apod', (size, 2*K))
+    win = ctx.window(n)[:,None]
+    np.multiply(z.real[:n], win, out=w[:n,0::2])
+    np.multiply(z.imag[:n], win, out=w[:n,1::2])
+    w[n:] = 0.0
+    # FT - with the conventions of NPKData.rfft() - and hypercomplex modulus
+    spec = fft_plan(size, ctx.dtype).rfft(w, axis=0)
+    t = ctx.workspace('modulus', (half, K))
+    np.square(spec.real[:half,0::2], out=out)       # real part of the real column
+    out[0] = (0.5*spec.real[0,0::2])**2
+    np.square(spec.real[:half,1::2], out=t)         # real part of the imaginary column
+    t[0] = (0.5*spec.real[0,1::2])**2
+    out += t
+    np.square(spec.imag[:half,0::2], out=t)         # imaginary part of the real column
+    t[0] = (0.5*spec.real[half,0::2])**2
+    out += t
+    np.square(spec.imag[:half,1::2], out=t)         # imaginary part of the imaginary column
+    t[0] = (0.5*spec.real[half,1::2])**2
+    out += t
+    np.sqrt(out, out=out)
+    # statistics, for all columns at once
+    mean, std = robust_stats(out, iterations=10, axis=0, method=parameter.noise_estimator)
+    # computed ridge and remove
+    if parameter.do_F1 and parameter.do_rem_ridge:
+        out -= mean
+    # clean for compression
+    if parameter.compress_outfile :
+        out[abs(out) < parameter.compress_level*std] = 0.0
+    empty = (band[:,0::2].max(axis=0) == 0) & (band[:,1::2].max(axis=0) == 0)
+    out[:,empty] = 0.0     # empty data
+    std[empty] = 0.0
+    return std
+
+def iterargF1range(ranges, cols=None):
+    """
+    an iterator used by the F1 processing, yields (i0, i1, band) for each range of columns
+    band holds the columns read from cols (see ColumnReader), or is None if the workers read them by themselves
+    """
+    for (i0, i1) in ranges:
+        if cols is None:
+            yield (i0, i1, None)
+        else:
+            yield (i0, i1, cols.cols(i0, i1))
+
+def _do_proc_F1range(data):
+    """
+    given a range of columns, return the processed demodued FTed modulused columns
+    as (i0//2, buffer, noise, ranks), buffer holding one processed column for each pair of columns in the range,
+    noise their noise levels and ranks the ranks used by their denoising (see denoise())
+    uses the worker context (see F1Context)
+    """
+    i0, i1, band = data
+    if band is None:
+        band = np.asarray(worker_open(_context.source).buffer[:, i0:i1], dtype=_context.dtype)
+    npairs = band.shape[1]//2
+    out = np.empty((_context.size//2, npairs), dtype=_context.dtype)
+    noise = np.empty(npairs)
+    ranks = np.zeros(npairs, dtype=int)
+    if _context.vectorized:
+        for k0 in range(0, npairs, _context.npairs):
+            k1 = min(k0+_context.npairs, npairs)
+            noise[k0:k1] = _do_proc_F1_block(band[:,2*k0:2*k1], out[:,k0:k1])
+    else:       # reference code, column by column
+        for k in range(npairs):
+            out[:,k], noise[k], ranks[k] = _do_proc_F1_pair(band[:,2*k], band[:,2*k+1])
+    return (i0//2, out, noise, ranks)
+
+class F1ColumnContext(object):
+    """
+    holds everything the workers need for the F1 processing without demodulation (see do_proc_F1() and do_proc_F1_modu()):
+    parameters, final size and the F1 axis of the columns - sent once to each worker, as F1Context
+    if modulus is True, the columns are processed by pairs, combined by hypercomplex modulus
+    if source is given, the workers read the columns from it by themselves (see worker_open())
+    """
+    def __init__(self, parameter, dinp, size, modulus, source=None):
+        self.parameter = parameter
+        self.size = size
+        self.modulus = modulus
+        self.source = source
+        self.datatype = type(dinp)
+        self.axis1 = dinp.axis1.copy()
+        self.params = getattr(dinp, 'params', None)
+    def col(self, buf):
+        "returns buf as a 1D data-set, as ColumnReader.col() does"
+        c = self.datatype(buffer = buf.copy())
+        c.axis1 = self.axis1.copy()
+        if self.params is not None:
+            c.params = self.params
+        return c
+
+def _do_proc_F1cols(data):
+    """
+    given a range of columns, return (j0, buffer, noise) with the columns processed without demodulation,
+    by _do_proc_F1() or _do_proc_F1_modu() - j0 is the index of the first processed column, a pair of columns giving one with modulus
+    uses the worker context (see F1ColumnContext)
+    """
+    i0, i1, band = data
+    if band is None:
+        band = np.asarray(worker_open(_context.source).buffer[:, i0:i1], dtype=float)
+    size, parameter = _context.size, _context.parameter
+    if _context.modulus:
+        res = [_do_proc_F1_modu((_context.col(band[:,k]), _context.col(band[:,k+1]), size, parameter)) for k in range(0, band.shape[1], 2)]
+        j0 = i0//2
+    else:
+        res = [_do_proc_F1((_context.col(band[:,k]), size, parameter)) for k in range(band.shape[1])]
+        j0 = i0
+    return (j0, np.column_stack([buf for buf, noise in res]), np.array([noise for buf, noise in res]))
+
+def proc_F1_ranges(dinp, writer, parameter, size, modulus, start, scan, first, pbar):
+    """
+    the block F1 processing without demodulation, from column start up to scan of dinp, stored with writer at column -first
+    columns are sent to the workers by ranges, or read by themselves (see worker_reads()), see F1ColumnContext
+    """
+    ranges = column_ranges(dinp, scan, executor.nworkers, start)
+    if worker_reads(dinp, parameter):      # workers get only the column ranges
+        context = F1ColumnContext(parameter, dinp, size, modulus, source=data_source(dinp))
+        cols = None
+    else:
+        context = F1ColumnContext(parameter, dinp, size, modulus)
+        cols = ColumnReader(dinp)
+    def store(res):
+        done = (start//2 if modulus else start) - first
+        for j, buf, noise in res:
+            writer.set_cols(j-first, buf, noise)
+            done += buf.shape[1]
+            pbar.update(done)
+        writer.flush()
+    stats = run_pipeline(lambda xarg: imap_context(_do_proc_F1cols, xarg, context), iterargF1range(ranges, cols), store, parameter, 'F1')
+    pbar.finish()
+    stats.report()
+    report_reader(cols)
+
+def f1demodu_shift(dinp, parameter):
+    "the frequency shift of the F1 demodulation of dinp, which is the offsetfreq of the processed F1 axis"
+    if parameter.freq_f1demodu == 0:   # means not given in .mscf file -> compute from highmass
+        return dinp.axis2.lowfreq   # frequency shift in points, computed from lowfreq of excitation pulse - assumiing the pulse was from high to low !
+    return parameter.freq_f1demodu
+
+def do_proc_F1_demodu_modu(dinp, doutp, parameter, pyramid=None, start=0):
+    """
+    as do_proc_F1, but applies demodu and then complex modulus() at the end
+    if pyramid is given (see stream_pyramid()), the processed columns are fed to it as they are written
+    processing starts at column start of doutp
+    """
+    size1, size2, i0, i1, j0, j1 = roi_window(doutp)
+    size = 2*size1
+    scan =  min(dinp.size2//2-j0, doutp.size2)
     F1widgets = ['Processing F1 demodu-modulus: ', widgets.Percentage(), ' ', widgets.Bar(marker='-',left = '[',right = ']'), widgets.ETA()]
     pbar= pg.ProgressBar(widgets = F1widgets, maxval = scan).start() #, fd=sys.stdout)
 
-    if parameter.freq_f1demodu == 0:   # means not given in .mscf file -> compute from highmass
-        hshift = dinp.axis2.lowfreq   # frequency shift in points, computed from lowfreq of excitation pulse - assumiing the pulse was from high to low !
-    else:
-        hshift = parameter.freq_f1demodu
+    hshift = f1demodu_shift(dinp, parameter)
     shift = doutp.axis1.htoi(hshift)
     rot = dinp.axis1.htoi( hshift )       # rot correction is applied in the starting space
     # sampling
@@ -484,44 +1433,68 @@ def do_proc_F1_demodu_modu(dinp, doutp, parameter):
     if debug>0: print("LEFT_POINT", shift)
     doutp.axis1.offsetfreq = hshift
 
-    xarg = iterarg(dinp, rot, size, parameter)      # construct iterator for main loop
-    if parameter.mp:  # means multiprocessing //
-        res = Pool.imap(_do_proc_F1_demodu_modu, xarg)
-        for i,buf in enumerate(res):
-            doutp.buffer[:,i] = buf
-#            doutp.set_col(i,p)
-            pbar.update(i+1)
-    elif mpiutil.MPI_size > 1:      # code for MPI processing //
-        res = mpiutil.enum_imap(_do_proc_F1_demodu_modu, xarg)    # apply it
-        for i,buf in res:       # and get results
-            doutp.buffer[:,i] = buf
-#            doutp.set_col(i, p)
-            pbar.update(i+1)
+    progress = Progress(doutp, 'F1', start)
+    writer = column_writer(doutp, parameter, pyramid, progress, start)
+    denoising = getattr(doutp, 'denoising', None)      # see DenoisingStats
+    if parameter.block_processing:      # columns are processed by ranges, using a shared worker context
+        ranges = column_ranges(dinp, 2*(j0+scan), executor.nworkers, 2*(j0+start), float_type(parameter))
+        if worker_reads(dinp, parameter):      # workers get only the column ranges
+            context = F1Context(parameter, dinp, rot, size, source=data_source(dinp))
+            cols = None
+        else:
+            context = F1Context(parameter, dinp, rot, size)
+            cols = ColumnReader(dinp, dtype=context.dtype)
+        def store(res):
+            done = start
+            for j, buf, noise, ranks in res:
+                writer.set_cols(j-j0, buf, noise)
+                if denoising is not None:
+                    denoising.set_ranks(j-j0, ranks)
+                done += buf.shape[1]
+                pbar.update(done)
+            writer.flush()
+        stats = run_pipeline(lambda xarg: imap_context(_do_proc_F1range, xarg, context), iterargF1range(ranges, cols), store, parameter, 'F1')
+        pbar.finish()
+        stats.report()
+        report_reader(cols)
+        report_denoising(denoising)
+        return
+    cols = column_reader(dinp, parameter)
+    xarg = iterarg(dinp, rot, size, parameter, cols, 2*(j0+start), 2*(j0+scan))      # construct iterator for main loop
+    def store(res):
+        done = start
+        for i, (buf, noise, rank) in res:
+            writer.set_col(i, buf, noise)
+            if denoising is not None:
+                denoising.set_ranks(i, [rank])
+            done += 1
+            pbar.update(done)
             if interfproc:
                 output = open('InterfProc/progbar.pkl', 'wb')
-                pb = ['F1', int((i+1)/float(scan)*100)]
+                pb = ['F1', int(done/float(scan)*100)]
                 pickle.dump(pb, output) # for Qt progressbar
                 output.close()
-        if interfproc:
-            output = open('InterfProc/progbar.pkl', 'wb')
-            pb = ['end']
-            pickle.dump(pb, output) # for Qt progressbar
-            output.close()
-    else:       # plain non //
-        res = imap(_do_proc_F1_demodu_modu, xarg)
-        for i,buf in enumerate(res):
-            doutp.buffer[:,i] = buf
-#            doutp.set_col(i,p)
-            pbar.update(i+1)
+        writer.flush()
+    stats = run_pipeline(functools.partial(enum_imap_start, _do_proc_F1_demodu_modu, start=start), xarg, store, parameter, 'F1')
+    if interfproc:
+        output = open('InterfProc/progbar.pkl', 'wb')
+        pb = ['end']
+        pickle.dump(pb, output) # for Qt progressbar
+        output.close()
     pbar.finish()
+    stats.report()
+    report_reader(cols)
+    report_denoising(denoising)
 
-def do_process2D(dinp, datatemp, doutp, parameter):
+def do_process2D(dinp, datatemp, doutp, parameter, pyramid=None, f2start=0, f1start=0):
     """
     apply the processing to an input 2D data set : dinp
     result is found in an output file : doutp
     
     dinp and doutp should have been created before, size of doutp will determine the processing
     will use a temporay file if needed
+    pyramid, if given, receives the F1 processed columns (see Projections and stream_pyramid())
+    f2start and f1start are the first row and column to process, when resuming an interrupted processing
     """
     if debug>1:
         for f,d in ((parameter.infile, dinp), (parameter.interfile, datatemp), (parameter.outfile, doutp)):
@@ -529,40 +1502,52 @@ def do_process2D(dinp, datatemp, doutp, parameter):
             print(d)
     # in F2
     t00 = time.time()
-    if parameter.do_F2:
+    if parameter.do_F2 and f2start >= min(dinp.size1, datatemp.size1):
+        print("######### F2 already done - skipped")
+    elif parameter.do_F2:
         print("######### processing in F2")
+        if f2start > 0:
+            print("resuming at row %d"%f2start)
         print("""------ From:
 %s
 ------ To:
 %s
 """%(dinp.report(), datatemp.report()) )
-        do_proc_F2mp(dinp, datatemp, parameter)
+        if parameter.block_processing:
+            do_proc_F2block(dinp, datatemp, parameter, f2start)
+        else:
+            do_proc_F2mp(dinp, datatemp, parameter, f2start)
         print_time(time.time()-t00, "F2 processing time")
     # in F1
     if parameter.do_F1:
+        if parameter.worker_read and executor.remote:
+            datatemp = reopen_readonly(datatemp)      # so that workers can read it
         print("######### processing in F1")
         print("""------ From
 %s
 ------ To:
 %s
 """%(datatemp.report(), doutp.report()) )
+        if f1start > 0:
+            print("resuming at column %d"%f1start)
         t0 = time.time()
         if parameter.do_f1demodu and parameter.do_modulus:
-            do_proc_F1_demodu_modu(datatemp, doutp, parameter)
+            do_proc_F1_demodu_modu(datatemp, doutp, parameter, pyramid, f1start)
         elif parameter.do_modulus:
-            do_proc_F1_modu(datatemp, doutp, parameter)
+            do_proc_F1_modu(datatemp, doutp, parameter, pyramid, f1start)
         else:
-            do_proc_F1(datatemp, doutp, parameter)
+            do_proc_F1(datatemp, doutp, parameter, pyramid, f1start)
         print_time(time.time()-t0, "F1 processing time")
     print_time(time.time()-t00, "F1-F2 processing time")
 
-def downsample2D(data, outp, n1, n2, compress=False, compress_level=3.0):
+def downsample2D(data, outp, n1, n2, compress=False, compress_level=3.0, method=None):
     """
     takes data (a 2D) and generate a smaller dataset downsampled by factor (n1,n2) on each axis
     then returned data-set is n1*n2 times smaller
     - do a filtered decimation along n2
     - simply takes the mean along n1
     - set to zero all entries below 3*sigma if compress is True
+      sigma is estimated with the given method (see noise_estimate.py)
     ** Not fully tested on non powers of 2 **
     """
     if debug>0: print("in downsample2D : %s x %s"%(n1,n2))
@@ -579,16 +1564,303 @@ def downsample2D(data, outp, n1, n2, compress=False, compress_level=3.0):
             temp += yy
         temp *= (1.0/n1)
         if compress:
-            b = temp.copy()
-            for j in range(3):
-                b = b[ b-b.mean()<3*b.std() ]
-            threshold = compress_level * b.std()    # compress_level * b.std()  is 3*sigma by default
+            mean, std = robust_stats(temp, iterations=3, method=method)
+            threshold = compress_level * std    # compress_level * std  is 3*sigma by default
             temp[abs(temp)<threshold] = 0.0
         outp.buffer[i//n1,:] = temp
     copyaxes(data, outp)
     outp.adapt_size()
     return outp
 
+def create_pyramid(hfar, d1, allsizes, create=True):
+    """
+    creates in hfar the groups holding the downsampled versions of d1, at the sizes given in allsizes
+    returns a list of (group, data, n1, n2), each level being downsampled by (n1, n2) from the previous one
+    if create is False, the groups already present in hfar are used
+    """
+    levels = []
+    downprevious = d1
+    for (i, (sizeF1, sizeF2)) in enumerate(allsizes):
+        if (downprevious.size1%sizeF1) != 0 or  (downprevious.size2%sizeF2) != 0:
+            print("downsampling not available for level %d : %d x %d -> %d x %d"%((i+1), downprevious.size1, downprevious.size2, sizeF1, sizeF2))
+            continue
+        group = 'resol%d'%(i+2)     # +2 because we poped the first value
+        down = FTICRData( dim = 2 )   # create dummy 2D
+        copyaxes(d1, down)        # copy axes from d1 to down
+        down.axis1.size = sizeF1
+        down.axis2.size = sizeF2
+        down.axis1.left_point = d1.axis1.left_point*sizeF1/d1.size1      # d1 cropped to a region of interest (see crop_roi())
+        down.axis2.left_point = d1.axis2.left_point*sizeF2/d1.size2
+        if create:
+            hfar.create_from_template(down, group)
+        else:
+            hfar.load(group)
+            down.buffer = hfar.data.buffer
+        if debug > 0: print(group, down)
+        levels.append( (group, down, downprevious.size1//sizeF1, downprevious.size2//sizeF2) )
+        downprevious = down
+    return levels
+
+class StreamDownsampler(object):
+    """
+    builds one level of the multiresolution pyramid from the columns of the level above, received by blocks while they are produced.
+    as in downsample2D(), rows are averaged by groups of n1, and rows are decimated by n2 with the FIR filter of scipy.signal.decimate()
+    so the level is complete as soon as the last column of the level above is received.
+    when compress is True, the threshold is computed on each row of every block of columns written.
+    blocks may arrive in any order, the decimated columns are passed in order to nextlevel if given.
+    """
+    def __init__(self, outp, n1, n2, compress=False, compress_level=3.0, nextlevel=None, blockmem=BLOCKMEM, method=None):
+        self.outp = outp
+        self.n1 = n1
+        self.n2 = n2
+        self.size2in = n2*outp.size2    # number of columns in the level above
+        self.compress = compress
+        self.compress_level = compress_level
+        self.method = method
+        self.next = nextlevel
+        if n2 > 1:
+            self.half = 10*n2           # as in scipy.signal.decimate()
+            self.taps = firwin(2*self.half+1, 1./n2, window='hamming')
+        else:
+            self.half = 0
+            self.taps = np.ones(1)
+        self.xp = np.zeros((outp.size1, self.half))   # received columns not used yet, zero padded on the left
+        self.xstart = 0         # index of xp[:,0] in the padded list of columns
+        self.received = 0       # number of columns received in order
+        self.waiting = {}       # blocks received out of order
+        self.nout = 0           # number of columns computed
+        self.written = 0        # number of columns written
+        self.stage = []         # computed columns waiting to be written
+        try:
+            cw = outp.buffer.chunkshape[1]
+        except AttributeError:
+            cw = 1
+        self.width = cw*max(1, blockmem//(4*cw*self.xp.itemsize*outp.size1))   # columns are written by blocks of chunks
+    def push(self, start, block):
+        "receives the columns [start, start+block.shape[1]] of the level above"
+        if start != self.received:
+            self.waiting[start] = block
+            return
+        self._push(block)
+        while self.received in self.waiting:
+            self._push(self.waiting.pop(self.received))
+    def _push(self, block):
+        "processes the next block of columns"
+        self.received += block.shape[1]
+        if self.n1 > 1:     # mean along F1
+            block = block.reshape((self.outp.size1, self.n1, block.shape[1])).sum(axis=1)*(1.0/self.n1)
+        tail = [self.xp, block]
+        if self.received == self.size2in:       # last one, zero pad on the right
+            tail.append(np.zeros((self.outp.size1, self.half)))
+        self.xp = np.concatenate(tail, axis=1)
+        self._decimate()
+    def _decimate(self):
+        "computes all the output columns available from the columns received"
+        q = self.n2
+        avail = self.xstart + self.xp.shape[1]      # padded columns received
+        mmax = min(self.outp.size2, (avail-2*self.half-1)//q + 1)  # column m needs padded columns m*q ... m*q+2*half
+        nm = mmax - self.nout
+        if nm > 0:
+            y = np.zeros((self.outp.size1, nm))
+            first = self.nout*q - self.xstart
+            for j, h in enumerate(self.taps):
+                y += h*self.xp[:, first+j : first+j+(nm-1)*q+1 : q]
+            self.nout = mmax
+            self.xp = self.xp[:, mmax*q-self.xstart:]       # drop what is not needed anymore
+            self.xstart = mmax*q
+            self.stage.append(y)
+        staged = self.nout - self.written
+        if staged >= self.width or (self.nout == self.outp.size2 and staged > 0):
+            self._write(np.concatenate(self.stage, axis=1))
+            self.stage = []
+    def _write(self, y):
+        "thresholds and stores the computed columns, and send them to the next level"
+        if self.compress:      # robust per-row noise estimate, as in downsample2D()
+            mean, std = robust_stats(y, iterations=3, axis=1, method=self.method)
+            y[abs(y) < self.compress_level*std[:,None]] = 0.0
+        self.outp.buffer[:, self.written:self.written+y.shape[1]] = y
+        if self.next is not None:
+            self.next.push(self.written, y)
+        self.written += y.shape[1]
+    def complete(self):
+        "True if this level, and all levels below, are completely computed and stored"
+        done = (self.written == self.outp.size2)
+        if self.next is not None:
+            done = done and self.next.complete()
+        return done
+
+class Projections(object):
+    """
+    computes, from the columns of the processed data-set d1 received by blocks while they are produced,
+    the max projections along F1 and F2, and the diagonal - the points at the same m/z along F1 and F2.
+    as in the LC-MS import, projections are never negative.
+    blocks may arrive in any order, and are then passed to nextlevel (see stream_pyramid()) if given
+    """
+    GROUPS = ('diagonal', 'projectionF1', 'projectionF2')
+    def __init__(self, d1, nextlevel=None):
+        self.d1 = d1
+        self.next = nextlevel
+        self.proj1 = np.zeros(d1.size1)
+        self.proj2 = np.zeros(d1.size2)
+        self.diag = np.zeros(d1.size2)
+        self.rows = None
+    def diagonal_rows(self):
+        "the row index of the diagonal point in each column, -1 when the m/z of the column is not in F1"
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            mz = self.d1.axis2.itomz(np.arange(self.d1.size2))
+            rows = np.round(self.d1.axis1.mztoi(mz))
+        rows[~np.isfinite(rows)] = -1
+        rows[(rows < 0) | (rows >= self.d1.size1)] = -1
+        return rows.astype(int)
+    def push(self, start, block):
+        "receives the columns [start, start+block.shape[1]] of d1"
+        if self.rows is None:       # on the first block, once the F1 axis is final (offsetfreq)
+            self.rows = self.diagonal_rows()
+        stop = start + block.shape[1]
+        np.maximum(self.proj1, block.max(axis=1), out=self.proj1)
+        self.proj2[start:stop] = np.maximum(block.max(axis=0), 0.0)
+        rows = self.rows[start:stop]
+        cols = np.flatnonzero(rows >= 0)
+        self.diag[start+cols] = block[rows[cols], cols]
+        if self.next is not None:
+            self.next.push(start, block)
+    def scan(self, blockmem=BLOCKMEM):
+        "computes the projections from d1, read by bands of columns - when they were not computed during F1"
+        try:
+            cw = self.d1.buffer.chunkshape[1]
+        except AttributeError:
+            cw = 1
+        width = cw*max(1, blockmem//(itemsize(self.d1)*cw*self.d1.size1))
+        for j0 in range(0, self.d1.size2, width):
+            self.push(j0, np.asarray(self.d1.buffer[:, j0:j0+width]))
+    def store(self, hf):
+        "stores the diagonal and the projections as 1D data-sets in hf, in the groups GROUPS"
+        for group, axis, values in zip(self.GROUPS, (self.d1.axis2, self.d1.axis1, self.d1.axis2), (self.diag, self.proj1, self.proj2)):
+            if group in hf.hf.root:     # left by a previous run
+                hf.hf.remove_node('/'+group, recursive=True)
+            d = FTICRData(dim=1)
+            d.axis1 = axis.copy()
+            hf.create_from_template(d, group=group)
+            d.buffer[:] = values
+        hf.flush()
+
+def stream_pyramid(levels, compress=False, compress_level=3.0, method=None):
+    """
+    builds the chain of StreamDownsampler computing the levels created by create_pyramid()
+    returns the first one, to be fed with the columns of resol1 as they are produced, None if there are no levels
+    """
+    first = None
+    for (group, down, n1, n2) in reversed(levels):
+        first = StreamDownsampler(down, n1, n2, compress=compress, compress_level=compress_level, nextlevel=first, method=method)
+    return first
+
+def downsample_pyramid(d1, levels, pyramid, parameter):
+    "computes the levels created by create_pyramid() from d1, unless pyramid, given by stream_pyramid(), already did it"
+    if pyramid is not None and pyramid.complete():
+        print("downsampled levels %s computed during F1"%(", ".join(grp for (grp, down, n1, n2) in levels)))
+        return
+    downprevious = d1       # used to downsample by step   downprevious -downto-> down
+    t0 = time.time()
+    for (grp, down, n1, n2) in levels:
+        print("downsampling %s  (%d x %d)" % (grp, down.size1, down.size2) )
+        downsample2D(downprevious, down, n1, n2, compress=parameter.compress_outfile, method=parameter.noise_estimator)
+        downprevious = down
+    print_time(time.time()-t0, "Downsampling time")
+
+def noise_node(hfar, data, group="resol1"):
+    """
+    returns the array of the noise levels of the columns of data, measured during F1 (see ColumnWriter),
+    stored in hfar next to the data as group/noise - created empty if missing
+    """
+    hgroup = hfar.hf.get_node('/'+group)
+    if 'noise' not in hgroup:
+        hfar.hf.create_carray(hgroup, 'noise', tables.Float64Atom(), (data.size2,), title="noise level of the columns")
+    return hgroup._f_get_child('noise')
+
+class DenoisingStats(object):
+    """
+    the ranks used by the F1 denoising of the columns of data (see denoise()), stored in hfar next to the data as group/denoising,
+    0 for the columns not denoised, -1 for the columns not processed yet, so that the statistics cover resumed processings
+    the work of the denoising being proportional to its rank, report() shows the work saved by adaptive_denoising
+    """
+    def __init__(self, hfar, data, parameter, group="resol1"):
+        self.nominal = denoising_rank(parameter)
+        hgroup = hfar.hf.get_node('/'+group)
+        if 'denoising' not in hgroup:
+            hfar.hf.create_carray(hgroup, 'denoising', tables.Int32Atom(dflt=-1), (data.size2,), title="rank of the denoising of the columns")
+        self.node = hgroup._f_get_child('denoising')
+        self.ranks = self.node[:]
+    def set_ranks(self, i0, ranks):
+        "the columns starting at i0 were denoised with ranks"
+        self.ranks[i0:i0+len(ranks)] = ranks
+    def work_saved(self):
+        "the fraction of the denoising work saved on the columns processed, compared with the rank of the parameters"
+        done = self.ranks[self.ranks >= 0]
+        if len(done) == 0 or self.nominal == 0:
+            return 0.0
+        return 1.0 - done.sum()/(self.nominal*len(done))
+    def report(self):
+        "print the statistics"
+        done = self.ranks[self.ranks >= 0]
+        print("denoising : %d columns, %d not denoised, %d with a reduced rank, mean rank %.1f (nominal %d)"%(
+            len(done), (done == 0).sum(), ((done > 0) & (done < self.nominal)).sum(), done.mean() if len(done) else 0.0, self.nominal))
+        print("   %.1f %% of the denoising work saved"%(100*self.work_saved()))
+    def save(self):
+        "stores the ranks and the summary in the file"
+        self.node[:] = self.ranks
+        self.node.attrs.nominal_rank = self.nominal
+        self.node.attrs.work_saved = self.work_saved()
+        self.node._v_file.flush()
+
+def column_thresholds(data, level):
+    """
+    the peak picking thresholds of the columns of data : level x the noise levels of data.noise (see noise_node())
+    columns with an unknown noise level use the median of the others
+    """
+    noise = np.asarray(data.noise[:], dtype=float)
+    known = noise > 0
+    if known.any() and not known.all():
+        noise[~known] = np.median(noise[known])
+    return level*noise
+
+def peak_tiles(data, tilemem=BLOCKMEM//8):
+    "the (tile1, tile2) size of the peak picking tiles of data, multiples of its chunks, about tilemem bytes"
+    try:
+        c1, c2 = data.buffer.chunkshape
+    except AttributeError:
+        c1, c2 = 1, 1
+    npoints = tilemem//8
+    tile1 = min(data.size1, c1*max(1, int(math.sqrt(npoints))//c1))
+    tile2 = min(data.size2, c2*max(1, (npoints//tile1)//c2))
+    return (tile1, tile2)
+
+def iterargPP(data, threshold, parameter):
+    "an iterator used by the peak picking, yields the tiles of data (see peak_tiles()) with their margins and thresholds"
+    tile1, tile2 = peak_tiles(data)
+    for (i0, i1, j0, j1) in tiles(data.size1, data.size2, tile1, tile2):
+        tile = np.asarray(data.buffer[i0-1:i1+1, j0-1:j1+1], dtype=float)
+        yield (tile, threshold[j0-1:j1+1], parameter.centroid, (i0-1, j0-1))
+
+def _do_peak_tile(data):
+    "peak picking of a tile - called by the mp loop"
+    tile, threshold, centroid, offset = data
+    return pick_tile(tile, threshold, centroid=centroid, offset=offset)
+
+def do_peak_picking(data, parameter):
+    """
+    tiled peak picking of the processed 2D data, tiles are processed in parallel, with the executor
+    thresholds are given by the noise levels of the columns measured during F1 (see column_thresholds())
+    returns the table of peaks, sorted by decreasing intensity (see peak_picking.py)
+    """
+    threshold = column_thresholds(data, parameter.peakpicking_noise_level)
+    found = []
+    def store(res):
+        for peaks in res:
+            found.append(peaks)
+    stats = run_pipeline(functools.partial(executor.imap_unordered, _do_peak_tile), iterargPP(data, threshold, parameter), store, parameter, 'peak picking')
+    stats.report()
+    return merge_peaks(found)
+
 def load_input(name):
     """load input file and returns it, in read-only mode"""
     if debug>0: print("reading", name)
@@ -597,6 +1869,226 @@ def load_input(name):
     d0.hdf5file = hf
     return d0
 
+def open_for_resume(name, group="resol1"):
+    """opens the file name in read-write mode, and returns (hdf5file, data) - used to resume a processing"""
+    if debug>0: print("reopening", name)
+    hf = HDF5File(name, "rw")
+    hf.load(group)
+    data = hf.data
+    data.hdf5file = hf
+    return (hf, data)
+
+def reopen_readonly(data):
+    """
+    closes the file holding data, and reopens it in read-only mode so that other processes can access it
+    returns the new data
+    """
+    if hasattr(data, 'shared'):         # in shared memory or in a raw file
+        data.shared.flush()
+        return data
+    if not hasattr(data, 'hdf5file') or data.hdf5file.hf.mode == 'r':      # in memory, or already read-only
+        return data
+    params = getattr(data, 'params', {})
+    fname = data.hdf5file.fname
+    data.hdf5file.close()
+    data = load_input(fname)
+    data.params = params
+    return data
+
+class SharedArray(object):
+    """
+    a 2D array of float allocated in shared memory, used to keep the intermediate data in memory in multiprocessing mode
+    only its name and shape are pickled, so the workers attach to the same memory, without copy
+    the array is available as self.buffer
+    """
+    def __init__(self, shape, dtype=float):
+        from multiprocessing import shared_memory
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.dtype.itemsize*self.shape[0]*self.shape[1])
+        self.name = self.shm.name
+        self.owner = True
+        self.buffer = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.buffer[...] = 0.0
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory, resource_tracker
+        self.__dict__.update(state)
+        self.owner = False
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.name, track=False)
+        except TypeError:       # python < 3.13, the memory would be released when the worker exits
+            self.shm = shared_memory.SharedMemory(name=self.name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.buffer = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+    ondisk = False      # not visible by MPI processes
+    def flush(self):
+        "nothing to do, the memory is shared"
+        pass
+    def release(self):
+        "frees the memory - the array cannot be used anymore"
+        self.buffer = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class MappedArray(object):
+    """
+    a 2D array of float stored in a raw file, accessed with np.memmap,
+    used for the intermediate data when tempformat is raw - no chunking, no metadata, no locking
+    as for SharedArray, only the file name and shape are pickled, the workers map the file in read-only mode
+    """
+    ondisk = True
+    def __init__(self, fname, shape, dtype=float):
+        self.name = fname
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = True
+        self.buffer = np.memmap(fname, dtype=self.dtype, mode='w+', shape=self.shape)
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.owner = False
+        self.buffer = np.memmap(self.name, dtype=self.dtype, mode='r', shape=self.shape)
+    def flush(self):
+        "writes the modified pages to the file"
+        if self.owner:
+            self.buffer.flush()
+    def release(self):
+        "unmaps, and removes the file if it was created here"
+        self.buffer = None
+        if self.owner:
+            os.unlink(self.name)
+
+def intermediate_type(parameter):
+    """
+    the type of the intermediate data when it is kept in memory or in a raw file - msh5 files are always in float64
+    float32 in single precision, if F1 is done with F1Context, as other F1 codes build FTICRData columns, which have to be float64
+    """
+    if parameter.block_processing and parameter.do_f1demodu and parameter.do_modulus:
+        return float_type(parameter)
+    return np.float64
+
+def intermediate_in_memory(datatemp, parameter):
+    """
+    allocates the buffer of datatemp in memory if it fits in parameter.memory_budget (in MB),
+    in shared memory with the processes executor (see SharedArray)
+    returns True if done, False if datatemp has to go on file
+    """
+    dtype = intermediate_type(parameter)
+    if np.dtype(dtype).itemsize*datatemp.size1*datatemp.size2 > parameter.memory_budget*1024*1024:
+        return False
+    if executor.backend == 'processes':
+        datatemp.shared = SharedArray((datatemp.size1, datatemp.size2), dtype)
+        datatemp.buffer = datatemp.shared.buffer
+    else:
+        datatemp.buffer = np.zeros((datatemp.size1, datatemp.size2), dtype=dtype)
+    return True
+
+def data_source(data):
+    "what the workers need to access data by themselves (see worker_open()) : a SharedArray, a MappedArray, a SerFile or a file name"
+    try:
+        return data.shared
+    except AttributeError:
+        return data.hdf5file.fname
+
+_worker_data = {}   # data-sets opened by the worker processes, indexed by file name
+def worker_open(source):
+    """
+    opens (once per process) source, and returns the data it contains
+    source is either a file name, opened in read-only mode, a SharedArray, a MappedArray or a SerFile (see data_source())
+    """
+    key = getattr(source, 'name', source)
+    try:
+        return _worker_data[key]
+    except KeyError:
+        if isinstance(source, (SharedArray, MappedArray, SerFile)):
+            _worker_data[key] = source
+        else:
+            _worker_data[key] = load_input(source)
+        return _worker_data[key]
+
+def worker_reads(data, parameter):
+    """
+    True if, in the current set-up, the workers read data from its file or shared memory by themselves
+    HDF5 files are never read from several threads
+    """
+    if not parameter.worker_read or not executor.parallel:
+        return False
+    if hasattr(data, 'shared'):
+        return executor.backend == 'processes' or data.shared.ondisk
+    if not executor.remote:
+        return False
+    try:
+        return data.hdf5file.hf.mode == 'r'
+    except AttributeError:
+        return False
+
+def quicklook_data(d0, step, truncate):
+    """
+    returns an in-memory copy of the first 1/step of the transients of d0, each one truncated to 1/truncate of its length
+    the spectral widths are kept, so that the m/z axes are the ones of d0, at a lower resolution
+    """
+    n1 = max(2, 2*(d0.size1//(2*step)))
+    n2 = max(2, 2*(d0.size2//(2*truncate)))
+    dq = FTICRData(buffer=np.asarray(d0.buffer[0:n1, 0:n2], dtype=float))
+    copyaxes(d0, dq)
+    dq.axis1.size = n1
+    dq.axis2.size = n2
+    dq.params = d0.params
+    return dq
+
+def quick_look(d0, parameter, configfile=None):
+    """
+    processes a reduced version of d0 (see quicklook_data()) into the provisional file parameter.quicklook_file,
+    without denoising nor peak picking, the intermediate data being kept in memory
+    the file holds the same groups as the final one, and can be opened by the viewers while the full processing goes on
+    d0 is only read, so that the full processing continues from the same import
+    """
+    qparam = copy.copy(parameter)
+    qparam.do_urqrd = qparam.do_sane = False
+    qparam.peakpicking = False
+    dq = quicklook_data(d0, parameter.quicklook_step, parameter.quicklook_truncate)
+    allsizes = comp_sizes(dq, zflist=qparam.zflist, szmlist=qparam.szmlist, largest=qparam.largest, dtype=float_type(qparam))
+    (sizeF1, sizeF2) = allsizes.pop(0)
+    datatemp = FTICRData(dim = 2)
+    copyaxes(dq, datatemp)
+    datatemp.axis1.size = min(dq.size1, sizeF1)
+    datatemp.axis2.size = 2*sizeF2 if qparam.do_modulus else sizeF2
+    if not intermediate_in_memory(datatemp, qparam):
+        raise Exception("the quick-look does not fit in memory_budget, increase quicklook_step or quicklook_truncate")
+    datatemp.params = dq.params
+    d1 = FTICRData(dim = 2)
+    copyaxes(dq, d1)
+    d1.axis1.size = sizeF1
+    d1.axis2.size = sizeF2
+    allsizes = region_of_interest(dq, d1, qparam, allsizes)
+    print("quick-look of %d x %d points, processed to %d x %d, in %s"%(dq.size1, dq.size2, d1.size1, d1.size2, qparam.quicklook_file))
+    hfar = HDF5File(qparam.quicklook_file, "w")
+    if qparam.compress_outfile:
+        hfar.set_compression(True)
+    hfar.create_from_template(d1, 'resol1')
+    levels = create_pyramid(hfar, d1, allsizes)
+    d1.params = dq.params
+    d1.noise = noise_node(hfar, d1)
+    if qparam.block_processing:
+        pyramid = stream_pyramid(levels, compress=qparam.compress_outfile, method=qparam.noise_estimator)
+    else:
+        pyramid = None
+    projections = Projections(d1, nextlevel=pyramid)
+    do_process2D(dq, datatemp, d1, qparam, projections)
+    if hasattr(datatemp, 'shared'):
+        datatemp.shared.release()
+    for grp in ['resol1'] + [grp for (grp, down, n1, n2) in levels]:
+        hfar.axes_update(group = grp, axis = 1, infos = {'offsetfreq':d1.axis1.offsetfreq} )
+    projections.store(hfar)
+    downsample_pyramid(d1, levels, pyramid, qparam)
+    if configfile is not None:
+        hfar.store_internal_file(filename=configfile, h5name="config.mscf", where='/attached')
+    hfar.close()
+
 class Proc_Parameters(object):
     """this class is a container for processing parameters"""
     def __init__(self, configfile=None, verif=True):
@@ -620,22 +2112,48 @@ class Proc_Parameters(object):
         self.pgsane_rank = 10
         self.pgsane_iterations = 10
         self.pgsane_threshold = 2.0   # this was previously hard-coded to 2.0
+        self.adaptive_denoising = False
+        self.adaptive_threshold = 6.0
         self.zflist = None
         self.szmlist = None
+        self.f1_mz_range = None
+        self.f2_mz_range = None
+        self.quicklook = False
+        self.quicklook_step = 8
+        self.quicklook_truncate = 4
+        self.quicklook_file = None
         self.mp = False
         self.nproc = 4
+        self.executor = 'serial'
+        self.blas_threads = 1
+        self.prefetch = 4
+        self.block_processing = True
+        self.worker_read = True
+        self.vectorized_F1 = True
+        self.noise_estimator = 'clip'
         # files param
         self.apex = None
         self.format = None
+        self.create_infile = False
+        self.compress_infile = False
         self.infile = None
         self.interfile = None
         self.outfile = None
         self.compress_outfile = True
+        self.sparse_outfile = False
         self.compress_level = 1.0
         self.samplingfile = None
         self.samplingfile_fake = False
         self.tempdir = "/tmp/processing/"
         self.largest = LARGESTDATA
+        self.memory_budget = 1024.0     # in MB
+        self.tempformat = 'hdf5'
+        self.precision = 'double'
+        # peak picking param
+        self.peakpicking = False
+        self.peakpicking_noise_level = 10.0
+        self.centroid = True
+        self.fft_tolerance = 0.0
         self.freq_f1demodu = 0.0
         
         if configfile:
@@ -665,10 +2183,19 @@ class Proc_Parameters(object):
         self.apex =    cp.get( "import", "apex", '.')                                   # input file
         self.format =    cp.get( "import", "format", default="Solarix")                 # use format Apex or Solarix
         self.infile =  cp.get( "processing", "infile", './ser.msh5')                    # input file
+        self.create_infile = cp.getboolean( "processing", "create_infile", str(self.create_infile))   # import into infile if missing
+        self.compress_infile = cp.getboolean( "processing", "compress_infile", str(self.compress_infile))
         self.interfile = cp.get( "processing", "interfile", None)                       # intermediatefile
         self.outfile = cp.get( "processing", "outfile")                                 # output file
+        self.quicklook = cp.getboolean( "processing", "quicklook", str(self.quicklook))   # provisional reduced 2D first
+        self.quicklook_step = cp.getint( "processing", "quicklook_step", self.quicklook_step)
+        self.quicklook_truncate = cp.getint( "processing", "quicklook_truncate", self.quicklook_truncate)
+        if self.outfile:
+            self.quicklook_file = os.path.splitext(self.outfile)[0]+"_quicklook.msh5"
+        self.quicklook_file = cp.get( "processing", "quicklook_file", self.quicklook_file)
         self.compress_outfile = cp.getboolean( "processing", "compress_outfile", str(self.compress_outfile))
         self.compress_level = cp.getfloat( "processing", "compress_level", self.compress_level)
+        self.sparse_outfile = cp.getboolean( "processing", "sparse_outfile", str(self.sparse_outfile))   # see sparse_store.py
         self.tempdir = cp.get( "processing", "tempdir", ".")                            # dir for temporary file
         self.samplingfile = cp.get( "processing", "samplingfile")
         if self.samplingfile == "None":
@@ -676,6 +2203,10 @@ class Proc_Parameters(object):
         self.samplingfile_fake = cp.getboolean( "processing", "samplingfile_fake", str(self.samplingfile_fake))
         self.largest = cp.getint( "processing", "largest_file", 8*LARGESTDATA)            # largest allowed file
         self.largest = self.largest//8                                                   # in byte in the configfile, internally in word
+        self.memory_budget = cp.getfloat( "processing", "memory_budget", self.memory_budget)   # in MB, for the in-memory intermediate
+        self.tempformat = cp.get( "processing", "tempformat", self.tempformat)         # format of the temporary intermediate file
+        self.precision = cp.get( "processing", "precision", self.precision)             # double or single
+        self.fft_tolerance = cp.getfloat( "processing", "fft_tolerance", self.fft_tolerance)   # size tuning, 0 is off
         self.do_modulus = cp.getboolean( "processing", "do_modulus", str(self.do_modulus))   # do_modulus
         self.do_f1demodu = cp.getboolean( "processing", "do_f1demodu", str(self.do_f1demodu))       # do_f1demodu
         self.freq_f1demodu = cp.getfloat( "processing", "freq_f1demodu")        # freq for do_f1demodu
@@ -689,11 +2220,23 @@ class Proc_Parameters(object):
         self.pgsane_rank = cp.getint( "processing", "pgsane_rank", self.pgsane_rank)       # do_pgsane
         self.pgsane_iterations = cp.getint( "processing", "pgsane_iterations", self.pgsane_iterations)       # do_pgsane
         self.pgsane_threshold = cp.getfloat( "processing", "pgsane_threshold", self.pgsane_threshold)       # do_pgsane
+        self.adaptive_denoising = cp.getboolean( "processing", "adaptive_denoising", str(self.adaptive_denoising))   # rank per column
+        self.adaptive_threshold = cp.getfloat( "processing", "adaptive_threshold", self.adaptive_threshold)
         self.do_rem_ridge = cp.getboolean( "processing", "do_rem_ridge", str(self.do_rem_ridge))
-        self.mp = cp.getboolean( "processing", "use_multiprocessing", str(self.mp))
-        self.nproc = cp.getint( "processing", "nb_proc", self.nproc)
+        self.mp = cp.getboolean( "processing", "mp", cp.get( "processing", "use_multiprocessing", str(self.mp)))     # both names were used
+        self.nproc = cp.getint( "processing", "nproc", cp.getint( "processing", "nb_proc", self.nproc))
+        self.executor = cp.get( "processing", "executor", default_backend(self.mp))   # serial, threads, processes or mpi
+        self.blas_threads = cp.getint( "processing", "blas_threads", self.blas_threads)   # BLAS threads per worker
+        self.prefetch = cp.getint( "processing", "prefetch", self.prefetch)     # depth of the reading and writing queues
+        self.block_processing = cp.getboolean( "processing", "block_processing", str(self.block_processing))
+        self.worker_read = cp.getboolean( "processing", "worker_read", str(self.worker_read))
+        self.vectorized_F1 = cp.getboolean( "processing", "vectorized_F1", str(self.vectorized_F1))
+        self.noise_estimator = cp.get( "processing", "noise_estimator", self.noise_estimator)
         self.do_F1 = cp.getboolean( "processing", "do_F1", str(self.do_F1))
         self.do_F2 = cp.getboolean( "processing", "do_F2", str(self.do_F2))
+        self.peakpicking = cp.getboolean( "peak_picking", "peakpicking", str(self.peakpicking))     # see peak_picking.py
+        self.peakpicking_noise_level = cp.getfloat( "peak_picking", "peakpicking_noise_level", self.peakpicking_noise_level)
+        self.centroid = cp.getboolean( "peak_picking", "centroid", str(self.centroid))
         # load zflist  or  szmlist
         zflist =  cp.get( "processing", "zerofilling", self.zflist)                              # get zf levels
         if zflist:
@@ -708,6 +2251,10 @@ class Proc_Parameters(object):
             if debug>0: print("szmlist:", self.szmlist)
         else:
             self.szmlist = None
+        for axis in ('f1', 'f2'):      # region of interest
+            mzrange = cp.get( "processing", axis+"_mz_range", None)
+            if mzrange and mzrange != "None":
+                setattr(self, axis+"_mz_range", [float(i) for i in mzrange.split()])
         if verif:
             self.verify()
     def verify(self):
@@ -731,8 +2278,36 @@ class Proc_Parameters(object):
             raise Exception("PG_Sane can only be applied on a NUS data-set")
         if (self.zflist!=None) and (self.szmlist!=None):
             raise Exception("Please define only one value : zerofilling or sizes multipliers")
-        if self.mp and mpiutil.MPI_size > 1:
-            raise Exception("use_multiprocessing is not compatible with MPI")
+        if self.executor not in EXECUTORS:
+            raise Exception("executor should be one of %s"%(", ".join(EXECUTORS)))
+        if (self.executor == 'mpi') != (mpiutil.MPI_size > 1):
+            raise Exception("the mpi executor is used if and only if the program is launched with mpirun")
+        if self.precision not in ('double', 'single'):
+            raise Exception("precision should be either double or single")
+        if self.prefetch < 0:
+            raise Exception("prefetch should be positive or 0")
+        for mzrange in (self.f1_mz_range, self.f2_mz_range):
+            if mzrange is not None and (len(mzrange) != 2 or not 0 < mzrange[0] < mzrange[1]):
+                raise Exception("m/z ranges should be given as 2 increasing positive values : low high")
+        if self.quicklook:
+            if self.quicklook_step < 1 or self.quicklook_truncate < 1:
+                raise Exception("quicklook_step and quicklook_truncate should be at least 1")
+            if not (self.do_F1 and self.do_F2):
+                raise Exception("quicklook requires both do_F1 and do_F2")
+            if self.samplingfile is not None:
+                raise Exception("quicklook is not available on NUS data-sets")
+            if self.quicklook_file in (self.infile, self.interfile, self.outfile):
+                raise Exception("quicklook_file should differ from the other files : %s"%self.quicklook_file)
+        if self.adaptive_threshold <= 0:
+            raise Exception("adaptive_threshold should be positive")
+        if self.peakpicking_noise_level <= 0:
+            raise Exception("peakpicking_noise_level should be positive")
+        if self.fft_tolerance < 0 or self.fft_tolerance >= 1:
+            raise Exception("fft_tolerance should be within [0...1[")
+        if self.tempformat not in ('hdf5', 'raw'):
+            raise Exception("tempformat should be either hdf5 or raw")
+        if self.noise_estimator not in NOISE_METHODS:
+            raise Exception("noise_estimator should be one of %s"%(", ".join(NOISE_METHODS)))
         if self.samplingfile is not None:
             if not os.path.exists(self.samplingfile):
                 raise Exception("Sampling file for N.U.S. is missing:",self.samplingfile)
@@ -778,6 +2353,254 @@ class Test(unittest.TestCase):
         sizes = comp_sizes(d, szmlist=(3, 1.5) )
         if SIZEMIN == 1024:
             self.assertEqual( sizes, [(3072, 15360), (1024, 3840), (1024, 1920)])
+    def test_roi(self):
+        "testing that cropping to a region of interest keeps the calibration"
+        d = FTICRData(dim = 2)
+        d.axis1.size = 1024
+        d.axis2.size = 8192
+        d.axis1.specwidth = 500000.0
+        d.axis2.specwidth = 1000000.0
+        full = d.axis2.copy()
+        sizes = crop_roi(d, None, (400.0, 800.0), [(1024, 2048), (256, 512)])
+        size1, size2, i0, i1, j0, j1 = roi_window(d)
+        self.assertEqual((i0, i1), (0, 1024))
+        self.assertEqual((j0%16, j1%16), (0, 0))
+        self.assertTrue(d.axis2.itomz(d.size2-1) <= 400.0 and d.axis2.itomz(0) >= 800.0)
+        self.assertEqual(sizes, [(1024, (j1-j0)//4), (256, (j1-j0)//16)])
+        pts = np.arange(d.size2)
+        self.assertTrue(np.allclose(d.axis2.itomz(pts), full.itomz(pts+j0), rtol=1E-12))
+    def test_quicklook(self):
+        "testing that the quick-look data keep the m/z axes, and that small data-sets get their processed size"
+        d = FTICRData(buffer = np.random.randn(100, 1002))
+        d.params = {}
+        d.axis1.specwidth = 500000.0
+        d.axis2.specwidth = 1000000.0
+        dq = quicklook_data(d, 8, 4)
+        self.assertEqual((dq.size1, dq.size2), (12, 250))
+        self.assertTrue(np.all(dq.buffer == d.buffer[:12, :250]))
+        self.assertEqual((dq.axis1.specwidth, dq.axis2.specwidth), (d.axis1.specwidth, d.axis2.specwidth))
+        self.assertAlmostEqual(dq.axis2.itomz(dq.size2/2), d.axis2.itomz(d.size2/2))
+        self.assertEqual(comp_sizes(dq, szmlist=(1.0, 1.0))[0], (12, 256))
+    def test_F2block(self):
+        "testing F2 processing by blocks against row by row processing"
+        param = Proc_Parameters()
+        dinp = FTICRData(buffer = np.random.randn(20, 1000))
+        for size in (2048, 800):
+            dref = FTICRData(buffer = np.zeros((20, size)))
+            dblk = FTICRData(buffer = np.zeros((20, size)))
+            do_proc_F2mp(dinp, dref, param)
+            do_proc_F2block(dinp, dblk, param)
+            self.assertTrue(np.allclose(dref.buffer, dblk.buffer, rtol=1E-12, atol=1E-12))
+    def test_block_memory(self):
+        "testing that the blocks hold in blockmem whatever the type of the values"
+        d = FTICRData(buffer = np.zeros((100, 64)))
+        for dtype in (np.float64, np.float32):
+            size = np.dtype(dtype).itemsize
+            self.assertEqual(block_size(d, d, 64, blockmem=10*64*size, dtype=dtype), 10)
+            self.assertEqual(ColumnReader(d, blockmem=8*100*size, dtype=dtype).width, 8)
+            d.buffer = d.buffer.astype(dtype)      # as intermediate_in_memory() does
+            self.assertEqual(ColumnWriter(d, blockmem=4*4*100*size).width, 4)     # room for 4 blocks
+    def test_caches(self):
+        "testing cached windows and FFT plans against NPKData kaiser() and rfft()"
+        d = FTICRData(buffer = np.random.randn(6, 1000))
+        ref = d.copy().kaiser(beta=3.5, axis=2).rfft(axis=2)
+        hits = cache_stats['window'][0]
+        for i in range(2):
+            d2 = apod(d.copy(), 1000, axis=2)
+        self.assertTrue(cache_stats['window'][0] > hits)
+        self.assertTrue(np.all(rfft_data(d2, axis=2).buffer == ref.buffer))
+        self.assertEqual(d2.axis2.itype, 1)
+        c = d.col(3)
+        self.assertTrue(np.all(rfft_data(c.copy()).buffer == c.rfft().buffer))
+    def test_column_writer(self):
+        "testing ColumnWriter with columns arriving in any order"
+        ref = np.random.randn(10, 17)
+        d = FTICRData(buffer = np.zeros((10, 17)))
+        noise = np.zeros(17)
+        w = ColumnWriter(d, blockmem=3*4*8*10, noise=noise)     # blocks of 3 columns
+        self.assertEqual(w.width, 3)
+        for i in (5, 0, 16, 2, 1, 3):
+            w.set_col(i, ref[:,i], i+1.0)
+        w.set_cols(6, ref[:,6:11], np.arange(7.0, 12.0))
+        w.set_col(4, ref[:,4], 5.0)
+        self.assertTrue(np.all(d.buffer[:,:9] == ref[:,:9]))    # complete blocks are written
+        self.assertTrue(np.all(d.buffer[:,9:] == 0.0))
+        w.set_cols(11, ref[:,11:16], np.arange(12.0, 17.0))
+        w.flush()
+        self.assertTrue(np.all(d.buffer == ref))
+        self.assertTrue(np.all(noise == np.arange(1.0, 18.0)))
+    def test_progress(self):
+        "testing the progress watermark and resuming ColumnWriter"
+        d = FTICRData(buffer = np.ones((10, 17)))
+        p = Progress(d, 'F1', start=4)
+        w = ColumnWriter(d, blockmem=3*4*8*10, progress=p, start=4)     # blocks of 3 columns
+        ref = np.random.randn(10, 17)
+        w.set_cols(9, ref[:,9:13])
+        self.assertEqual(p.mark, 4)
+        w.set_cols(4, ref[:,4:9])
+        self.assertEqual(p.mark, 12)
+        w.set_cols(13, ref[:,13:])
+        w.flush()
+        self.assertEqual(p.mark, 17)
+        self.assertTrue(np.all(d.buffer[:,:4] == 1.0))      # columns before start are untouched
+        self.assertTrue(np.all(d.buffer[:,4:] == ref[:,4:]))
+        p = Progress(d, 'F1')
+        w = ColumnWriter(d, blockmem=3*4*8*10, progress=p)
+        w.set_cols(0, ref[:,0:4])
+        w.set_col(5, ref[:,5])
+        w.flush()
+        self.assertEqual(p.mark, 4)         # column 4 was not received
+    def test_interrupted_resume(self):
+        "testing that a run interrupted partway, then resumed from its watermark, gives the uninterrupted result"
+        ref = np.random.randn(10, 40)
+        d = FTICRData(buffer = np.zeros((10, 40)))
+        def run(start, stop=None):
+            p = Progress(d, 'F1', start)
+            w = ColumnWriter(d, blockmem=3*4*8*10, progress=p, start=start)     # blocks of 3 columns
+            def compute(xs):
+                for i in xs:
+                    if i == stop:
+                        raise IOError("interrupted")
+                    yield (i, 2*ref[:,i])
+            def store(res):
+                for i, buf in res:
+                    w.set_col(i, buf)
+                w.flush()
+            try:
+                pipeline(compute, range(start, 40), store, 2)
+            except IOError:
+                pass
+            return p.mark
+        mark = run(0, 20)
+        self.assertEqual(mark, 18)      # the incomplete block is neither stored nor counted
+        self.assertTrue(np.all(d.buffer[:,mark:] == 0.0))
+        self.assertEqual(run(mark), 40)
+        self.assertTrue(np.all(d.buffer == 2*ref))
+    def test_F1context(self):
+        "testing F1 processing with the worker context against the per-column code"
+        param = Proc_Parameters()
+        dinp = FTICRData(buffer = np.random.randn(500, 6))
+        dinp.buffer[:,2:4] = 0.0        # an empty pair
+        rot = 37.3
+        for vectorized in (False, True):
+            param.vectorized_F1 = vectorized
+            for size in (2048, 512):
+                ctx = F1Context(param, dinp, rot, size)
+                ctx.npairs = 2          # so that the kernel is called on blocks of different sizes
+                set_context(ctx)
+                i0, out, noise, ranks = _do_proc_F1range((0, 6, dinp.buffer.copy()))
+                self.assertEqual(i0, 0)
+                self.assertEqual(noise[1], 0.0)     # the empty pair
+                for k in range(3):
+                    c0 = FTICRData(buffer = dinp.buffer[:,2*k].copy())
+                    c1 = FTICRData(buffer = dinp.buffer[:,2*k+1].copy())
+                    ref, refnoise, rank = _do_proc_F1_demodu_modu((c0, c1, rot, size, param))
+                    self.assertTrue(np.allclose(ref, out[:,k], rtol=1E-12, atol=1E-12))
+                    self.assertTrue(np.allclose(refnoise, noise[k], rtol=1E-12, atol=1E-12))
+    def test_F1column_context(self):
+        "testing F1 processing without demodulation by ranges against the per-column code"
+        param = Proc_Parameters()
+        dinp = FTICRData(buffer = np.random.randn(500, 6))
+        for modulus, kernel in ((False, _do_proc_F1), (True, _do_proc_F1_modu)):
+            set_context(F1ColumnContext(param, dinp, 1024, modulus))
+            j0, out, noise = _do_proc_F1cols((2, 6, dinp.buffer[:,2:6]))
+            self.assertEqual(j0, 1 if modulus else 2)
+            cols = ColumnReader(dinp)
+            for k in range(out.shape[1]):
+                if modulus:
+                    ref, refnoise = kernel((cols.col(2+2*k), cols.col(3+2*k), 1024, param))
+                else:
+                    ref, refnoise = kernel((cols.col(2+k), 1024, param))
+                self.assertTrue(np.all(ref == out[:,k]))
+                self.assertEqual(refnoise, noise[k])
+    def test_adaptive_denoising(self):
+        "testing that the denoising rank follows the number of lines, and that noise-only columns are skipped"
+        np.random.seed(12)
+        param = Proc_Parameters()
+        param.do_urqrd = True
+        param.adaptive_denoising = True
+        t = np.arange(1000)
+        for (freqs, rank) in (((), 0), ((0.11, 0.27, 0.36), 12)):
+            z = np.random.randn(1000) + 1j*np.random.randn(1000)
+            for f in freqs:
+                z += 10*np.exp(2j*np.pi*f*t)
+            d = FTICRData(buffer = np.stack((z.real, z.imag), axis=1))
+            self.assertEqual(count_lines(d, param.adaptive_threshold), len(freqs))
+            ref = d.copy()
+            self.assertEqual(denoise(d, param), rank)
+            self.assertEqual(np.all(d.buffer == ref.buffer), rank == 0)
+        param.adaptive_denoising = False
+        self.assertEqual(denoise(d, param), param.urqrd_rank)
+    def test_single_precision(self):
+        "testing that single precision stays within 1E-5 of the largest value of the double precision results"
+        param = Proc_Parameters()
+        param.compress_outfile = False
+        block = np.random.randn(10, 1000)
+        ref = rfft_block(apod_block(block, 2048, beta=3.5))
+        single = rfft_block(apod_block(block.astype(np.float32), 2048, beta=3.5))
+        self.assertEqual(single.dtype, np.float32)
+        self.assertTrue(abs(single-ref).max() < 1E-5*abs(ref).max())
+        band = np.random.randn(500, 6)
+        band[::50] += 100.0     # some signal
+        res = {}
+        for precision in ('double', 'single'):
+            param.precision = precision
+            set_context(F1Context(param, FTICRData(buffer=band), 37.3, 2048))
+            i0, res[precision], noise, ranks = _do_proc_F1range((0, 6, band.astype(float_type(param))))
+        self.assertEqual(res['single'].dtype, np.float32)
+        self.assertTrue(abs(res['single']-res['double']).max() < 1E-5*abs(res['double']).max())
+    def test_shared_arrays(self):
+        "testing that pickled SharedArray and MappedArray give access to the same data"
+        import tempfile
+        sh = SharedArray((10, 6))
+        other = pickle.loads(pickle.dumps(sh))
+        sh.buffer[3,4] = 1.5
+        self.assertEqual(other.buffer[3,4], 1.5)
+        other.release()
+        sh.release()
+        fname = os.path.join(tempfile.gettempdir(), 'test_mapped.raw')
+        mapped = MappedArray(fname, (10, 6))
+        mapped.buffer[2,5] = 2.5
+        mapped.flush()
+        other = pickle.loads(pickle.dumps(mapped))
+        self.assertEqual(other.buffer[2,5], 2.5)
+        other.release()
+        mapped.release()
+        self.assertFalse(os.path.exists(fname))
+    def test_stream_downsampler(self):
+        "testing downsampling on the fly against downsample2D"
+        src = FTICRData(buffer = np.random.randn(32, 2048)**2)
+        for n1, n2 in ((1,16), (4,4), (2,1)):
+            dref = FTICRData(buffer = np.zeros((32//n1, 2048//n2)))
+            dstr = FTICRData(buffer = np.zeros((32//n1, 2048//n2)))
+            downsample2D(src, dref, n1, n2)
+            sd = StreamDownsampler(dstr, n1, n2, blockmem=8*32*100)
+            blocks = [(i, src.buffer[:, i:i+300]) for i in range(0, 2048, 300)]
+            for start, block in blocks[3:]+blocks[:3]:     # out of order
+                sd.push(start, block)
+            self.assertTrue(sd.complete())
+            self.assertTrue(np.allclose(dref.buffer, dstr.buffer, rtol=1E-12, atol=1E-12))
+    def test_projections(self):
+        "testing diagonal and projections computed on the fly against the full data-set"
+        d = FTICRData(buffer = np.random.randn(64, 1024))
+        d.axis1.specwidth = 500000.0
+        d.axis2.specwidth = 1000000.0
+        a = d.get_buffer()
+        ref = np.zeros(1024)
+        for j in range(1024):
+            i = d.axis1.mztoi(d.axis2.itomz(j))
+            if np.isfinite(i) and 0 <= round(i) < 64:
+                ref[j] = a[int(round(i)), j]
+        pr = Projections(d)
+        for start in (512, 0, 768, 256):     # out of order
+            pr.push(start, a[:, start:start+256])
+        pr2 = Projections(d)
+        pr2.scan(blockmem=8*64*100)
+        for p in (pr, pr2):
+            self.assertTrue(np.all(p.diag == ref))
+            self.assertTrue((p.diag != 0).sum() > 10)
+            self.assertTrue(np.all(p.proj1 == np.maximum(a.max(axis=1), 0)))
+            self.assertTrue(np.all(p.proj2 == np.maximum(a.max(axis=0), 0)))
     def test_proc(self):
         "apply a complete processing test"
         # test is run from above spike
@@ -839,8 +2662,10 @@ def main(argv = None):
     """
     Does the whole on-file processing, 
     syntax is
-    processing.py [ configuration_file.mscf ]
+    processing.py [ configuration_file.mscf ] [ --resume ]
     if no argument is given, the standard file : process.mscf is used.
+    with --resume, an interrupted processing is continued from where it stopped,
+    using the progress stored in the intermediate and output files
     """
     import datetime as dt
     print('CONFIG:', os.path.realpath( os.curdir), os.path.exists(sys.argv[1]))
@@ -851,13 +2676,14 @@ def main(argv = None):
 =============================
     reading configuration
 =============================""")
-    global Pool     # This global will hold the multiprocessing.Pool if needed
-    Pool = None
+    global executor     # This global will hold the Executor
     t0 = time.time()
     t00 = t0
     ######### read arguments
     if not argv:
         argv = sys.argv
+    resume = '--resume' in argv
+    argv = [a for a in argv if a != '--resume']
     try:                        # First try to read config file from arg list
         configfile = argv[1]
     except IndexError:          # then assume standard name
@@ -883,8 +2709,8 @@ def main(argv = None):
         v = cp.getfloat( "import", p, 0.0)
         if v != 0.0:
             opt_param[p] = v
-    if param.mp:
-        Pool = mp.Pool(param.nproc)     # if multiprocessing, creates slaves early, while memory is empty !
+    executor = Executor(param.executor, param.nproc, param.blas_threads)    # creates slaves early, while memory is empty !
+    print("running on", executor)
     param.report()
     logflux.log.flush()     # flush logfile
     ######## determine files and load inputfile
@@ -894,32 +2720,17 @@ def main(argv = None):
 =============================
     preparating files
 =============================""")
-    if not os.path.exists(param.infile):
-        print("importing %s into %s"%(".", param.infile))  #To be corrected MAD
-        d0 = Import_2D[param.format](param.apex, param.infile)
+    if not os.path.exists(param.infile) and not param.create_infile:
+        print("reading %s data-set %s directly, without creating %s"%(param.format, param.apex, param.infile))
+        d0 = open_ser(param.apex, param.format, opt_param)
+    elif not os.path.exists(param.infile):
+        print("importing %s into %s"%(param.apex, param.infile))
+        d0 = import_2D(param.apex, param.infile, param.format, opt_param, compress=param.compress_infile, imap=executor.imap_unordered, blockmem=BLOCKMEM)
         imported = True
-        if opt_param != {}: # if some parameters were overloaded in config file
-            # hum close, open, close, open ...
-            d0.hdf5file.close()
-            del(d0)
-            hf = HDF5File(param.infile,"rw")
-            for item in opt_param:
-                if item.startswith('F1_'):
-                    fileitem = item[3:]
-                    hf.axes_update(axis = 1, infos = {fileitem:opt_param[item]})
-                    print("Updating axis F1 %s to %f"%(fileitem, opt_param[item]))
-                elif item.startswith('F2_'):
-                    fileitem = item[3:]
-                    hf.axes_update(axis = 2, infos = {fileitem:opt_param[item]})
-                    print("Updating axis F2 %s to %f"%(fileitem, opt_param[item]))
-                else:
-                    hf.axes_update(axis = 1, infos = {item:opt_param[item]})
-                    hf.axes_update(axis = 2, infos = {item:opt_param[item]})
-                    print("Updating all axes %s to %f"%(item, opt_param[item]))
-            hf.close()
-            d0 = load_input(param.infile)
     else:
         d0 = load_input(param.infile)
+    if param.worker_read and executor.remote:
+        d0 = reopen_readonly(d0)      # so that workers can read it
     d0.check2D()    # raise error if not a 2D
     try:
         d0.params
@@ -930,25 +2741,35 @@ def main(argv = None):
     else:
         print_time( time.time()-t0, "Load")
     logflux.log.flush()     # flush logfile
+    ###### quick-look, from the same input
+    if param.quicklook and not resume:
+        print("""
+=============================
+    quick-look processing
+=============================""")
+        t0 = time.time()
+        quick_look(d0, param, configfile)
+        print_time( time.time()-t0, "Quick-look time")
+        print("provisional data-set %s available, going on with the full processing"%param.quicklook_file)
+        logflux.log.flush()     # flush logfile
     ###### Read processing arguments
     Set_Table_Param()
     if debug>0:
         Report_Table_Param()
         print(d0.report())
     ### compute final sizes
-    allsizes = comp_sizes(d0, zflist=param.zflist, szmlist=param.szmlist, largest = param.largest)
+    allsizes = comp_sizes(d0, zflist=param.zflist, szmlist=param.szmlist, largest = param.largest, tolerance=param.fft_tolerance, dtype=float_type(param))
     if debug>0: print(allsizes)
     (sizeF1, sizeF2) = allsizes.pop(0)   # this is the largest, to be processed by FT
     ### prepare intermediate file
     if debug>0: print("preparing intermediate file ")
     if param.interfile is None:     # We have to create one !
         interfile = os.path.join(param.tempdir,'tmpfile_for_{}'.format(os.path.basename(param.outfile)))  
-        print("creating TEMPFILE:",interfile)
     else:
         interfile = param.interfile
     ### in F2
+    f2start = None      # first row to process, None if the intermediate file is to be created
     if param.do_F2:     # create
-        temp =  HDF5File(interfile, "w")
         datatemp = FTICRData(dim = 2)
         copyaxes(d0, datatemp)
         datatemp.params = d0.params
@@ -958,31 +2779,98 @@ def main(argv = None):
         else:
             datatemp.axis1.size = min(d0.size1, sizeF1)
             datatemp.axis2.size = sizeF2
-        temp.create_from_template(datatemp)
+        f2sig = F2_signature(param, d0, datatemp)
+        if resume and os.path.exists(interfile):
+            temp, dtemp = open_for_resume(interfile)
+            f2start = resume_point(dtemp, 'F2', f2sig)
+            if f2start is None:
+                print("intermediate file %s does not match the current processing, it is recomputed"%interfile)
+                temp.close()
+            else:
+                print("resuming intermediate file %s at row %d"%(interfile, f2start))
+                datatemp = dtemp
+        mbytes = 1E-6*np.dtype(intermediate_type(param)).itemsize*datatemp.size1*datatemp.size2
+        scratch = (f2start is None and param.interfile is None and param.do_F1      # not an HDF5 file
+                    and not (resume and os.path.exists(interfile)))
+        if scratch and intermediate_in_memory(datatemp, param):
+            print("intermediate data kept in %s: %.1f MB - memory_budget is %.1f MB"%(
+                "shared memory" if hasattr(datatemp, 'shared') else "memory", mbytes, param.memory_budget))
+        elif scratch and param.tempformat == 'raw':
+            rawfile = os.path.splitext(interfile)[0] + '.raw'
+            print("creating raw intermediate file %s: %.1f MB"%(rawfile, mbytes))
+            datatemp.shared = MappedArray(rawfile, (datatemp.size1, datatemp.size2), intermediate_type(param))
+            datatemp.buffer = datatemp.shared.buffer
+        elif f2start is None:
+            scratch = False
+            temp =  HDF5File(interfile, "w")
+            if param.block_processing:      # chunks adapted to row writing and column reading
+                temp.chunks = intermediate_chunks(d0, datatemp)
+            temp.create_from_template(datatemp)
+            print("creating intermediate file %s: %.1f MB"%(interfile, 1E-6*itemsize(datatemp)*datatemp.size1*datatemp.size2))    # msh5 files are in float64
+            set_signature(datatemp, 'F2', f2sig)
     else:                # already existing
+        scratch = False
         datatemp = load_input(param.interfile)
+        f2sig = get_signature(datatemp, 'F2')
+        f2start = 0
     datatemp.params = d0.params
     logflux.log.flush()     # flush logfile
     ### prepare output file
     if debug>0: print("preparing output file ")
+    f1start = None      # first column to process, None if the output file is to be created
     if param.do_F1:
-        hfar =  HDF5File(param.outfile, "w") #, debug=debug)  # OUTFILE for all resolutions
         d1 = FTICRData( dim = 2 )   # create dummy 2D
         copyaxes(d0, d1)        # copy axes from d0 to d1
         d1.axis2.size = sizeF2
         d1.axis1.size = sizeF1
         group = 'resol1'
-        if param.compress_outfile:    # file is compressed
-            hfar.set_compression(True)
-        hfar.create_from_template(d1, group)
+        allsizes = region_of_interest(d0, d1, param, allsizes)
+        f1sig = F1_signature(param, f2sig, d1)
+        if resume and f2start is not None and os.path.exists(param.outfile):     # intermediate file was kept
+            hfar, dout = open_for_resume(param.outfile, group)
+            f1start = resume_point(dout, 'F1', f1sig)
+            if f1start is None:
+                print("output file %s does not match the current processing, it is recomputed"%param.outfile)
+                hfar.close()
+            else:
+                print("resuming output file %s at column %d"%(param.outfile, f1start))
+                d1.buffer = dout.buffer
+                levels = create_pyramid(hfar, d1, allsizes, create=False)
+                if param.sparse_outfile:
+                    for d in [d1] + [down for (grp, down, n1, n2) in levels]:
+                        make_sparse(d, create=False)
+        if f1start is None:
+            f1start = 0
+            hfar =  HDF5File(param.outfile, "w") #, debug=debug)  # OUTFILE for all resolutions
+            if param.compress_outfile:    # file is compressed
+                hfar.set_compression(True)
+            hfar.create_from_template(d1, group)
+            set_signature(d1, 'F1', f1sig)
+            levels = create_pyramid(hfar, d1, allsizes)     # downsampled versions of d1
+            if param.sparse_outfile:        # empty chunks are not written
+                for d in [d1] + [down for (grp, down, n1, n2) in levels]:
+                    make_sparse(d)
         d1.params = d0.params
+        d1.noise = noise_node(hfar, d1, group)      # filled during F1, used by the peak picking
+        if denoising_rank(param) > 0:
+            d1.denoising = DenoisingStats(hfar, d1, param, group)
         if debug>0:
             print("######################### d1.report() ################")
             print(d1.report())
             print("######################### Checked ################")
+        if param.block_processing and f1start == 0:      # computed on the fly during F1
+            pyramid = stream_pyramid(levels, compress=param.compress_outfile, method=param.noise_estimator)
+        else:
+            pyramid = None
+        if f1start == 0:        # diagonal and projections also computed during F1
+            projections = Projections(d1, nextlevel=pyramid)
+        else:
+            projections = None
     else:
         d1 = None
         hfar = None
+        pyramid = None
+        projections = None
     logflux.log.flush()     # flush logfile
     ###### Do processing
     print("""
@@ -990,17 +2878,27 @@ def main(argv = None):
     FT processing
 =============================""")
     t0 = time.time()
-    do_process2D(d0, datatemp, d1, param) # d0 original, d1 processed
+    do_process2D(d0, datatemp, d1, param, projections, f2start or 0, f1start or 0) # d0 original, d1 processed
     # close temp file
     # try:
     #     d0.hdf5file.close()
     # except AttributeError:      # depends on how d0 was loaded
     #     pass
-    datatemp.hdf5file.close()
+    if not scratch:
+        datatemp.hdf5file.close()
+    elif hasattr(datatemp, 'shared'):
+        datatemp.shared.release()
     ### update files
     if param.do_F1:
         hfar.axes_update(group = group,axis = 1, infos = {'offsetfreq':d1.axis1.offsetfreq} )
-    if param.interfile is None:
+        for (grp, down, n1, n2) in levels:
+            hfar.axes_update(group = grp,axis = 1, infos = {'offsetfreq':d1.axis1.offsetfreq} )
+        if projections is None:     # resumed processing, computed from the stored data
+            projections = Projections(d1)
+            projections.scan()
+        projections.store(hfar)
+        print("diagonal and projections stored")
+    if param.interfile is None and not scratch:
         temp.close()
         os.unlink(interfile)
     print("==  FT Processing finished  ==")
@@ -1012,27 +2910,21 @@ def main(argv = None):
 =============================
     downsampling
 =============================""")
-        downprevious = d1       # used to downsample by step   downprevious -downto-> down
+        downsample_pyramid(d1, levels, pyramid, param)
+    ### peak picking
+    if param.do_F1 and param.peakpicking:
+        print("""
+=============================
+    peak picking
+=============================""")
         t0 = time.time()
-        for (i, (sizeF1, sizeF2)) in enumerate(allsizes):
-            if (downprevious.size1%sizeF1) != 0 or  (downprevious.size2%sizeF2) != 0:
-                print("downsampling not available for level %d : %d x %d -> %d x %d"%((i+1), downprevious.size1, downprevious.size2, sizeF1, sizeF2))
-                continue
-            zflevel = "level %d"%(i+1)
-            group = 'resol%d'%(i+2)     # +2 because we poped the first value
-            print("downsampling %s - %s  (%d x %d)" % (zflevel, group, sizeF1, sizeF2) )
-            down = FTICRData( dim = 2 )   # create dummy 2D
-            copyaxes(d1, down)        # copy axes from d1 to down
-            down.axis1.size = sizeF1
-            down.axis2.size = sizeF2
-            #create_branch(hfar, group, d1)
-            hfar.create_from_template(down, group)
-            if debug > 0: print(down)
-            downsample2D(downprevious, down, downprevious.size1//sizeF1, downprevious.size2//sizeF2, compress=param.compress_outfile)
-            downprevious = down
-        print_time(time.time()-t0, "Downsampling time")
+        peaks = do_peak_picking(d1, param)
+        store_peaks(hfar, peaks, d1, param.peakpicking_noise_level)
+        print("%d peaks detected above %.1f x noise level, stored in /peaks"%(len(peaks), param.peakpicking_noise_level))
+        print_time(time.time()-t0, "Peak picking time")
     print("== Processing finished  ==")
     print_time(time.time() - t00, "Total processing time")
+    if debug>0: print(cache_report(), "(main process)")
     logflux.log.flush()     # flush logfile
     ### clean and close output files
     # copy attached to outputfile
@@ -1043,36 +2935,45 @@ def main(argv = None):
     # copy files and parameters
     if hfar is not None:
         hfar.store_internal_file(filename=configfile, h5name="config.mscf", where='/attached')  # first mscf
-        try:
-            hfar.store_internal_object( h5name='params', obj=d0.hdf5file.retrieve_object(h5name='params') )
-        except:
-            print("No params copied to Output file") 
+        if hasattr(d0, 'files'):        # read directly from the ser file, parameters are copied from the acquisition
+            attach_acquisition(d0, hfar)
+            print("parameters, acquisition and configuration files copied")
         else:
-            print("parameters and configuration file copied")
-
-        for h5name in ["apexAcquisition.method", "ExciteSweep"]:    # then parameter files
             try:
-                Finh5 = d0.hdf5file.open_internal_file(h5name)
+                hfar.store_internal_object( h5name='params', obj=d0.hdf5file.retrieve_object(h5name='params') )
             except:
-                print("no %s internal file to copy"%h5name)
-            else:   # performed only if no error
-                Fouth5 = hfar.open_internal_file(h5name, access='w')
-                Fouth5.write(Finh5.read())
-                Finh5.close()
-                Fouth5.close()
-                print("%s internal file copied"%h5name)
+                print("No params copied to Output file") 
+            else:
+                print("parameters and configuration file copied")
+
+            for h5name in ["apexAcquisition.method", "ExciteSweep"]:    # then parameter files
+                try:
+                    Finh5 = d0.hdf5file.open_internal_file(h5name)
+                except:
+                    print("no %s internal file to copy"%h5name)
+                else:   # performed only if no error
+                    Fouth5 = hfar.open_internal_file(h5name, access='w')
+                    Fouth5.write(Finh5.read())
+                    Finh5.close()
+                    Fouth5.close()
+                    print("%s internal file copied"%h5name)
+        # occupancy of the sparse data-sets
+        for (grp, d) in [(group, d1)] + [(grp, down) for (grp, down, n1, n2) in levels]:
+            if isinstance(d.buffer, SparseArray):
+                d.buffer.save()
+                print("%s stored sparse, %.1f %% of the chunks hold data"%(grp, 100*d.buffer.fill_ratio()))
         # then logfile
         logflux.log.flush()     # flush logfile
         hfar.store_internal_file(filename=logflux.log_name, h5name="processing.log", where='/attached')
         print("log file copied")
         # and close
-        d0.hdf5file.close()
         hfar.close()
+    if hasattr(d0, 'shared'):
+        d0.shared.release()
     else:
         d0.hdf5file.close()
  
-    if param.mp:
-        Pool.close()    # finally closes multiprocessing slaves
+    executor.close()    # finally closes the slaves
     logflux.log.flush()     # flush logfile
 
 # default values
@@ -1085,4 +2986,5 @@ if __name__ == '__main__':
             main()
             mpiutil.shutdown()
         else:               # slave proc
+            limit_blas_threads(1)
             mpiutil.slave()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+sparse_store.py
+
+sparse storage of the thresholded msh5 outputs.
+
+With compression, most of the points of the processed data-sets are exact zeros.
+In the sparse layout, the HDF5 chunks of a resolN/data array which hold only zeros are never written
+- HDF5 does not allocate them, and reads them as zeros - and an occupancy bitmap, one value per chunk,
+is stored next to the data as resolN/occupancy.
+
+The files remain regular msh5 files, readable by any program.
+SparseArray uses the bitmap to skip the empty chunks : they are neither written nor read,
+so zoomed reads only touch the chunks holding data.
+load_sparse() gives this access to the data-sets loaded from a msh5 file.
+"""
+
+from __future__ import print_function, division
+import unittest
+import numpy as np
+import tables
+
+OCCUPANCY = 'occupancy'     # name of the bitmap in the resolN groups
+
+def _runs(mask):
+    "yields the (j0, j1) ranges of consecutive True values of the 1D boolean array mask"
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    return zip(starts, stops)
+
+def _range(key, size):
+    "returns (start, stop, step, isint) for key, an int or a slice over size points"
+    if isinstance(key, slice):
+        start, stop, step = key.indices(size)
+        return (start, max(start, stop), step, False)
+    i = int(key)
+    if i < 0:
+        i += size
+    if not 0 <= i < size:
+        raise IndexError("index %d out of range"%key)
+    return (i, i+1, 1, True)
+
+class SparseArray(object):
+    """
+    the 2D data array of a resolN group, node, accessed through its occupancy bitmap
+    reads (as in a[i0:i1, j0:j1]) skip the empty chunks, and writes skip the chunks which receive only zeros
+    the bitmap is loaded from the file, or, if absent, computed from the file when create is False
+    (all chunks are considered occupied if occupied is True), or empty when create is True (a new array)
+    save() stores the bitmap - other attributes are the ones of node
+    """
+    def __init__(self, node, create=False, occupied=False):
+        self.node = node
+        self.shape = tuple(int(i) for i in node.shape)
+        self.chunkshape = tuple(int(i) for i in node.chunkshape)
+        self.grid = tuple(-(-s//c) for s, c in zip(self.shape, self.chunkshape))
+        group = node._v_parent
+        if OCCUPANCY in group and not create:
+            self.occupancy = group._f_get_child(OCCUPANCY).read().astype(bool)
+        elif create:
+            self.occupancy = np.zeros(self.grid, dtype=bool)
+        elif occupied:
+            self.occupancy = np.ones(self.grid, dtype=bool)
+        else:
+            self.occupancy = self._scan()
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+    def __len__(self):
+        return self.shape[0]
+    @property
+    def ndim(self):
+        return 2
+    @property
+    def size(self):
+        return self.shape[0]*self.shape[1]
+    def _scan(self):
+        "computes the bitmap from the content of the file, by bands of chunks"
+        c1, c2 = self.chunkshape
+        occ = np.zeros(self.grid, dtype=bool)
+        for i in range(self.grid[0]):
+            band = self.node[i*c1:(i+1)*c1, :] != 0
+            pad = np.zeros((c1, self.grid[1]*c2), dtype=bool)
+            pad[:band.shape[0], :band.shape[1]] = band
+            occ[i] = pad.reshape((c1, self.grid[1], c2)).any(axis=(0, 2))
+        return occ
+    def _key(self, key):
+        "normalizes key into the ranges along both axes"
+        if key is Ellipsis:
+            key = (slice(None), slice(None))
+        elif not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError("SparseArray are 2D")
+        return [_range(k, s) for k, s in zip(key, self.shape)]
+    def fill_ratio(self):
+        "the fraction of chunks holding data"
+        return self.occupancy.mean()
+    def read(self, i0, i1, j0, j1):
+        "returns the block [i0:i1, j0:j1], reading only the chunks holding data"
+        c1, c2 = self.chunkshape
+        out = np.zeros((i1-i0, j1-j0), dtype=self.node.dtype)
+        if i1 <= i0 or j1 <= j0:
+            return out
+        ci0, ci1 = i0//c1, -(-i1//c1)
+        cj0, cj1 = j0//c2, -(-j1//c2)
+        occ = self.occupancy[ci0:ci1, cj0:cj1]
+        if occ.all():
+            return self.node[i0:i1, j0:j1]
+        for ci in range(ci0, ci1):
+            r0, r1 = max(i0, ci*c1), min(i1, (ci+1)*c1)
+            for (k0, k1) in _runs(occ[ci-ci0]):
+                s0, s1 = max(j0, (cj0+k0)*c2), min(j1, (cj0+k1)*c2)
+                out[r0-i0:r1-i0, s0-j0:s1-j0] = self.node[r0:r1, s0:s1]
+        return out
+    def __getitem__(self, key):
+        (i0, i1, si, inti), (j0, j1, sj, intj) = self._key(key)
+        out = self.read(i0, i1, j0, j1)[::si, ::sj]
+        if inti and intj:
+            return out[0, 0]
+        if inti:
+            return out[0]
+        if intj:
+            return out[:, 0]
+        return out
+    def __array__(self, dtype=None, copy=None):
+        out = self.read(0, self.shape[0], 0, self.shape[1])
+        return out if dtype is None else out.astype(dtype)
+    def __setitem__(self, key, value):
+        (i0, i1, si, inti), (j0, j1, sj, intj) = self._key(key)
+        if si != 1 or sj != 1:
+            raise IndexError("SparseArray only supports contiguous writes")
+        shape = [n for (n, isint) in ((i1-i0, inti), (j1-j0, intj)) if not isint]   # the shape of the value, as in numpy
+        value = np.broadcast_to(np.asarray(value, dtype=self.node.dtype), shape).reshape((i1-i0, j1-j0))
+        c1, c2 = self.chunkshape
+        ci0, ci1 = i0//c1, -(-i1//c1)
+        cj0, cj1 = j0//c2, -(-j1//c2)
+        for ci in range(ci0, ci1):
+            r0, r1 = max(i0, ci*c1), min(i1, (ci+1)*c1)
+            band = value[r0-i0:r1-i0]
+            # a chunk is written if it receives data, or if it held data before
+            todo = self.occupancy[ci, cj0:cj1].copy()
+            for cj in range(cj0, cj1):
+                s0, s1 = max(j0, cj*c2), min(j1, (cj+1)*c2)
+                if band[:, s0-j0:s1-j0].any():
+                    todo[cj-cj0] = True
+            self.occupancy[ci, cj0:cj1] |= todo
+            for (k0, k1) in _runs(todo):
+                s0, s1 = max(j0, (cj0+k0)*c2), min(j1, (cj0+k1)*c2)
+                self.node[r0:r1, s0:s1] = band[:, s0-j0:s1-j0]
+    def save(self):
+        "stores the occupancy bitmap in the file"
+        group = self.node._v_parent
+        if OCCUPANCY in group:
+            group._f_get_child(OCCUPANCY)._f_remove()
+        self.node._v_file.create_array(group, OCCUPANCY, self.occupancy.astype(np.uint8),
+            title="occupancy of the chunks of data")
+        self.node._v_file.flush()
+
+def is_sparse(data):
+    "True if the data-set data, loaded from a msh5 file, is stored in the sparse layout"
+    node = getattr(data, 'buffer', None)
+    if isinstance(node, SparseArray):
+        return True
+    return isinstance(node, tables.Leaf) and OCCUPANCY in node._v_parent
+
+def load_sparse(data):
+    "if data, loaded from a msh5 file, is stored in the sparse layout, sets its buffer to a SparseArray, returns data"
+    if is_sparse(data) and not isinstance(data.buffer, SparseArray):
+        data.buffer = SparseArray(data.buffer)
+    return data
+
+def make_sparse(data, create=True):
+    """
+    sets the buffer of data, a data-set on a msh5 file, to a SparseArray, so that empty chunks are not written
+    create is True for a new data-set, False to continue writing an existing one, returns the SparseArray
+    """
+    data.buffer = SparseArray(data.buffer, create=create, occupied=True)
+    return data.buffer
+
+class Test(unittest.TestCase):
+    """tests """
+    def test_sparse(self):
+        "testing that reads and writes through the bitmap are exact"
+        import os, tempfile
+        fname = os.path.join(tempfile.gettempdir(), 'test_sparse.h5')
+        ref = np.zeros((50, 70))
+        ref[3:5, 10:12] = 1.0
+        ref[40, 66] = -2.0
+        with tables.open_file(fname, "w") as h:
+            g = h.create_group("/", "resol1")
+            node = h.create_carray(g, "data", tables.Float64Atom(), ref.shape, chunkshape=(8, 8))
+            a = SparseArray(node, create=True)
+            a[0:30, :] = ref[0:30]
+            for j in range(70):     # by columns, partially overlapping the chunks
+                a[30:50, j] = ref[30:50, j]
+            a[4, 10] = 0.0          # zeros written in an occupied chunk
+            ref[4, 10] = 0.0
+            a.save()
+            self.assertEqual(a.occupancy.sum(), 2)
+            self.assertEqual(node._v_file.get_node("/resol1/data")[...].tolist(), ref.tolist())
+        with tables.open_file(fname, "r") as h:
+            a = SparseArray(h.root.resol1.data)
+            self.assertTrue(np.all(a[:, :] == ref))
+            self.assertTrue(np.all(a[2:45:3, 5:] == ref[2:45:3, 5:]))
+            self.assertTrue(np.all(a[40] == ref[40]))
+            self.assertTrue(np.all(a[:, 66] == ref[:, 66]))
+            self.assertEqual(a[3, 11], 1.0)
+            self.assertTrue(np.all(np.abs(a) == np.abs(ref)))
+            occ = a.occupancy
+        with tables.open_file(fname, "a") as h:     # without bitmap, computed from the file
+            h.root.resol1.occupancy._f_remove()
+            self.assertTrue(np.all(SparseArray(h.root.resol1.data).occupancy == occ))
+        os.unlink(fname)
+
+if __name__ == '__main__':
+    unittest.main()